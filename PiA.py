@@ -1,14 +1,24 @@
 from object_detection.object_detection import *
+from object_detection.detector_backends import get_detector
 from comms.comms import *
 from gps.gps import Neo8T
 from depth.depth import *
 from datetime import datetime
-from time import sleep
+from time import sleep, perf_counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from comms.updateJSON import *
 import cv2
 from cameras import *
 import logging
-from stitching.stitching_main import performPanoramicStitching
+from stitching.stitching_main import (
+    transformObjectsToPanorama,
+    stitchImages,
+    stitchPreview,
+    getPanoramaShape,
+    loadStitchingMaps,
+)
+from stitching.tile_pyramid import saveThumbnail, buildTilePyramid
 import json
 import traceback
 
@@ -30,7 +40,16 @@ def new_scan(
 
     # Update YOLO model with objects of interest
     logging.info(f"Set objects of interest to {list(classes.keys())}.")
-    rgb_model.set_classes(list(classes.keys()))
+    # Exported detectors are made for the shape detected in. When tiled, the whole frame pass
+    # fits in the tiles' export at the same scale as in its own
+    detect_shape = (RESOLUTION[1], RESOLUTION[0])
+    if OD_TILED:
+        detect_shape = tile_shape(
+            detect_shape, OD_TILE_SIZE, OD_TILE_OVERLAP, OD_MAX_TILES
+        )
+    detector = get_detector(
+        rgb_model, classes.keys(), OD_BACKEND, OD_INT8, detect_shape
+    )
 
     # Captures two images
     setStatusMessage("capturing images")
@@ -49,10 +68,25 @@ def new_scan(
     send_object_detection_results(conn, [classes])
 
     setStatusMessage("detecting objects")
-    # Perform object detection
-    objects = []
-    for i, f in enumerate(frames):
-        objects.append(object_detection(rgb_model, f, i, OD_THRESHOLD))
+    # Perform object detection, on all frames at once unless tiled
+    with stage("Object detection"):
+        if OD_TILED:
+            objects = [
+                object_detection_tiled(
+                    detector,
+                    f,
+                    i,
+                    OD_THRESHOLD,
+                    OD_TILE_SIZE,
+                    OD_TILE_OVERLAP,
+                    OD_MAX_TILES,
+                )
+                for i, f in enumerate(frames)
+            ]
+        else:
+            objects = object_detection_batch(
+                detector, frames, range(len(frames)), OD_THRESHOLD
+            )
 
     # Retrieve slave images and data
     logging.info("Receiving PiB frames")
@@ -87,127 +121,191 @@ def new_scan(
 
     # Blur people if privacy
     setStatusMessage("blurring people")
-    if privacy:
-        for i in range(len(frames)):
-            frames[i] = blur_people(frames[i], objects[i], 255)
+    with stage("Blurring people"):
+        if privacy:
+            for i in range(len(frames)):
+                frames[i] = blur_people(frames[i], objects[i], 255)
 
-    setStatusMessage("stitching images")
-    # Perform pano stitching
-    panorama, objects = performPanoramicStitching(frames, objects)
+    # Object locations in the panorama only depend on the image size, so are found before stitching
+    with stage("Transforming objects to panorama"):
+        objects = transformObjectsToPanorama(frames, objects)
 
-    # Restructure objects into one array instead of separated by frames
-    logging.debug("Restructuring objects array")
-    objects_restructured = []
-    for frame in objects:
-        objects_restructured += frame
+        # Restructure objects into one array instead of separated by frames
+        logging.debug("Restructuring objects array")
+        objects_restructured = []
+        for frame in objects:
+            objects_restructured += frame
 
     # Remove duplicate object detections
     setStatusMessage("removing duplicate objects")
-    filtered_objects = non_maximum_suppression(objects_restructured)
-
-    # Updates json and moves images to correct folder
-    setStatusMessage("updating ui")
-    # uid = str(lon) + str(lat)
-    t = time.strftime("%Y%m%d_%H%M%S")
-    uid = f"{lat},{lon}-{t}"
-    updateJSON(uid, lat, lon, filtered_objects, panorama, activeFile)
-
-    # If manual hs scan checked
-    if manual_hs:
-        # Perform singular 360 hs scan
-        logging.debug("Recieving manual hyperspectral scan results")
-        setStatusMessage("Performing manual 360 hyperspectral scan")
-        hs_classification, hs_ndvi, hs_msavi, hs_custom2, hs_artificial, hs_rgb = receive_image_arrays(conn)
-        hs_materials = receive_object_detection_results(conn)[0]
-
-        # Save results to images in ui
-        id = -1
-
-        # Save paths
-        save_path = UI_IMAGES_SAVE_PATH + activeFile[:-5]
-        hsi_ref = f"/hs_{uid}_{id}_classification.jpg"
-        ndvi_ref = f"/hs_{uid}_{id}_ndvi.jpg"
-        msavi_ref = f"/hs_{uid}_{id}_msavi.jpg"
-        custom2_ref = f"/hs_{uid}_{id}_custom2.jpg"
-        artificial_ref = f"/hs_{uid}_{id}_artificial.jpg"
-        rgb_ref = f"/hs_{uid}_{id}_rgb.jpg"
-
-        logging.debug(f"Writing images to {save_path}")
-        cv2.imwrite(save_path + hsi_ref, hs_classification)
-        cv2.imwrite(save_path + ndvi_ref, hs_ndvi)
-        cv2.imwrite(save_path + msavi_ref, hs_msavi)
-        cv2.imwrite(save_path + custom2_ref, hs_custom2)
-        cv2.imwrite(save_path + artificial_ref, hs_artificial)
-        cv2.imwrite(save_path + rgb_ref, hs_rgb)
-
-        # Update JSON with hyperspectral data
-        updateJSON_HS(
-            filtered_objects,
-            lat,
-            lon,
-            activeFile,
-            hsi_ref,
-            ndvi_ref,
-            msavi_ref,
-            custom2_ref, 
-            artificial_ref,
-            hs_materials,
-            rgb_ref,
+    with stage("Non-maximum suppression"):
+        filtered_objects = non_maximum_suppression(
+            objects_restructured, method=NMS_METHOD
         )
-    else:
-        # Send filtered objects to PiB
+
+    # Start PiB scanning straight away
+    if not manual_hs:
         logging.debug(
             "Sending filtered object detection results to PiB for hyperspectral scanning"
         )
         send_object_detection_results(conn, filtered_objects)
 
-        # Receive processed hyperspectral data from PiB for each object
-        for i in range(len(filtered_objects)):
-            if classes[filtered_objects[i].label]:
-                setStatusMessage(f"hyperspectral scanning {filtered_objects[i].label}")
-                logging.debug(f"hyperspectral scanning {filtered_objects[i].label}")
-
-                # Receive scan information
-                logging.debug(f"Receiving scan data")
-                hs_classification, hs_ndvi, hs_msavi, hs_custom2, hs_artificial, hs_rgb = receive_image_arrays(conn)
-                hs_materials = receive_object_detection_results(conn)[0]
-                logging.debug("Received scan data")
-
-                id = filtered_objects[i].id
-                save_path = UI_IMAGES_SAVE_PATH + activeFile[:-5]
-                hsi_ref = f"/hs_{uid}_{id}_classification.jpg"
-                ndvi_ref = f"/hs_{uid}_{id}_ndvi.jpg"
-                msavi_ref = f"/hs_{uid}_{id}_msavi.jpg"
-                custom2_ref = f"/hs_{uid}_{id}_custom2.jpg"
-                artificial_ref = f"/hs_{uid}_{id}_artificial.jpg"
-                rgb_ref = f"/hs_{uid}_{id}_rgb.jpg"
-
-                # Save results to images in ui
-                logging.debug(f"Writing images to {save_path}")
-                cv2.imwrite(save_path + hsi_ref, hs_classification)
-                cv2.imwrite(save_path + ndvi_ref, hs_ndvi)
-                cv2.imwrite(save_path + msavi_ref, hs_msavi)
-                cv2.imwrite(save_path + custom2_ref, hs_custom2)
-                cv2.imwrite(save_path + artificial_ref, hs_artificial)
-                cv2.imwrite(save_path + rgb_ref, hs_rgb)
-
-                # Update object with refereances and materials
-                filtered_objects[i].set_hs_classification_ref(hsi_ref)
-                filtered_objects[i].set_hs_ndvi_ref(ndvi_ref)
-                filtered_objects[i].set_hs_msavi_ref(msavi_ref)
-                filtered_objects[i].set_hs_custom2_ref(custom2_ref)
-                filtered_objects[i].set_hs_artificial_ref(artificial_ref)
-                filtered_objects[i].set_hs_rgb_ref(rgb_ref)
-                filtered_objects[i].set_hs_materials(hs_materials)
-
-        # Update JSON with hyperspectral data
-        updateJSON_HS(
-            filtered_objects,
-            lat,
-            lon,
-            activeFile,
+    # uid = str(lon) + str(lat)
+    t = time.strftime("%Y%m%d_%H%M%S")
+    uid = f"{lat},{lon}-{t}"
+
+    # Stitch and update the UI while PiB performs the hyperspectral scans
+    setStatusMessage("stitching images")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        stitching = executor.submit(
+            stitch_and_update_ui, frames, uid, lat, lon, filtered_objects, activeFile
         )
 
+        # If manual hs scan checked
+        if manual_hs:
+            # Perform singular 360 hs scan
+            logging.debug("Recieving manual hyperspectral scan results")
+            setStatusMessage("Performing manual 360 hyperspectral scan")
+            with stage("Manual hyperspectral scan"):
+                images, hs_materials = receive_hs_results(conn)
+
+            # Save results to images in ui
+            refs = save_hs_results(images, uid, -1, activeFile)
+
+            # Pin must exist before it can be updated
+            stitching.result()
+
+            # Update JSON with hyperspectral data
+            updateJSON_HS(
+                filtered_objects,
+                lat,
+                lon,
+                activeFile,
+                refs["classification"],
+                refs["ndvi"],
+                refs["msavi"],
+                refs["custom2"],
+                refs["artificial"],
+                hs_materials,
+                refs["rgb"],
+            )
+        else:
+            # Receive processed hyperspectral data from PiB for each object, as each scan finishes
+            for i in range(len(filtered_objects)):
+                if classes[filtered_objects[i].label]:
+                    setStatusMessage(
+                        f"hyperspectral scanning {filtered_objects[i].label}"
+                    )
+                    logging.debug(f"hyperspectral scanning {filtered_objects[i].label}")
+
+                    # Receive scan information
+                    logging.debug(f"Receiving scan data")
+                    with stage(f"Hyperspectral scan of object {filtered_objects[i].id}"):
+                        images, hs_materials = receive_hs_results(conn)
+                    logging.debug("Received scan data")
+
+                    # Save results to images in ui
+                    refs = save_hs_results(
+                        images, uid, filtered_objects[i].id, activeFile
+                    )
+
+                    # Update object with refereances and materials
+                    filtered_objects[i].set_hs_classification_ref(refs["classification"])
+                    filtered_objects[i].set_hs_ndvi_ref(refs["ndvi"])
+                    filtered_objects[i].set_hs_msavi_ref(refs["msavi"])
+                    filtered_objects[i].set_hs_custom2_ref(refs["custom2"])
+                    filtered_objects[i].set_hs_artificial_ref(refs["artificial"])
+                    filtered_objects[i].set_hs_rgb_ref(refs["rgb"])
+                    filtered_objects[i].set_hs_materials(hs_materials)
+
+                    # Show each result as it arrives once the pin is in the UI
+                    if stitching.done():
+                        updateJSON_HS(filtered_objects, lat, lon, activeFile)
+
+            stitching.result()
+
+            # Update JSON with hyperspectral data
+            updateJSON_HS(
+                filtered_objects,
+                lat,
+                lon,
+                activeFile,
+            )
+
+
+def stitch_and_update_ui(frames, uid, lat, lon, filtered_objects, activeFile):
+    """Stitches {frames} and adds the panorama and objects to the UI JSON.
+    A low resolution preview is shown first, and replaced once the full panorama is stitched"""
+    if UI_PREVIEW_PANORAMA:
+        with stage("Preview stitching"):
+            preview = stitchPreview(frames)
+            updateJSON(
+                uid,
+                lat,
+                lon,
+                filtered_objects,
+                preview,
+                activeFile,
+                preview=True,
+                objects_shape=getPanoramaShape(frames[0].shape),
+            )
+        setStatusMessage("stitching full resolution panorama")
+
+    with stage("Stitching"):
+        panorama = stitchImages(frames)
+
+    # Updates json and moves images to correct folder
+    with stage("Updating UI"):
+        updateJSON(uid, lat, lon, filtered_objects, panorama, activeFile)
+    setStatusMessage("updated ui")
+
+    # Tiles are only for viewing, so are built off the scan's critical path
+    if UI_PANORAMA_TILES:
+        tile_worker.submit(publish_panorama_tiles, panorama, uid, activeFile)
+
+
+def publish_panorama_tiles(panorama, uid, activeFile):
+    """Writes the thumbnail and tile pyramid of {panorama} to the UI images, and adds them to its pin"""
+    save_path = UI_IMAGES_SAVE_PATH + activeFile[:-5]
+    thumbnail_ref = f"/img{uid}_thumb.jpg"
+    tiles_ref = f"/img{uid}_tiles"
+
+    try:
+        with stage(f"Building panorama tiles of {uid}"):
+            saveThumbnail(panorama, save_path + thumbnail_ref)
+            multires = buildTilePyramid(panorama, save_path + tiles_ref)
+        updateJSON_tiles(uid, activeFile, thumbnail_ref, tiles_ref, multires)
+    except Exception:
+        logging.exception(f"Failed to build panorama tiles of {uid}")
+
+
+HS_RESULT_NAMES = ["classification", "ndvi", "msavi", "custom2", "artificial", "rgb"]
+
+
+def save_hs_results(images, uid, id, activeFile):
+    """Writes the hyperspectral result {images} of object {id} to the UI images.
+    Returns the UI reference of each image, keyed by name"""
+    save_path = UI_IMAGES_SAVE_PATH + activeFile[:-5]
+    refs = {}
+
+    logging.debug(f"Writing images to {save_path}")
+    with stage(f"Writing hyperspectral images of object {id}"):
+        for name, image in zip(HS_RESULT_NAMES, images):
+            refs[name] = f"/hs_{uid}_{id}_{name}.jpg"
+            cv2.imwrite(save_path + refs[name], image)
+
+    return refs
+
+
+@contextmanager
+def stage(name):
+    """Logs the wall clock time taken by a stage of a scan"""
+    t0 = perf_counter()
+    try:
+        yield
+    finally:
+        logging.info(f"{name} took {perf_counter() - t0:.2f}s")
+
 
 # ----- GLOBAL VARIABLES ----- #
 
@@ -223,10 +321,21 @@ FOV = (102, 67)
 PRIVACY = True  # Blur people
 CLASSES = ["person"]
 OD_THRESHOLD = 0.1
+OD_BACKEND = "ultralytics"  # "ultralytics", "onnx" or "openvino"
+OD_INT8 = False  # Int8 quantise the exported detector
+# Detect in overlapping tiles of each frame, finding smaller objects at the cost of a model run per tile
+OD_TILED = False
+OD_TILE_SIZE = 1280  # Pixels, grown if more than OD_MAX_TILES tiles would be needed
+OD_TILE_OVERLAP = 0.2  # Fraction of each tile shared with its neighbours
+OD_MAX_TILES = 16
+NMS_METHOD = "numpy"  # "numpy", "cv2" or "soft" to decay overlapping objects' scores
 last_objects = []
 
 # UI
 UI_IMAGES_SAVE_PATH = "./user-interface/public/images/"
+UI_PANORAMA_TILES = True  # Also publish a thumbnail and tile pyramid of each panorama
+UI_PREVIEW_PANORAMA = True  # Show a low resolution panorama before the full panorama is stitched
+tile_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tiles")
 
 # GPS
 GPS_PORT = "/dev/ttyACM0"
@@ -277,6 +386,10 @@ if __name__ == "__main__":
         rgb_model = YOLOWorld("object_detection/yolo_models/yolov8s-worldv2.pt")
         logging.debug("Loaded RGB object detection model.")
 
+        # Load stitching maps, built and cached on first run
+        loadStitchingMaps((RESOLUTION[1], RESOLUTION[0]))
+        logging.debug("Loaded panorama stitching maps.")
+
         logging.info("All systems setup.")
         logging.info(f"Privacy set {PRIVACY}.")
         logging.info(f"Waiting for trigger from UI...")
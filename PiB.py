@@ -1,4 +1,6 @@
 from object_detection.object_detection import *
+from object_detection.class_embeddings import set_classes
+from object_detection.detector_backends import get_detector
 from comms.comms import *
 from cameras import *
 from time import sleep
@@ -6,11 +8,14 @@ import logging
 from hyperspectral.zaber_driver import *
 from hyperspectral.hyperspectral_driver import *
 from hyperspectral.classification import *
+from hyperspectral.model_registry import load_model, get_model, set_default_backend
+from hyperspectral.indices import IndexEngine
+from hyperspectral.streaming import StreamingClassifier
 import time
 import traceback
 
 
-def on_trigger(rgb_model, axis, hs_cam, cal_arr):
+def on_trigger(rgb_model, axis, hs_cam, calibration):
     # Capture images
     frames = capture(cams, "PiB")
 
@@ -22,15 +27,42 @@ def on_trigger(rgb_model, axis, hs_cam, cal_arr):
     classes = receive_object_detection_results(client_socket)[0]
     classes_list = list(classes.keys())
     if classes_list != []:
-        rgb_model.set_classes(classes_list)
+        set_classes(rgb_model, classes_list)
+
+    # Exported detectors are made for the shape detected in. When tiled, the whole frame pass
+    # fits in the tiles' export at the same scale as in its own
+    detect_shape = (RESOLUTION[1], RESOLUTION[0])
+    if OD_TILED:
+        detect_shape = tile_shape(
+            detect_shape, OD_TILE_SIZE, OD_TILE_OVERLAP, OD_MAX_TILES
+        )
+
+    # Detect with the classes set, which are kept from the last scan if none were sent
+    detector = get_detector(
+        rgb_model, rgb_model.model.names, OD_BACKEND, OD_INT8, detect_shape
+    )
 
     logging.debug("Successfully received object detection classes from PiA")
     logging.info(f"Set RGB object detection classes to {classes_list}.")
 
-    # Perform object detection
-    objects = []
-    for i, f in enumerate(frames):
-        objects.append(object_detection(rgb_model, f, i + 2, OD_THRESHOLD))
+    # Perform object detection, on all frames at once unless tiled
+    if OD_TILED:
+        objects = [
+            object_detection_tiled(
+                detector,
+                f,
+                i + 2,
+                OD_THRESHOLD,
+                OD_TILE_SIZE,
+                OD_TILE_OVERLAP,
+                OD_MAX_TILES,
+            )
+            for i, f in enumerate(frames)
+        ]
+    else:
+        objects = object_detection_batch(
+            detector, frames, range(2, len(frames) + 2), OD_THRESHOLD
+        )
 
     # Send images to PiA
     logging.debug("Sending RGB image frames to PiA")
@@ -57,13 +89,14 @@ def on_trigger(rgb_model, axis, hs_cam, cal_arr):
         if ENABLE_HS:
             logging.debug("Performing manual hyperspectral scan")
             mats, hs_classification, hs_ndvi, hs_msavi, hs_custom2, hs_artificial, hs_rgb = on_rotate(
-                axis, (-110, 110), hs_cam, cal_arr, -1, True
+                axis, (-110, 110), hs_cam, calibration, -1, True
             )
             logging.debug("Sending manual hyperspectral scan results to PiA")
-            send_image_arrays(
-                client_socket, [hs_classification, hs_ndvi, hs_msavi, hs_custom2, hs_artificial, hs_rgb]
+            send_hs_results(
+                client_socket,
+                [hs_classification, hs_ndvi, hs_msavi, hs_custom2, hs_artificial, hs_rgb],
+                mats,
             )
-            send_object_detection_results(client_socket, [mats])
             logging.debug("Successfully sent manual hyperspectral scan results to PiA")
     else:
         # Scan individual objects
@@ -94,16 +127,17 @@ def on_trigger(rgb_model, axis, hs_cam, cal_arr):
                         f"Scanning Object {i}, ID: {id}, X pixel coords: {px_1},{px_2} => X angle: {angle_x1},{angle_x2}"
                     )
                     mats, hs_classification, hs_ndvi, hs_msavi, hs_custom2, hs_artificial, hs_rgb = on_rotate(
-                        axis, (angle_x1, angle_x2), hs_cam, cal_arr, id, False
+                        axis, (angle_x1, angle_x2), hs_cam, calibration, id, False
                     )
                     logging.debug("Sending scan results to PiA")
-                    send_image_arrays(
-                        client_socket, [hs_classification, hs_ndvi, hs_msavi, hs_custom2, hs_artificial, hs_rgb]
+                    send_hs_results(
+                        client_socket,
+                        [hs_classification, hs_ndvi, hs_msavi, hs_custom2, hs_artificial, hs_rgb],
+                        mats,
                     )
-                    send_object_detection_results(client_socket, [mats])
 
 
-def on_rotate(axis, angles, hs_cam, cal_arr, id, manual_hs=False):
+def on_rotate(axis, angles, hs_cam, calibration, id, manual_hs=False):
 
     # Grab hyperspectral data
     fps = hs_cam.ResultingFrameRateAbs.Value
@@ -126,9 +160,26 @@ def on_rotate(axis, angles, hs_cam, cal_arr, id, manual_hs=False):
     speed = get_rotation_speed(nframes, fps, diff)
     logging.info("Grabbing hyperspectral scan...")
     rotate_safe(axis, angles[1], ROTATION_OFFSET, speed, blocking=False)
-    scene = grab_hyperspectral_scene(
-        hs_cam, nframes, None, None, "test", calibrate=False
+    grabber = HyperspectralGrabber(hs_cam, nframes).start()
+
+    # Classify blocks of frames as they arrive, while the stage is still rotating
+    if HS_STREAMING:
+        streamer = StreamingClassifier(
+            grabber,
+            get_model(MODEL_PATH, HS_INFERENCE_BACKEND),
+            IndexEngine(calibration, HS_PIXEL_BINNING),
+            block_frames=HS_STREAM_BLOCK_FRAMES,
+        ).start()
+    scene = grabber.join()
+
+    # Rotation speed assumes every frame arrives at the camera's frame rate
+    grabbed_fps = grabber.effective_fps()
+    logging.debug(
+        f"Grabbed {grabber.frames_grabbed} frames at {grabbed_fps:.1f} fps "
+        f"(expected {fps:.1f}), {grabber.frames_dropped} dropped, {grabber.failed_grabs} failed"
     )
+    if grabber.frames_dropped or grabber.failed_grabs:
+        logging.warning("Hyperspectral frames lost, scan will be compressed in rotation")
 
     # Save scene as .npy if debugging
     if ENABLE_DEBUG:
@@ -147,30 +198,40 @@ def on_rotate(axis, angles, hs_cam, cal_arr, id, manual_hs=False):
         np.save(path, scene)
         logging.debug(f"Saved raw hyperspectral scene to {path}")
 
-    # Save RGB image
-    logging.debug("Saving HS RGB image")
-    RGB = (
-        get_wavelength_index(cal_arr, 690, 2),
-        get_wavelength_index(cal_arr, 535, 2),
-        get_wavelength_index(cal_arr, 470, 2),
-    )
-
-    rgb_image = scene[:, :, RGB]
-    plt.imsave(HSI_SCANS_PATH + f"hs_{id}_rgb.png", rgb_image)
+    # RGB image from the hyperspectral bands, in BGR order for the comms layer
+    RGB = calibration.indices((690, 535, 470), HS_PIXEL_BINNING)
+    hs_rgb = scene[:, :, RGB[::-1]]
 
     output_path = HSI_SCANS_PATH + f"hs_{id}.png"
-    mats = classify_and_save(
-        MODEL_PATH, scene, LABEL_ENCODING_PATH, output_path, cal_arr, manual_flag = manual_hs
-    )
+    if HS_STREAMING:
+        # Only smoothing and rendering are left once grabbing finishes
+        classified_image, indices = streamer.finish()
+        mats, hs_images = render_and_save(
+            classified_image,
+            indices,
+            LABEL_ENCODING_PATH,
+            output_path,
+            manual_flag=manual_hs,
+            save_png=ENABLE_DEBUG,
+        )
+    else:
+        mats, hs_images = classify_and_save(
+            MODEL_PATH,
+            scene,
+            LABEL_ENCODING_PATH,
+            output_path,
+            calibration,
+            manual_flag=manual_hs,
+            save_png=ENABLE_DEBUG,
+        )
+    if ENABLE_DEBUG:
+        save_debug_png(hs_rgb, HSI_SCANS_PATH + f"hs_{id}_rgb.png")
 
-    # Open plots as arrays
-    logging.debug("Reading HS image results")
-    hs_rgb = cv2.imread(HSI_SCANS_PATH + f"hs_{id}_rgb.png")
-    hs_classification = cv2.imread(HSI_SCANS_PATH + f"hs_{id}_classification.png")
-    hs_ndvi = cv2.imread(HSI_SCANS_PATH + f"hs_{id}_ndvi.png")
-    hs_msavi = cv2.imread(HSI_SCANS_PATH + f"hs_{id}_msavi.png")
-    hs_custom2 = cv2.imread(HSI_SCANS_PATH + f"hs_{id}_custom2.png")
-    hs_artificial = cv2.imread(HSI_SCANS_PATH + f"hs_{id}_artificial.png")
+    hs_classification = hs_images["classification"]
+    hs_ndvi = hs_images["ndvi"]
+    hs_msavi = hs_images["msavi"]
+    hs_custom2 = hs_images["custom2"]
+    hs_artificial = hs_images["artificial"]
 
     return mats, hs_classification, hs_ndvi, hs_msavi, hs_custom2, hs_artificial, hs_rgb
 
@@ -188,9 +249,17 @@ FOV = (102, 67)
 # OBJECT DETECTION
 CLASSES = ["person"]
 OD_THRESHOLD = 0.1
+OD_BACKEND = "ultralytics"  # "ultralytics", "onnx" or "openvino"
+OD_INT8 = False  # Int8 quantise the exported detector
+# Detect in overlapping tiles of each frame, finding smaller objects at the cost of a model run per tile
+OD_TILED = False
+OD_TILE_SIZE = 1280  # Pixels, grown if more than OD_MAX_TILES tiles would be needed
+OD_TILE_OVERLAP = 0.2  # Fraction of each tile shared with its neighbours
+OD_MAX_TILES = 16
 
 # HYPERSPECTRAL
 MODEL_PATH = "./hyperspectral/NN_18_03_2025.keras"
+HS_INFERENCE_BACKEND = "numpy"  # "numpy" or "keras"
 LABEL_ENCODING_PATH = "./hyperspectral/label_encoding.npy"
 CALIBRATION_FILE_PATH = "./hyperspectral/calibration/BaslerPIA1600_CalibrationA.txt"
 HSI_SCANS_PATH = "./hsi_scans/"
@@ -198,6 +267,8 @@ HS_EXPOSURE_TIME = 10000
 HS_PIXEL_BINNING = 2
 HS_GAIN = 200
 HS_MIN_CAPTURE_ANGLE = 27
+HS_STREAMING = True  # Classify while grabbing rather than after
+HS_STREAM_BLOCK_FRAMES = 64
 
 ROTATIONAL_STAGE_PORT = "/dev/ttyUSB0"
 ROTATION_OFFSET = -8
@@ -248,7 +319,13 @@ if __name__ == "__main__":
             hs_cam = None
 
         # Get Hyperspectral Calibration
-        cal_arr = get_calibration_array(CALIBRATION_FILE_PATH)
+        calibration = SpectralCalibration.from_file(CALIBRATION_FILE_PATH)
+
+        # Load hyperspectral classification model once, reused for every scan.
+        # Models loaded later, such as after the file changes, use the same backend
+        set_default_backend(HS_INFERENCE_BACKEND)
+        load_model(MODEL_PATH)
+        logging.debug("Loaded hyperspectral classification model.")
 
         # Make connection with PiA
         client_socket = make_client_connection(IP, PORT)
@@ -257,7 +334,7 @@ if __name__ == "__main__":
         # Setup object detection modelx
         rgb_model = YOLOWorld("object_detection/yolo_models/yolov8s-worldv2.pt")
         logging.debug("Loaded RGB object detection model.")
-        rgb_model.set_classes(CLASSES)
+        set_classes(rgb_model, CLASSES)
         logging.info(f"Set YOLO classes provisionally to {CLASSES}.")
 
         # Perform final setup rotation
@@ -269,7 +346,7 @@ if __name__ == "__main__":
         while True:
             if receive_capture_request(client_socket) == 1:
                 logging.info("Triggered Capture.")
-                on_trigger(rgb_model, axis, hs_cam, cal_arr)
+                on_trigger(rgb_model, axis, hs_cam, calibration)
                 rotate_safe(axis, 170, ROTATION_OFFSET, ROTATION_SPEED, blocking=True)
                 capture_triggered = True
             sleep(1)
@@ -1,6 +1,21 @@
+# Captures calibration images, and calibrates the transforms between neighbouring cameras for stitching.
+#   python calibrate_stitching.py --capture                     capture an image from each local camera
+#   python calibrate_stitching.py --images f0.jpg f1.jpg ...    calibrate from one image per camera, in camera order
+#   python calibrate_stitching.py --debug-dir ./debug_PiA       calibrate from the latest frames saved by PiA
+# Calibration is headless and writes stitching/calibration/transforms.json, which PiA loads at startup.
 import os
+import re
+import argparse
+import logging
 import subprocess
 from datetime import datetime
+from time import perf_counter
+import cv2
+from stitching.calibrate import calibrateTransforms, saveTransforms
+from stitching.stitching_main import TRANSFORMS_PATH
+
+NUM_CAMERAS = 4
+
 
 def capture_image(camera_id, save_dir):
     """Captures an image using libcamera-still for a specific camera ID."""
@@ -21,13 +36,67 @@ def capture_image(camera_id, save_dir):
     except subprocess.CalledProcessError as e:
         print(f"Error capturing image from camera {camera_id}: {e}")
 
+
+def latest_debug_frames(debug_dir, num_cameras=NUM_CAMERAS):
+    """Returns the paths of the latest set of frames saved by PiA in {debug_dir}, frame_{n}_{camera}.jpg"""
+    frames = {}
+    for f in os.listdir(debug_dir):
+        match = re.fullmatch(r"frame_(\d+)_(\d+)\.jpg", f)
+        if match:
+            frames[int(match.group(1))] = (int(match.group(2)), f)
+
+    # Frames are numbered consecutively, so the latest set is the last frame of camera 0 onwards
+    starts = [n for n, (camera, _) in frames.items() if camera == 0]
+    for start in sorted(starts, reverse=True):
+        group = [frames.get(start + i) for i in range(num_cameras)]
+        if all(g is not None and g[0] == i for i, g in enumerate(group)):
+            return [os.path.join(debug_dir, g[1]) for g in group]
+    raise FileNotFoundError(f"No complete set of {num_cameras} frames in {debug_dir}")
+
+
+def calibrate(paths, output=TRANSFORMS_PATH, translation_only=True):
+    """Calibrates the stitching transforms from the images at {paths}, in camera order, and saves them to {output}"""
+    images = [cv2.imread(p) for p in paths]
+    for p, image in zip(paths, images):
+        if image is None:
+            raise FileNotFoundError(f"Could not read {p}")
+
+    t0 = perf_counter()
+    transforms, report = calibrateTransforms(images, translation_only=translation_only)
+    print(f"Calibrated in {perf_counter() - t0:.2f}s")
+    for pair in report:
+        print(f"Cameras {pair['cameras']}: {pair['matches']} matches, {pair['inliers']} inliers")
+    for i, matrix in enumerate(transforms):
+        print(f"H{i + 1} = {matrix.tolist()}")
+
+    saveTransforms(output, transforms, images[0].shape, report)
+    print(f"Saved to {output}")
+
+
 def main():
-    save_dir = "./calibrate_stitching_image"  # Change this to your desired directory
-    os.makedirs(save_dir, exist_ok=True)
-    
-    # Capture from both cameras (0 and 1 assumed)
-    capture_image(0, save_dir)
-    capture_image(1, save_dir)
+    parser = argparse.ArgumentParser(description="Calibrate the stitching transforms")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--capture", action="store_true", help="capture an image from each local camera")
+    source.add_argument("--images", nargs=NUM_CAMERAS, help="one image per camera, in camera order")
+    source.add_argument("--debug-dir", help="calibrate from the latest frames saved by PiA here")
+    parser.add_argument("--output", default=TRANSFORMS_PATH, help="calibration file to write")
+    parser.add_argument("--affine", action="store_true", help="estimate full affine transforms, not translations")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    if args.capture:
+        save_dir = "./calibrate_stitching_image"  # Change this to your desired directory
+        os.makedirs(save_dir, exist_ok=True)
+
+        # Capture from both cameras (0 and 1 assumed)
+        capture_image(0, save_dir)
+        capture_image(1, save_dir)
+        return
+
+    paths = args.images or latest_debug_frames(args.debug_dir)
+    calibrate(paths, args.output, translation_only=not args.affine)
+
 
 if __name__ == "__main__":
     main()
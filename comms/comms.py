@@ -2,9 +2,9 @@ import os
 import socket
 from os import listdir
 from time import sleep
-import pickle
 import logging
 import cv2
+from comms import protocol
 
 
 def make_client_connection(ip, port):
@@ -108,49 +108,27 @@ def send_images(client_socket, folder_path):
 
 def send_image_arrays(client_socket, frames):
     """Takes in an array of frames and sends them over socekt"""
-    # Send number of frames to expect
     logging.debug(f"Sending {len(frames)} frames.")
-    client_socket.send(len(frames).to_bytes(8, byteorder="big"))
-    # Send all images
-    for img in frames:
-        img = cv2.imencode(".jpg", img)[1]  # Compress image
-        data = pickle.dumps(img)
-        logging.debug(f"Sending frame of size {len(data)}")
-        client_socket.send(len(data).to_bytes(8, byteorder="big"))
-        client_socket.sendall(data)
-        logging.debug(f"Frame sent.")
+    parts = protocol.encode_images(frames)
+    protocol.send_message(client_socket, protocol.MSG_IMAGES, len(frames), parts)
+    logging.debug(f"Frames sent.")
 
 
 def receive_object_detection_results(client_socket):
-    # Get number of objects
-    num_objects = client_socket.recv(8)
-    if not num_objects:
+    """Receives the Objects, grouped as they were sent, or the values sent with send_object_detection_results"""
+    message = protocol.receive_message(client_socket)
+    if message is None:
         return []
-    num_objects = int.from_bytes(num_objects, byteorder="big")
-    logging.debug(f"Receiving {num_objects} objects.")
-
-    objects = []
-    if num_objects:
-        for i in range(num_objects):
-            logging.debug(f"Receiving object object detection data {i}.")
-
-            data_size = client_socket.recv(8)  # First 8 bytes for size
-            if not data_size:
-                break
-            data_size = int.from_bytes(data_size, byteorder="big")
-            logging.debug(f"Receiving object detection data {i} of size {data_size}.")
-            data = b""
-            while len(data) < data_size:
-                packet = client_socket.recv(min(4096, data_size - len(data)))
-                if not packet:
-                    logging.error(f"Packet lost.")
-                    break
-                data += packet
-            logging.debug(f"Object detection data received.")
-
-            obj = pickle.loads(data)
-            objects.append(obj)
+    msg_type, count, payload = protocol.expect(
+        message, (protocol.MSG_DETECTIONS, protocol.MSG_VALUES)
+    )
+    logging.debug(f"Receiving {count} objects.")
 
+    if msg_type == protocol.MSG_DETECTIONS:
+        objects = protocol.decode_detections(count, payload)
+    else:
+        objects = protocol.decode_values(count, payload)
+    logging.debug(f"Object detection data received.")
     return objects
 
 
@@ -267,53 +245,46 @@ def receive_images(conn, save_location):
 
 
 def receive_image_arrays(conn):
-    # Get number of images
-    num_images = conn.recv(8)
-    if not num_images:
+    message = protocol.receive_message(conn)
+    if message is None:
         return []
-    num_images = int.from_bytes(num_images, byteorder="big")
-    logging.debug(f"Receiving {num_images} frames.")
-
-    frames = []
-    if num_images:
-        for i in range(num_images):
-            logging.debug(f"Receiving frame {i}.")
-
-            data_size = conn.recv(8)  # First 8 bytes for size
-            if not data_size:
-                break
-            data_size = int.from_bytes(data_size, byteorder="big")
-            logging.debug(f"Receiving frame {i} of size {data_size}.")
-            data = b""
-            while len(data) < data_size:
-                packet = conn.recv(min(4096, data_size - len(data)))
-                if not packet:
-                    logging.error(f"Packet lost.")
-                    break
-                data += packet
-            logging.debug(f"Frame received.")
-
-            img = pickle.loads(data)
-            img = cv2.imdecode(img, cv2.IMREAD_COLOR)
-            frames.append(img)
-
+    _, count, payload = protocol.expect(message, (protocol.MSG_IMAGES,))
+    logging.debug(f"Receiving {count} frames of {len(payload)} bytes.")
+    frames = protocol.decode_images(count, payload)
+    logging.debug(f"Frames received.")
     return frames
 
 
 def send_object_detection_results(client_socket, objects):
-    """Send object detection results to PiB over socket"""
-    try:
-        # Send number of objects
-        client_socket.send(len(objects).to_bytes(8, byteorder="big"))
-        # Send all objects
-        for obj in objects:
-            # Serialise the data
-            data = pickle.dumps(obj)
-            logging.debug(f"Sending array data of size {len(data)}")
-            client_socket.send(len(data).to_bytes(8, byteorder="big"))
-            client_socket.sendall(data)
-            logging.debug(f"Data sent.")
-
-    except Exception as e:
-        print(f"Error: {e}")
-
+    """Send object detection results to PiB over socket.
+    {objects} is a list of Objects, a list of lists of Objects such as the objects of each camera,
+    or a list of JSON serialisable values such as the class list or a flag"""
+    if protocol.is_detections(objects):
+        msg_type = protocol.MSG_DETECTIONS
+        count, parts = protocol.encode_detections(objects)
+    else:
+        msg_type, count = protocol.MSG_VALUES, len(objects)
+        parts = protocol.encode_values(objects)
+    protocol.send_message(client_socket, msg_type, count, parts)
+    logging.debug(f"Sent {len(objects)} objects.")
+
+
+def send_hs_results(client_socket, images, materials):
+    """Sends the rendered hyperspectral {images} and the class percentages {materials} of one scan"""
+    send_image_arrays(client_socket, images)
+    protocol.send_message(
+        client_socket,
+        protocol.MSG_MATERIALS,
+        len(materials),
+        protocol.encode_materials(materials),
+    )
+
+
+def receive_hs_results(conn):
+    """Receives the images and material percentages sent with send_hs_results"""
+    images = receive_image_arrays(conn)
+    message = protocol.receive_message(conn)
+    if message is None:
+        return images, {}
+    _, count, payload = protocol.expect(message, (protocol.MSG_MATERIALS,))
+    return images, protocol.decode_materials(count, payload)
@@ -0,0 +1,400 @@
+# Framed binary protocol between PiA and PiB.
+# Every message is a fixed header followed by a payload of a known length:
+#   magic (4s) | version (B) | message type (B) | item count (I) | payload length (Q)
+# Payloads are read with recv_into a buffer kept per socket, so no message is built up packet by packet.
+import json
+import struct
+import socket
+import logging
+import weakref
+import numpy as np
+import cv2
+from object_detection.object_detection import Object
+
+MAGIC = b"MSPF"
+VERSION = 2
+HEADER = struct.Struct("!4sBBIQ")
+
+# Message types
+MSG_IMAGES = 1  # count JPEG images, each prefixed by its length (Q)
+MSG_DETECTIONS = 2  # count groups of detection records, see encode_detections
+MSG_VALUES = 3  # JSON list of count values
+MSG_MATERIALS = 4  # count material records, hyperspectral class percentages
+
+IMAGE_LENGTH = struct.Struct("!Q")
+
+# id, camera, hs_scan, conf, distance, coords, coords_original, label length, extras length.
+# None is sent as -1 for integers and NaN for floats
+DETECTION = struct.Struct("!ib?dd4d4dHI")
+DETECTION_FIELDS = {
+    "id",
+    "camera",
+    "hs_scan",
+    "conf",
+    "distance",
+    "coords",
+    "coords_original",
+    "label",
+}
+
+# Whether the detections are grouped per camera, then the number of records in each of the count groups
+DETECTION_GROUPED = struct.Struct("!?")
+DETECTION_GROUP = struct.Struct("!I")
+
+# percentage, name length
+MATERIAL = struct.Struct("!dH")
+
+# Receive buffer for each socket, grown as needed
+_buffers = weakref.WeakKeyDictionary()
+INITIAL_BUFFER_SIZE = 1 << 20
+SMALL_MESSAGE_SIZE = 1 << 16
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def _recv_exact(sock, n):
+    """Reads exactly {n} bytes from {sock}. Returns a memoryview of the socket's receive buffer,
+    only valid until the next read from the same socket"""
+    buffer = _buffers.get(sock)
+    if buffer is None or len(buffer) < n:
+        size = INITIAL_BUFFER_SIZE
+        while size < n:
+            size *= 2
+        buffer = bytearray(size)
+        _buffers[sock] = buffer
+
+    view = memoryview(buffer)[:n]
+    received = 0
+    while received < n:
+        r = sock.recv_into(view[received:], n - received)
+        if r == 0:
+            raise ConnectionError(f"Connection closed after {received} of {n} bytes")
+        received += r
+    return view
+
+
+def send_message(sock, msg_type, count, parts):
+    """Sends a message of {msg_type} made of the bytes-like {parts}"""
+    payload_len = sum(memoryview(p).nbytes for p in parts)
+    header = HEADER.pack(MAGIC, VERSION, msg_type, count, payload_len)
+
+    # Small messages are joined into one send, large payloads are sent without copying
+    if payload_len <= SMALL_MESSAGE_SIZE:
+        sock.sendall(b"".join([header, *parts]))
+    else:
+        sock.sendall(header)
+        for part in parts:
+            sock.sendall(part)
+
+
+def receive_message(sock):
+    """
+    Reads one message from {sock}. Returns (message type, count, payload) where payload is a
+    memoryview only valid until the next read from {sock}, or None if the connection was closed
+    """
+    try:
+        header = _recv_exact(sock, HEADER.size)
+    except ConnectionError:
+        return None
+
+    magic, version, msg_type, count, payload_len = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError(f"Bad magic {bytes(magic)}, stream out of sync")
+    if version != VERSION:
+        raise ProtocolError(f"Protocol version {version} received, expected {VERSION}")
+
+    payload = _recv_exact(sock, payload_len)
+    return msg_type, count, payload
+
+
+def expect(message, msg_types):
+    msg_type, count, payload = message
+    if msg_type not in msg_types:
+        raise ProtocolError(f"Expected message type {msg_types}, received {msg_type}")
+    return msg_type, count, payload
+
+
+def _json_default(value):
+    """Converts numpy values for JSON"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value)} is not JSON serialisable")
+
+
+### Images ###
+def encode_images(frames):
+    parts = []
+    for img in frames:
+        data = cv2.imencode(".jpg", img)[1]  # Compress image
+        parts.append(IMAGE_LENGTH.pack(data.nbytes))
+        parts.append(data)
+    return parts
+
+
+def decode_images(count, payload):
+    frames = []
+    offset = 0
+    for _ in range(count):
+        (length,) = IMAGE_LENGTH.unpack_from(payload, offset)
+        offset += IMAGE_LENGTH.size
+        data = np.frombuffer(payload[offset : offset + length], dtype=np.uint8)
+        frames.append(cv2.imdecode(data, cv2.IMREAD_COLOR))
+        offset += length
+    return frames
+
+
+### Detections ###
+def _none_to(value, default):
+    return default if value is None else value
+
+
+def _coords_to_record(coords):
+    if coords is None:
+        return (float("nan"),) * 4
+    return tuple(float(c) for c in coords)
+
+
+def _coords_from_record(values):
+    if any(v != v for v in values):  # NaN
+        return None
+    if all(float(v).is_integer() for v in values):
+        return [int(v) for v in values]
+    return list(values)
+
+
+def is_detections(objects):
+    """Whether {objects} is a list of Objects, or a list of lists of Objects such as the objects of each camera"""
+    return all(isinstance(obj, Object) for obj in objects) or all(
+        isinstance(group, list) and all(isinstance(obj, Object) for obj in group)
+        for group in objects
+    )
+
+
+def encode_detections(objects):
+    """Encodes a list of Objects, or a list of lists of Objects which is decoded with the same grouping.
+    Returns the message count, the number of groups, and the parts of the payload"""
+    grouped = bool(objects) and not isinstance(objects[0], Object)
+    groups = objects if grouped else [objects]
+
+    parts = [DETECTION_GROUPED.pack(grouped)]
+    parts += [DETECTION_GROUP.pack(len(group)) for group in groups]
+    for obj in (obj for group in groups for obj in group):
+        label = str(_none_to(obj.label, "")).encode()
+        # Remaining attributes, such as hyperspectral results. Unset (None) attributes are left to the constructor
+        extras = {
+            k: v
+            for k, v in vars(obj).items()
+            if k not in DETECTION_FIELDS and v is not None
+        }
+        extras = json.dumps(extras, default=_json_default).encode() if extras else b""
+
+        parts.append(
+            DETECTION.pack(
+                _none_to(obj.id, -1),
+                _none_to(obj.camera, -1),
+                bool(obj.hs_scan),
+                _none_to(obj.conf, float("nan")),
+                _none_to(obj.distance, float("nan")),
+                *_coords_to_record(obj.coords),
+                *_coords_to_record(obj.coords_original),
+                len(label),
+                len(extras),
+            )
+        )
+        parts.append(label)
+        parts.append(extras)
+    return len(groups), parts
+
+
+def _decode_detection(payload, offset):
+    """Decodes the detection record at {offset} of {payload}. Returns the Object and the offset after it"""
+    values = DETECTION.unpack_from(payload, offset)
+    offset += DETECTION.size
+    id, camera, hs_scan, conf, distance = values[:5]
+    coords, coords_original = values[5:9], values[9:13]
+    label_len, extras_len = values[13:]
+
+    label = bytes(payload[offset : offset + label_len]).decode()
+    offset += label_len
+    extras = (
+        json.loads(bytes(payload[offset : offset + extras_len])) if extras_len else {}
+    )
+    offset += extras_len
+
+    obj = Object(
+        id=None if id == -1 else id,
+        label=label,
+        coords=_coords_from_record(coords),
+        conf=None if conf != conf else conf,
+        camera=None if camera == -1 else camera,
+        distance=None if distance != distance else distance,
+        hs_scan=hs_scan,
+    )
+    obj.coords_original = _coords_from_record(coords_original)
+    vars(obj).update(extras)
+    return obj, offset
+
+
+def decode_detections(count, payload):
+    """Decodes the {count} groups of detections of encode_detections, a list of Objects or of lists of Objects"""
+    (grouped,) = DETECTION_GROUPED.unpack_from(payload, 0)
+    offset = DETECTION_GROUPED.size
+    lengths = []
+    for _ in range(count):
+        lengths += DETECTION_GROUP.unpack_from(payload, offset)
+        offset += DETECTION_GROUP.size
+
+    groups = []
+    for length in lengths:
+        group = []
+        for _ in range(length):
+            obj, offset = _decode_detection(payload, offset)
+            group.append(obj)
+        groups.append(group)
+    if not grouped:
+        return groups[0] if groups else []
+    return groups
+
+
+### Hyperspectral materials ###
+def encode_materials(materials):
+    parts = []
+    for name, percentage in materials.items():
+        name = str(name).encode()
+        parts.append(MATERIAL.pack(percentage, len(name)))
+        parts.append(name)
+    return parts
+
+
+def decode_materials(count, payload):
+    materials = {}
+    offset = 0
+    for _ in range(count):
+        percentage, name_len = MATERIAL.unpack_from(payload, offset)
+        offset += MATERIAL.size
+        name = bytes(payload[offset : offset + name_len]).decode()
+        offset += name_len
+        materials[name] = percentage
+    return materials
+
+
+### Generic values ###
+def encode_values(values):
+    return [json.dumps(list(values), default=_json_default).encode()]
+
+
+def decode_values(count, payload):
+    return json.loads(bytes(payload))
+
+
+if __name__ == "__main__":
+    # Loopback throughput of the framed protocol against the previous pickle framing
+    import pickle
+    import threading
+    from time import perf_counter
+
+    NUM_MESSAGES = 50
+    PAYLOAD_SIZE = 4 * 1024 * 1024  # Roughly a full resolution JPEG
+    NUM_OBJECTS = 1000
+
+    payload = np.random.default_rng(0).integers(0, 256, PAYLOAD_SIZE, dtype=np.uint8)
+
+    def legacy_send(sock, data):
+        data = pickle.dumps(data)
+        sock.send(len(data).to_bytes(8, byteorder="big"))
+        sock.sendall(data)
+
+    def legacy_receive(sock):
+        data_size = int.from_bytes(_legacy_recv(sock, 8), byteorder="big")
+        data = b""
+        while len(data) < data_size:
+            data += sock.recv(min(4096, data_size - len(data)))
+        return pickle.loads(data)
+
+    def _legacy_recv(sock, n):
+        data = b""
+        while len(data) < n:
+            data += sock.recv(n - len(data))
+        return data
+
+    def run(name, send, receive, total_bytes):
+        a, b = socket.socketpair()
+        sender = threading.Thread(target=send, args=(a,))
+        t0 = perf_counter()
+        sender.start()
+        receive(b)
+        sender.join()
+        elapsed = perf_counter() - t0
+        a.close()
+        b.close()
+        print(f"{name}: {elapsed:.3f}s, {total_bytes / elapsed / 1e6:.1f} MB/s")
+
+    total = NUM_MESSAGES * PAYLOAD_SIZE
+
+    def send_pickle(sock):
+        for _ in range(NUM_MESSAGES):
+            legacy_send(sock, payload)
+
+    def receive_pickle(sock):
+        for _ in range(NUM_MESSAGES):
+            legacy_receive(sock)
+
+    def send_framed(sock):
+        for _ in range(NUM_MESSAGES):
+            send_message(
+                sock, MSG_IMAGES, 1, [IMAGE_LENGTH.pack(payload.nbytes), payload]
+            )
+
+    def receive_framed(sock):
+        for _ in range(NUM_MESSAGES):
+            expect(receive_message(sock), (MSG_IMAGES,))
+
+    run("Images, pickle", send_pickle, receive_pickle, total)
+    run("Images, framed", send_framed, receive_framed, total)
+
+    objects = [
+        Object(
+            id=i,
+            label="person",
+            coords=[i, i, i + 100, i + 200],
+            conf=0.5,
+            camera=i % 4,
+        )
+        for i in range(NUM_OBJECTS)
+    ]
+
+    def send_objects_pickle(sock):
+        sock.send(len(objects).to_bytes(8, byteorder="big"))
+        for obj in objects:
+            legacy_send(sock, obj)
+
+    def receive_objects_pickle(sock):
+        n = int.from_bytes(_legacy_recv(sock, 8), byteorder="big")
+        [legacy_receive(sock) for _ in range(n)]
+
+    def send_objects_framed(sock):
+        send_message(sock, MSG_DETECTIONS, *encode_detections(objects))
+
+    def receive_objects_framed(sock):
+        received = decode_detections(
+            *expect(receive_message(sock), (MSG_DETECTIONS,))[1:]
+        )
+        assert [o.coords for o in received] == [o.coords for o in objects]
+
+    size = sum(len(pickle.dumps(o)) for o in objects)
+    run(
+        f"{NUM_OBJECTS} objects, pickle",
+        send_objects_pickle,
+        receive_objects_pickle,
+        size,
+    )
+    run(
+        f"{NUM_OBJECTS} objects, framed",
+        send_objects_framed,
+        receive_objects_framed,
+        size,
+    )
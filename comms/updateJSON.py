@@ -1,4 +1,5 @@
 import json
+import threading
 import cv2
 import numpy as np
 import requests
@@ -9,8 +10,13 @@ import logging
 # location: string
 # pins: [
 #   {
+#       uid: string
 #       geo_coords: [lon, lat]
 #       panorama_ref: './imgref'
+#       preview: true, until the full resolution panorama replaces the preview
+#       thumbnail_ref: './imgref_thumb'
+#       tiles_ref: './imgref_tiles'
+#       tiles_multires: {pannellum multiRes settings}
 #       objects: [
 #           {
 #           x1: int
@@ -33,6 +39,10 @@ import logging
 # }
 
 
+# Scan JSON files are updated from the tile worker as well as the scan loop
+_scan_lock = threading.Lock()
+
+
 # Reset the JSON file script
 def resetJSON(filename="New Scan"):
     file_path = "../user-interface/api/data.json"
@@ -48,35 +58,47 @@ def resetJSON(filename="New Scan"):
         print(f"An error occurred whilst resetting JSON: {e}")
 
 
-# Save images to front-end, then update JSON with latest data
-def updateJSON(uid, lat, lon, objects, image, activeFile):
+# Save images to front-end, then update JSON with latest data.
+# A preview panorama adds a pin marked "preview", which the full resolution panorama of the same uid replaces.
+# Objects are in full resolution panorama co-ordinates, so {objects_shape} is the shape of the full panorama
+def updateJSON(
+    uid, lat, lon, objects, image, activeFile, preview=False, objects_shape=None
+):
     logging.debug("Updating ui json")
     # Specify panorama path
-    save_path = (
-        "./user-interface/public/images/" + activeFile[:-5] + "/img" + uid + ".jpg"
-    )
+    panorama_ref = "/img" + uid + ("_preview" if preview else "") + ".jpg"
+    save_path = "./user-interface/public/images/" + activeFile[:-5] + panorama_ref
 
     # Write image
     cv2.imwrite(save_path, image)
 
     # Specify JSON path and read data
     file_path = "./user-interface/api/scans/" + activeFile
-    with open(file_path, "r") as file:
-        data = json.load(file)
-
-    # Construct dictionary with new data
-    newPin = {
-        "geo_coords": [lat, lon],
-        "panorama_ref": "/img" + uid + ".jpg",
-        "objects": format_results(objects, image.shape),
-    }
+    with _scan_lock:
+        with open(file_path, "r") as file:
+            data = json.load(file)
 
-    # Append update
-    data["pins"].append(newPin)
+        # Construct dictionary with new data
+        newPin = {
+            "uid": uid,
+            "geo_coords": [lat, lon],
+            "panorama_ref": panorama_ref,
+            "objects": format_results(objects, objects_shape or image.shape),
+        }
+        if preview:
+            newPin["preview"] = True
+
+        # Replace the preview of this panorama, keeping anything added to its pin since, or append update
+        pin = next((pin for pin in data["pins"] if pin.get("uid") == uid), None)
+        if pin is None:
+            data["pins"].append(newPin)
+        else:
+            pin.pop("preview", None)
+            pin.update(newPin)
 
-    # Write to file
-    with open(file_path, "w") as file:
-        json.dump(data, file, indent=4)
+        # Write to file
+        with open(file_path, "w") as file:
+            json.dump(data, file, indent=4)
     print("JSON file updated successfully.")
 
     logging.debug("finished updating ui json")
@@ -97,42 +119,64 @@ def updateJSON_HS(
 ):
     logging.debug("Updating ui json with hyperspectral results")
     file_path = "./user-interface/api/scans/" + activeFile
-    with open(file_path, "r") as file:
-        data = json.load(file)
+    with _scan_lock:
+        with open(file_path, "r") as file:
+            data = json.load(file)
 
-    # Construct dictionary with new data
-    for pin in data["pins"]:
-        if pin["geo_coords"] == [lat, lon]:
-            if hs_classifcation_ref:
-                pin["hsi_ref"] = hs_classifcation_ref
-                pin["ndvi_ref"] = hs_ndvi_ref
-                pin["msavi_ref"] = hs_msavi_ref
-                pin["custom2_ref"] = hs_custom2_ref
-                pin["artificial_ref"] = hs_artificial_ref
-                pin["rgb_ref"] = hs_rgb_ref
-                pin["materials_ref"] = hs_materials_ref
-            else:
-                for i, json_obj in enumerate(pin["objects"]):
-                    for j, detect_obj in enumerate(filtered_objects):
-                        if json_obj["id"] == detect_obj.id:
-                            json_obj["HS_classification_ref"] = (
-                                detect_obj.hs_classification_ref
-                            )
-                            json_obj["HS_ndvi_ref"] = detect_obj.hs_ndvi_ref
-                            json_obj["HS_msavi_ref"] = detect_obj.hs_msavi_ref
-                            json_obj["HS_custom2_ref"] = detect_obj.hs_custom2_ref
-                            json_obj["HS_artificial_ref"] = detect_obj.hs_artificial_ref
-                            json_obj["HS_rgb_ref"] = detect_obj.hs_rgb_ref
-                            json_obj["HS_materials"] = detect_obj.hs_materials
+        # Construct dictionary with new data
+        for pin in data["pins"]:
+            if pin["geo_coords"] == [lat, lon]:
+                if hs_classifcation_ref:
+                    pin["hsi_ref"] = hs_classifcation_ref
+                    pin["ndvi_ref"] = hs_ndvi_ref
+                    pin["msavi_ref"] = hs_msavi_ref
+                    pin["custom2_ref"] = hs_custom2_ref
+                    pin["artificial_ref"] = hs_artificial_ref
+                    pin["rgb_ref"] = hs_rgb_ref
+                    pin["materials_ref"] = hs_materials_ref
+                else:
+                    for i, json_obj in enumerate(pin["objects"]):
+                        for j, detect_obj in enumerate(filtered_objects):
+                            if json_obj["id"] == detect_obj.id:
+                                json_obj["HS_classification_ref"] = (
+                                    detect_obj.hs_classification_ref
+                                )
+                                json_obj["HS_ndvi_ref"] = detect_obj.hs_ndvi_ref
+                                json_obj["HS_msavi_ref"] = detect_obj.hs_msavi_ref
+                                json_obj["HS_custom2_ref"] = detect_obj.hs_custom2_ref
+                                json_obj["HS_artificial_ref"] = detect_obj.hs_artificial_ref
+                                json_obj["HS_rgb_ref"] = detect_obj.hs_rgb_ref
+                                json_obj["HS_materials"] = detect_obj.hs_materials
 
-    # Write to file
-    with open(file_path, "w") as file:
-        json.dump(data, file, indent=4)
+        # Write to file
+        with open(file_path, "w") as file:
+            json.dump(data, file, indent=4)
     print("JSON file updated successfully.")
 
     logging.debug("Finished updating ui json with hyperspectral results")
 
 
+def updateJSON_tiles(uid, activeFile, thumbnail_ref, tiles_ref, multires):
+    """Adds the thumbnail and tile pyramid of panorama {uid} to its pin"""
+    logging.debug("Updating ui json with panorama tiles")
+    file_path = "./user-interface/api/scans/" + activeFile
+    with _scan_lock:
+        with open(file_path, "r") as file:
+            data = json.load(file)
+
+        for pin in data["pins"]:
+            if pin["panorama_ref"] == "/img" + uid + ".jpg":
+                pin["thumbnail_ref"] = thumbnail_ref
+                pin["tiles_ref"] = tiles_ref
+                pin["tiles_multires"] = multires
+
+        # Write to file
+        with open(file_path, "w") as file:
+            json.dump(data, file, indent=4)
+
+    logging.debug("Finished updating ui json with panorama tiles")
+
+
 # Populate the JSON file with dummy data
 def dummydataJSON():
     file_path = "../user-interface/api/data.json"
@@ -185,12 +229,13 @@ def format_results(objects, image_shape):
                 "RGB_classification": obj.label,
                 "RGB_confidence": obj.conf,
                 "HS_materials": obj.hs_materials,
-                "HS_classification_ref": "",
-                "HS_ndvi_ref": "",
-                "HS_msavi_ref": "",
-                "HS_custom2_ref": "",
-                "HS_artificial_ref": "",
-                "HS_rgb_ref": "",
+                # Set already if the pin replaces a preview after hyperspectral results arrived
+                "HS_classification_ref": obj.hs_classification_ref or "",
+                "HS_ndvi_ref": obj.hs_ndvi_ref or "",
+                "HS_msavi_ref": obj.hs_msavi_ref or "",
+                "HS_custom2_ref": obj.hs_custom2_ref or "",
+                "HS_artificial_ref": obj.hs_artificial_ref or "",
+                "HS_rgb_ref": obj.hs_rgb_ref or "",
                 "distance": obj.distance,
             }
         )
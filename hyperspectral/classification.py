@@ -1,14 +1,14 @@
 import os
 import numpy as np
-import matplotlib.pyplot as plt
-import tensorflow as tf
-from scipy.ndimage import median_filter
-import matplotlib.colors as mcolors
 import logging
-from hyperspectral.hyperspectral_driver import (
-    get_wavelength_index,
-    get_calibration_array,
-)
+from hyperspectral.hyperspectral_driver import SpectralCalibration
+from hyperspectral.model_registry import get_model
+from hyperspectral.indices import IndexEngine
+from hyperspectral.render import render_index, render_labels, save_debug_png
+from hyperspectral.smoothing import majority_filter
+
+# Indices rendered and sent to PiA with every scan
+RESULT_INDICES = ["ndvi", "msavi", "custom2", "artificial"]
 
 
 def select_bands(start=100, end=500, num_bands=30):
@@ -23,157 +23,47 @@ def load_label_encoder(label_encoding_path):
     raise FileNotFoundError("Label encoding file not found!")
 
 
-def apply_smoothing(image, filter_size=10):
-    """Applies median filtering to reduce speckling noise in classification results."""
-    return median_filter(image, size=filter_size)
-
-
-def plot_and_save_index(
-    index_data, output_path, manual_flag, title="Index", cmap="RdYlGn", vmin=-1, vmax=1
-):
-    """
-    Plots and saves a vegetation index image
-    """
+def prepare_pixels(full_image):
+    """Selects the classifier's bands from {full_image} and normalises them.
+    Returns the pixels flattened to (h*w, num_bands) float32, and (h, w)"""
+    selected_band_indices = select_bands()
+    image = full_image[:, :, selected_band_indices]  # reduced image
+    image = np.divide(image, np.max(image), dtype=np.float32)
+    # image = normalize_image(image)
 
-    plt.figure(figsize=(8, 6))
-    plt.axis("off")
-    im = plt.imshow(index_data, cmap=cmap, vmin=vmin, vmax=vmax)
+    h, w, num_bands = image.shape
+    return image.reshape(-1, num_bands), (h, w)  # Flatten for model input
 
-    if not manual_flag:
-        plt.axis("off")
-        ax = plt.gca()
-        ax.set_facecolor("black")
 
-        cbar = plt.colorbar(im, label=title)
-        cbar.ax.yaxis.label.set_color("white")
-        cbar.ax.tick_params(color="white", labelcolor="white")
-        plt.title(title, color="white")
+def apply_smoothing(image, filter_size=10, threads=1):
+    """Applies a majority filter to reduce speckling noise in classification results."""
+    return majority_filter(image, size=filter_size, threads=threads)
 
-    plt.savefig(
-        output_path,
-        dpi=300,
-        bbox_inches="tight",
-        pad_inches=0,
-        transparent=True,
-    )
-    plt.close()
-    print(f"{title} image saved as {output_path}")
-
-
-def calculate_ndvi(full_image, cal_arr):
-    """Calculate NDVI for all pixels in the image."""
-    logging.debug("Calculating NDVI")
-    red_idx = get_wavelength_index(cal_arr, 690, 2)
-    nir_idx = get_wavelength_index(cal_arr, 860, 2)
-
-    red_band = full_image[:, :, red_idx].astype(np.float32)
-    nir_band = full_image[:, :, nir_idx].astype(np.float32)
-
-    denominator = nir_band + red_band
-    ndvi = (nir_band - red_band) / denominator
-
-    # Replace NaNs and Infs with 0
-    ndvi = np.nan_to_num(ndvi, nan=0.0, posinf=0.0, neginf=0.0)
-    logging.debug("Succesfully calculated NDVI")
-    return ndvi
-
-def calculate_msavi(full_image, cal_arr):
-    red_idx = get_wavelength_index(cal_arr, 690, 2)
-    nir_idx = get_wavelength_index(cal_arr, 860, 2)
-    red_band = full_image[:, :, red_idx].astype(np.float32)
-    nir_band = full_image[:, :, nir_idx].astype(np.float32)
-    msavi = 0.5*(2*(nir_band+1)-np.sqrt((2*nir_band+1)**2-8*(nir_band-red_band)))
-    return np.nan_to_num(msavi, nan=0.0, posinf=0.0, neginf=0.0)
-
-def calculate_custom1(full_image, cal_arr):
-    a = get_wavelength_index(cal_arr, 700, 2)
-    b = get_wavelength_index(cal_arr, 770, 2)
-    a = full_image[:, :, a].astype(np.float32)
-    b = full_image[:, :, b].astype(np.float32)
-    result = 5*((b - a) / (b + a))
-    result = np.clip(result, -1, 1)
-    return np.nan_to_num(result, nan=0.0, posinf=0.0, neginf=0.0)
-
-def calculate_custom2(full_image, cal_arr):
-    a = get_wavelength_index(cal_arr, 540, 2)
-    b = get_wavelength_index(cal_arr, 580, 2)
-    a = full_image[:, :, a].astype(np.float32)
-    b = full_image[:, :, b].astype(np.float32)
-    result = np.clip((6*(b - a) / (b + a)),-1,1)
-    return np.nan_to_num(result, nan=0.0, posinf=0.0, neginf=0.0)
-
-def calculate_custom4(full_image, cal_arr):
-    red_idx = get_wavelength_index(cal_arr, 690, 2)
-    nir_idx = get_wavelength_index(cal_arr, 820, 2)
-    red_band = full_image[:, :, red_idx].astype(np.float32)
-    nir_band = full_image[:, :, nir_idx].astype(np.float32)
-    result = 2*(nir_band - red_band) / (nir_band + red_band)
-    result = np.clip(result, -1, 1)
-    return np.nan_to_num(result, nan=0.0, posinf=0.0, neginf=0.0)
-
-def calculate_custom_artifical(full_image, cal_arr):
-    custom1 = calculate_custom1(full_image, cal_arr)
-    custom2 = calculate_custom2(full_image, cal_arr)
-    custom4 = calculate_custom4(full_image, cal_arr)
-    ndvi = calculate_ndvi(full_image, cal_arr)
-    # result = np.where(ndvi < -0.4, ndvi, custom2)# + np.where(ndvi < -0.4, -1, 0) #+ np.where(custom1 < 0.1, -1, 0) + np.where(custom2 < -0.5, -1, 0)
-    result = np.where(custom4 < -0.55, custom4, np.where(custom1 < -0.4, custom1,custom2))
-    # result = np.where(custom1 < -0.4, custom1, custom2)
-    result = np.clip(result, -1, 1)
-    return np.nan_to_num(np.clip(result,-1,1), nan=0.0, posinf=0.0, neginf=0.0)
-
-def calculate_pi(full_image, cal_arr):
-    """ """
-    logging.debug("Calculating PI")
-    r680 = get_wavelength_index(cal_arr, 680, 2)
-    r750 = get_wavelength_index(cal_arr, 750, 2)
-    r860 = get_wavelength_index(cal_arr, 860, 2)
-
-    band_680 = full_image[:, :, r680].astype(np.float32)
-    band_750 = full_image[:, :, r750].astype(np.float32)
-    band_860 = full_image[:, :, r860].astype(np.float32)
-
-    # Spectral contrast: if the curve is flat, it might be plastic
-    pi = 1 - (np.abs(band_750 - band_680) + np.abs(band_860 - band_750)) / (
-        band_680 + band_860 + 1e-6
-    )
 
-    pi = np.nan_to_num(pi, nan=0.0, posinf=0.0, neginf=0.0)
-    logging.debug("Succesfully calculated PI")
-    return pi
+def classify_pixels(model, pixels):
+    """Returns the most likely class of each row of {pixels}"""
+    if hasattr(model, "predict_labels"):
+        return model.predict_labels(pixels)
+    return np.argmax(model.predict(pixels, verbose=0), axis=1)
 
 
-def classify_and_save(
-    model_path, full_image, label_encoding_path, output_path, cal_arr, manual_flag
+def render_and_save(
+    classified_image,
+    indices,
+    label_encoding_path,
+    output_path,
+    manual_flag,
+    save_png=False,
 ):
-    logging.debug("Classifying hyperspectral scene")
+    """
+    Smooths {classified_image} and renders it along with the calculated {indices}.
+    Returns the class percentages and a dict of rendered BGR images keyed by
+    "classification" and the names of {indices}.
+    If {save_png}, the images are also written next to {output_path} for debugging
+    """
     output_name, _ = os.path.splitext(output_path)
 
-    # Load model
-    logging.debug("Loading classification model")
-    model = tf.keras.models.load_model(model_path)
-    logging.debug("Successfully loaded classification model")
-
-    # Load hyperspectral image (full image for NDVI)
-    # full_image = np.load(image_path)
-
-    # Keep the reduced image for classification
-    selected_band_indices = select_bands()
-    image = full_image[:, :, selected_band_indices]  # reduced image
-    image = image / np.max(image)
-    # image = normalize_image(image)
-
-    h, w, num_bands = image.shape
-    image_reshaped = image.reshape(-1, num_bands)  # Flatten for model input
-
-    # Classify image
-    logging.debug("Classifying materials in scene")
-    predictions = model.predict(image_reshaped)
-    predicted_labels = np.argmax(predictions, axis=1)
-    classified_image = predicted_labels.reshape(h, w)
-    logging.debug("Finished classifying materials")
-
-    # Apply smoothing (using median filter)
+    # Apply smoothing (using majority filter)
     logging.debug("Smoothing classification result")
     smoothed_image = apply_smoothing(classified_image)
     logging.debug("Successfully finished smoothing classification result")
@@ -192,115 +82,83 @@ def classify_and_save(
         for i, orig in enumerate(unique_classes)
     }
 
-    # Generate colormap
-    cmap = plt.get_cmap("gist_rainbow", len(unique_classes))
-    colors = cmap(np.linspace(0, 1, len(unique_classes)))
-    custom_cmap = mcolors.ListedColormap(colors)
-
-    # Generate legend mapping from encoded labels to class names
-    legend_labels = {
-        encoded: label_encoder[orig][1]
-        for orig, (encoded, _) in label_encoder.items()
-        if encoded in unique_classes
-    }
-
-    # Plot classification result
-    plt.figure(figsize=(8, 6))
-    plt.axis("off")
-    # ax = plt.gca()
-    # ax.set_facecolor("black")
-    img = plt.imshow(
+    # Render classification result, with legend unless full manual scan
+    images = {}
+    class_names = {encoded: name for encoded, name in label_encoder.values()}
+    images["classification"] = render_labels(
         smoothed_image,
-        cmap=custom_cmap,
-        vmin=unique_classes[0],
-        vmax=unique_classes[-1],
+        class_names,
+        title=None if manual_flag else "Material Classification",
+        legend=not manual_flag,
     )
 
-    if not manual_flag:
-
-        ax = plt.gca()
-        ax.set_facecolor("black")
+    for name, index_data in indices.items():
+        images[name] = render_index(
+            index_data,
+            cmap="RdYlGn",
+            vmin=-1,
+            vmax=1,
+            title=None if manual_flag else name.upper(),
+            colorbar=not manual_flag,
+        )
 
-        plt.title("Material Classification", color="white")
+    if save_png:
+        for name, image in images.items():
+            save_debug_png(image, output_name + f"_{name}.png")
+        logging.debug(f"Saved hyperspectral results to {output_name}_*.png")
 
-        # Add colorbar legend
-        cbar = plt.colorbar(img, ticks=list(legend_labels.keys()))
-        cbar.set_ticklabels(list(legend_labels.values()))
-        cbar.set_label("Class Labels", color="white")
-        cbar.ax.tick_params(color="white", labelcolor="white")
+    return class_percentages, images
 
-    # Save output image
-    output_path = output_name + "_classification.png"
-    plt.savefig(
-        output_path,
-        dpi=300,
-        bbox_inches="tight",
-        pad_inches=0,
-        transparent=True,
-    )
-    plt.close()
-    logging.debug(f"Smoothed classification results saved to {output_path}")
 
+def classify_and_save(
+    model_path,
+    full_image,
+    label_encoding_path,
+    output_path,
+    calibration,
+    manual_flag,
+    save_png=False,
+):
     """
-    Calculate Indices
+    Classifies the materials in {full_image} and calculates its indices.
+    Returns the class percentages, and a dict of rendered BGR images keyed by
+    "classification", "ndvi", "msavi", "custom2" and "artificial".
+    If {save_png}, the images are also written next to {output_path} for debugging
     """
+    logging.debug("Classifying hyperspectral scene")
 
-    logging.debug("Calculating NDVI...")
-    ndvi = calculate_ndvi(full_image, cal_arr)
-    logging.debug("Calculating MSAVI...")
-    masavi = calculate_msavi(full_image, cal_arr)
-    logging.debug("Calculating CUSTOM2 Index...")
-    custom2 = calculate_custom2(full_image, cal_arr)
-    logging.debug("Calculating ARTIFICIAL index...")
-    artificial = calculate_custom_artifical(full_image, cal_arr)
-
-    plot_and_save_index(
-        ndvi,
-        output_name + "_ndvi.png",
-        manual_flag=manual_flag,
-        title="NDVI",
-        cmap="RdYlGn",
-        vmin=-1,
-        vmax=1,
-    )
+    # Get model, only read from disk on first use or if the file has changed
+    model = get_model(model_path)
 
-    plot_and_save_index(
-        masavi,
-        output_name + "_msavi.png",
-        manual_flag=manual_flag,
-        title="MSAVI",
-        cmap="RdYlGn",
-        vmin=-1,
-        vmax=1,
-    )
+    # Keep the reduced image for classification
+    image_reshaped, (h, w) = prepare_pixels(full_image)
 
-    plot_and_save_index(
-        custom2,
-        output_name + "_custom2.png",
-        manual_flag=manual_flag,
-        title="CUSTOM2",
-        cmap="RdYlGn",
-        vmin=-1,
-        vmax=1,
-    )
+    # Classify image
+    logging.debug("Classifying materials in scene")
+    classified_image = classify_pixels(model, image_reshaped).reshape(h, w)
+    logging.debug("Finished classifying materials")
 
-    plot_and_save_index(
-        artificial,
-        output_name + "_artificial.png",
-        manual_flag=manual_flag,
-        title="ARTIFICIAL",
-        cmap="RdYlGn",
-        vmin=-1,
-        vmax=1,
-    )
+    """
+    Calculate Indices
+    """
 
-    return class_percentages
+    # All indices are computed together so bands and shared terms are only calculated once
+    indices = IndexEngine(calibration).evaluate(full_image, RESULT_INDICES)
+
+    return render_and_save(
+        classified_image,
+        indices,
+        label_encoding_path,
+        output_path,
+        manual_flag,
+        save_png,
+    )
 
 
 if __name__ == "__main__":
 
     CALIBRATION_FILE_PATH = "calibration/BaslerPIA1600_CalibrationA.txt"
-    cal_arr = get_calibration_array(CALIBRATION_FILE_PATH)
+    calibration = SpectralCalibration.from_file(CALIBRATION_FILE_PATH)
 
     model_path = "NN_09_04_2025_v3.keras"
     image_path = "debug_PiB/scene_8.npy"
@@ -309,7 +167,13 @@ if __name__ == "__main__":
 
     full_image = np.load(image_path)
 
-    class_distribution = classify_and_save(
-        model_path, full_image, label_encoding_path, output_name, cal_arr
+    class_distribution, _ = classify_and_save(
+        model_path,
+        full_image,
+        label_encoding_path,
+        output_name,
+        calibration,
+        manual_flag=False,
+        save_png=True,
     )
     # print("Class Distribution (%):", class_distribution)
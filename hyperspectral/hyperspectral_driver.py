@@ -1,7 +1,8 @@
 import os
 import numpy as np
 import pypylon.pylon as pylon
-from time import time
+from time import time, perf_counter
+import threading
 import matplotlib.pyplot as plt
 import logging
 
@@ -32,30 +33,131 @@ def get_nframes(angle, pixel_binning):
     return round((angle / 27) * 1600/pixel_binning)
 
 
-def grab_hyperspectral_scene(
-    cam, nframes, white_image, dark_image, class_name, calibrate=True
-):
-    """Grabs {nframes} number of frames from hyperspectral camera"""
-    from time import time  # Import the time module
+class HyperspectralGrabber:
+    """
+    Grabs {nframes} line frames from the hyperspectral camera on a background thread.
 
-    cam.StartGrabbing(pylon.GrabStrategy_OneByOne)
+    Each frame is copied as-is into a preallocated, contiguous (nframes, height, width) buffer,
+    so the camera is never throttled by the caller. Records host and camera timestamps per frame
+    and counts frames dropped between the camera and the host.
+    """
 
-    scene = np.zeros(
-        (cam.Width.Value, nframes, cam.Height.Value), dtype=np.uint8
-    )
-    i = 0
+    def __init__(self, cam, nframes, timeout_ms=1000, max_num_buffer=64):
+        self.cam = cam
+        self.nframes = nframes
+        self.timeout_ms = timeout_ms
+        self.max_num_buffer = max_num_buffer
 
-    logging.debug("Starting grabbing")
-    while cam.IsGrabbing():
+        self.buffer = np.empty(
+            (nframes, cam.Height.Value, cam.Width.Value), dtype=np.uint8
+        )
+        self.host_timestamps = np.zeros(nframes)  # perf_counter() seconds
+        self.camera_timestamps = np.zeros(nframes, dtype=np.uint64)  # camera ticks
+
+        self.frames_grabbed = 0
+        self.frames_dropped = 0  # BlockID gaps, frames the camera sent that never arrived
+        self.failed_grabs = 0  # Frames that arrived incomplete
+        self.error = None
+
+        self._done = False
+        self._stop = threading.Event()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.cam.MaxNumBuffer.Value = self.max_num_buffer
+        self.cam.StartGrabbing(pylon.GrabStrategy_OneByOne)
+        logging.debug("Starting grabbing")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops grabbing early, keeping the frames grabbed so far"""
+        self._stop.set()
+
+    def _run(self):
+        last_block_id = None
+        try:
+            while self.frames_grabbed < self.nframes and not self._stop.is_set():
+                grab = self.cam.RetrieveResult(
+                    self.timeout_ms, pylon.TimeoutHandling_ThrowException
+                )
+                try:
+                    if not grab.GrabSucceeded():
+                        self.failed_grabs += 1
+                        continue
+
+                    i = self.frames_grabbed
+                    with grab.GetArrayZeroCopy() as frame:
+                        self.buffer[i] = frame  # uncalibrated
+                    self.host_timestamps[i] = perf_counter()
+                    self.camera_timestamps[i] = grab.TimeStamp
+
+                    block_id = grab.BlockID
+                    if last_block_id is not None and block_id > last_block_id + 1:
+                        self.frames_dropped += block_id - last_block_id - 1
+                    last_block_id = block_id
+
+                    with self._condition:
+                        self.frames_grabbed = i + 1
+                        self._condition.notify_all()
+                finally:
+                    grab.Release()
+
+        except Exception as e:
+            logging.error(f"Hyperspectral grabbing failed: {e}")
+            self.error = e
+
+        finally:
+            self.cam.StopGrabbing()
+            logging.debug("Finished grabbing")
+            with self._condition:
+                self._done = True
+                self._condition.notify_all()
+
+    def wait_for_frames(self, n, timeout=None):
+        """Blocks until at least {n} frames have been grabbed or grabbing has finished.
+        Returns the number of frames available"""
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.frames_grabbed >= n or self._done, timeout
+            )
+            return self.frames_grabbed
+
+    def is_done(self):
+        return self._done
+
+    def join(self, timeout=None):
+        """Waits for grabbing to finish and returns the scene cube"""
+        self._thread.join(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.cube()
+
+    def cube(self):
+        """Zero-copy view of the frames grabbed so far as a (width, nframes, height) scene,
+        the layout returned by grab_hyperspectral_scene"""
+        return self.buffer[: self.frames_grabbed].transpose(2, 0, 1)
+
+    def effective_fps(self):
+        """Frame rate actually achieved, from the host timestamps"""
+        n = self.frames_grabbed
+        if n < 2:
+            return 0.0
+        return (n - 1) / (self.host_timestamps[n - 1] - self.host_timestamps[0])
 
-        grab = cam.RetrieveResult(1000, pylon.TimeoutHandling_ThrowException)
 
-        if grab.GrabSucceeded():
-            scene[:, i, :] = np.transpose(grab.Array)  # uncalibrated
-            i += 1
+def grab_hyperspectral_scene(
+    cam, nframes, white_image, dark_image, class_name, calibrate=True
+):
+    """Grabs {nframes} number of frames from hyperspectral camera"""
 
-        if i == nframes:
-            break
+    grabber = HyperspectralGrabber(cam, nframes).start()
+    scene = grabber.join()
+    logging.debug(
+        f"Grabbed {grabber.frames_grabbed} frames at {grabber.effective_fps():.1f} fps, "
+        f"{grabber.frames_dropped} dropped, {grabber.failed_grabs} failed"
+    )
     """
     calibrated_scene = np.zeros_like(scene)
 
@@ -67,8 +169,6 @@ def grab_hyperspectral_scene(
         )
     """
 
-    cam.StopGrabbing()
-    logging.debug("Finished grabbing")
     # print(f"Acquired {nframes} frames in {time()-t0} seconds")
 
     # Define the directory path to save images to
@@ -134,23 +234,70 @@ def get_calibration_array(path):
     return np.loadtxt(path)
 
 
-def get_wavelength_index(cal_array, wavelength, pixel_binning):
-    """Returns closest index of {wavelength} from {cal_array} while accounting for pixel binning"""
-
-    if wavelength < cal_array[0]:
-        print("Wavelength out of range: Too small.")
-        return 0
+class SpectralCalibration:
+    """
+    Wavelength of each sensor row from the calibration file, with lookups from wavelength to band index.
+    Built once and shared, binned band centres are computed once per binning factor
+    """
 
-    elif wavelength > cal_array[-1]:
-        print("Wavelength out of range: Too large.")
-        return len(cal_array) // pixel_binning
+    def __init__(self, wavelengths):
+        self.wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        self._centres = {}
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(get_calibration_array(path))
+
+    def __len__(self):
+        return len(self.wavelengths)
+
+    def num_bands(self, pixel_binning):
+        """Number of bands in a cube grabbed with {pixel_binning}"""
+        return len(self.wavelengths) // pixel_binning
+
+    def centres(self, pixel_binning):
+        """Returns the mean wavelength of each band of a cube grabbed with {pixel_binning}"""
+        centres = self._centres.get(pixel_binning)
+        if centres is None:
+            n = self.num_bands(pixel_binning)
+            centres = (
+                self.wavelengths[: n * pixel_binning]
+                .reshape(n, pixel_binning)
+                .mean(axis=1)
+            )
+            centres.flags.writeable = False
+            self._centres[pixel_binning] = centres
+        return centres
+
+    def indices(self, wavelengths, pixel_binning):
+        """Returns the band index of each of {wavelengths}, the band containing the first
+        sensor row at or above the wavelength. Out of range wavelengths give the first or last band"""
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        rows = np.searchsorted(self.wavelengths, wavelengths, side="left")
+
+        if np.any(wavelengths < self.wavelengths[0]):
+            logging.warning("Wavelength out of range: Too small.")
+        if np.any(wavelengths > self.wavelengths[-1]):
+            logging.warning("Wavelength out of range: Too large.")
+
+        return np.minimum(rows // pixel_binning, self.num_bands(pixel_binning) - 1)
+
+    def index(self, wavelength, pixel_binning):
+        """Returns the band index of {wavelength}"""
+        return int(self.indices(wavelength, pixel_binning))
+
+    def band_window(self, cube, low, high, pixel_binning):
+        """Returns the mean of the bands of {cube} from wavelength {low} to {high} inclusive, as float32"""
+        start, end = self.indices((low, high), pixel_binning)
+        return cube[..., start : end + 1].mean(axis=-1, dtype=np.float32)
 
-    for i in range(0, len(cal_array)):
-        diff = wavelength - cal_array[i]
-        if diff <= 0:
-            break
 
-    return int(i / pixel_binning)
+def get_wavelength_index(cal_array, wavelength, pixel_binning):
+    """Returns closest index of {wavelength} from {cal_array} while accounting for pixel binning.
+    {cal_array} may be a SpectralCalibration or the array from get_calibration_array"""
+    if not isinstance(cal_array, SpectralCalibration):
+        cal_array = SpectralCalibration(cal_array)
+    return cal_array.index(wavelength, pixel_binning)
 
 
 def calibrate_hyperspectral(X, W, D):
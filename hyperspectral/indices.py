@@ -0,0 +1,237 @@
+# Declarative spectral index engine.
+# Each index is an expression over wavelengths. IndexEngine resolves the bands of all
+# requested indices once, casts each band once, and evaluates shared sub-expressions once.
+import logging
+import numpy as np
+from hyperspectral.hyperspectral_driver import SpectralCalibration
+
+
+class Expr:
+    """Node of an index expression. Nodes with the same key are evaluated once per pass"""
+
+    def __init__(self, op, *args):
+        self.op = op
+        self.args = args
+        self.key = (op,) + tuple(
+            a.key if isinstance(a, Expr) else a for a in args
+        )
+
+    def bands(self):
+        """Returns the set of wavelengths used by this expression"""
+        if self.op == "band":
+            return {self.args[0]}
+        found = set()
+        for a in self.args:
+            if isinstance(a, Expr):
+                found |= a.bands()
+        return found
+
+    def __add__(self, other):
+        return Expr("add", self, _wrap(other))
+
+    def __radd__(self, other):
+        return Expr("add", _wrap(other), self)
+
+    def __sub__(self, other):
+        return Expr("sub", self, _wrap(other))
+
+    def __rsub__(self, other):
+        return Expr("sub", _wrap(other), self)
+
+    def __mul__(self, other):
+        return Expr("mul", self, _wrap(other))
+
+    def __rmul__(self, other):
+        return Expr("mul", _wrap(other), self)
+
+    def __truediv__(self, other):
+        return Expr("div", self, _wrap(other))
+
+    def __rtruediv__(self, other):
+        return Expr("div", _wrap(other), self)
+
+    def __pow__(self, other):
+        return Expr("pow", self, _wrap(other))
+
+    def __neg__(self):
+        return Expr("neg", self)
+
+    def __lt__(self, other):
+        return Expr("lt", self, _wrap(other))
+
+    def __gt__(self, other):
+        return Expr("gt", self, _wrap(other))
+
+
+def _wrap(value):
+    if isinstance(value, Expr):
+        return value
+    return Expr("const", float(value))
+
+
+def Band(wavelength):
+    """Reflectance at {wavelength} nm"""
+    return Expr("band", float(wavelength))
+
+
+def sqrt(x):
+    return Expr("sqrt", _wrap(x))
+
+
+def absolute(x):
+    return Expr("abs", _wrap(x))
+
+
+def clip(x, low, high):
+    return Expr("clip", _wrap(x), _wrap(low), _wrap(high))
+
+
+def where(condition, x, y):
+    return Expr("where", condition, _wrap(x), _wrap(y))
+
+
+def finite(x):
+    """Replaces NaNs and Infs with 0"""
+    return Expr("finite", _wrap(x))
+
+
+def normalised_difference(a, b):
+    return (a - b) / (a + b)
+
+
+_OPS = {
+    "add": np.add,
+    "sub": np.subtract,
+    "mul": np.multiply,
+    "div": np.divide,
+    "pow": np.power,
+    "neg": np.negative,
+    "lt": np.less,
+    "gt": np.greater,
+    "sqrt": np.sqrt,
+    "abs": np.abs,
+    "clip": np.clip,
+    "where": np.where,
+    "finite": lambda x: np.nan_to_num(x, nan=0.0, posinf=0.0, neginf=0.0),
+}
+
+
+### Index definitions ####
+BLUE = Band(470)
+GREEN = Band(560)
+RED = Band(690)
+NIR = Band(860)
+
+NDVI = finite(normalised_difference(NIR, RED))
+MSAVI = finite(0.5 * (2 * (NIR + 1) - sqrt((2 * NIR + 1) ** 2 - 8 * (NIR - RED))))
+
+# NIR edge
+CUSTOM1 = finite(clip(5 * normalised_difference(Band(770), Band(700)), -1, 1))
+CUSTOM2 = finite(clip(6 * normalised_difference(Band(580), Band(540)), -1, 1))
+CUSTOM4 = finite(clip(2 * normalised_difference(Band(820), RED), -1, 1))
+ARTIFICIAL = finite(
+    clip(
+        where(CUSTOM4 < -0.55, CUSTOM4, where(CUSTOM1 < -0.4, CUSTOM1, CUSTOM2)),
+        -1,
+        1,
+    )
+)
+
+# Spectral contrast: if the curve is flat, it might be plastic
+PI = finite(
+    1
+    - (absolute(Band(750) - Band(680)) + absolute(NIR - Band(750)))
+    / (Band(680) + NIR + 1e-6)
+)
+
+INDICES = {
+    "ndvi": NDVI,
+    "gndvi": finite(normalised_difference(NIR, GREEN)),
+    "ndwi": finite(normalised_difference(GREEN, NIR)),
+    "msavi": MSAVI,
+    "pvi": finite((NIR - 0.6 * RED - 0.2) / np.sqrt(1 + 0.6**2)),
+    # Wide Dynamic Range Vegetation Index
+    "wdrvi": finite((0.1 * NIR - RED) / (0.1 * NIR + RED)),
+    "npcri": finite(normalised_difference(RED, Band(492))),
+    # Green Chlorophyll Index
+    "clg": finite(NIR / Band(680) - 1),
+    "evi": finite(2.5 * (NIR - RED) / (NIR + 6 * RED - 7.5 * BLUE + 1)),
+    "ndbi": finite(normalised_difference(Band(900), Band(800))),
+    "custom1": CUSTOM1,
+    "custom2": CUSTOM2,
+    "custom3_sky": finite(6 * normalised_difference(BLUE, Band(530))),
+    "custom4": CUSTOM4,
+    "custom1_2_combo": finite(
+        normalised_difference(Band(770), Band(700))
+        + normalised_difference(Band(520), GREEN)
+    ),
+    "artificial": ARTIFICIAL,
+    "pi": PI,
+}
+
+
+class IndexEngine:
+    """Evaluates named indices over a hyperspectral cube of shape (h, w, bands).
+    {calibration} is a SpectralCalibration, or the array from get_calibration_array"""
+
+    def __init__(self, calibration, pixel_binning=2, indices=INDICES, block_rows=16):
+        self.indices = indices
+        self.block_rows = block_rows
+
+        # Resolve every wavelength used by any index once
+        wavelengths = set()
+        for expr in indices.values():
+            wavelengths |= expr.bands()
+        if not isinstance(calibration, SpectralCalibration):
+            calibration = SpectralCalibration(calibration)
+        wavelengths = sorted(wavelengths)
+        self.band_index = dict(
+            zip(wavelengths, calibration.indices(wavelengths, pixel_binning).tolist())
+        )
+
+    def evaluate(self, cube, names=None):
+        """Returns {name: float32 array (h, w)} for each index in {names} (default all),
+        computed in one pass over {cube} in blocks of rows"""
+        if names is None:
+            names = list(self.indices)
+        exprs = [self.indices[name] for name in names]
+
+        wavelengths = set()
+        for expr in exprs:
+            wavelengths |= expr.bands()
+
+        h, w = cube.shape[:2]
+        results = {name: np.empty((h, w), dtype=np.float32) for name in names}
+
+        logging.debug(f"Calculating indices {names}")
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            for start in range(0, h, self.block_rows):
+                block = cube[start : start + self.block_rows]
+
+                # Cast each band used by the requested indices once per block
+                memo = {
+                    ("band", wl): block[:, :, self.band_index[wl]].astype(np.float32)
+                    for wl in wavelengths
+                }
+
+                for name, expr in zip(names, exprs):
+                    results[name][start : start + self.block_rows] = self._evaluate(
+                        expr, memo
+                    )
+
+        logging.debug("Successfully calculated indices")
+        return results
+
+    def _evaluate(self, expr, memo):
+        value = memo.get(expr.key)
+        if value is not None:
+            return value
+
+        if expr.op == "const":
+            value = expr.args[0]
+        else:
+            args = [self._evaluate(a, memo) for a in expr.args]
+            value = _OPS[expr.op](*args)
+
+        memo[expr.key] = value
+        return value
@@ -0,0 +1,106 @@
+# Keeps the hyperspectral classification models loaded for the lifetime of the process,
+# so that each object scan does not have to deserialise the model again.
+import os
+import threading
+import logging
+import numpy as np
+from hyperspectral.numpy_mlp import NumpyMLP, export_keras_file
+
+MODEL_BACKENDS = ("keras", "numpy")
+
+# model_path -> (mtime, model, backend)
+_models = {}
+_lock = threading.Lock()
+# Backend models are loaded with when none is given, see set_default_backend
+_default_backend = "keras"
+
+
+def set_default_backend(backend):
+    """Sets the backend, "keras" or "numpy", models are loaded with when none is given"""
+    global _default_backend
+    if backend not in MODEL_BACKENDS:
+        raise ValueError(f"Unknown model backend {backend}")
+    _default_backend = backend
+
+
+def _read_model(model_path, backend):
+    """Reads the model at {model_path} from disk.
+    backend="numpy" runs the model with NumpyMLP, exporting {model_path} to a .npz alongside it if needed"""
+    if backend == "numpy":
+        npz_path = os.path.splitext(model_path)[0] + ".npz"
+        if npz_path != model_path and (
+            not os.path.exists(npz_path)
+            or os.path.getmtime(npz_path) < os.path.getmtime(model_path)
+        ):
+            logging.info(f"Exporting {model_path} to {npz_path}")
+            export_keras_file(model_path, npz_path)
+        return NumpyMLP.from_npz(npz_path)
+
+    elif backend == "keras":
+        import tensorflow as tf
+
+        return tf.keras.models.load_model(model_path)
+
+    raise ValueError(f"Unknown model backend {backend}")
+
+
+def warmup_model(model, batch_size=1024):
+    """Runs a dummy batch through {model} so the first real scan does not pay for graph tracing"""
+    num_inputs = model.input_shape[-1]
+    model.predict(np.zeros((batch_size, num_inputs), dtype=np.float32), verbose=0)
+
+
+def load_model(model_path, backend=None, warmup=True):
+    """Loads the model at {model_path} into the registry, replacing any previously loaded version.
+    {backend} is "keras" or "numpy", the default backend if None, and is remembered for later reloads"""
+    with _lock:
+        return _load_locked(model_path, backend or _default_backend, warmup)
+
+
+def _load_locked(model_path, backend, warmup):
+    mtime = os.path.getmtime(model_path)
+
+    logging.debug(f"Loading classification model {model_path} ({backend})")
+    model = _read_model(model_path, backend)
+    if warmup:
+        warmup_model(model)
+    logging.debug("Successfully loaded classification model")
+
+    _models[model_path] = (mtime, model, backend)
+    return model
+
+
+def get_model(model_path, backend=None):
+    """Returns the loaded model for {model_path}.
+    The model is loaded on first use, with {backend} or the default backend if None,
+    and reloaded whenever the file's mtime changes or another backend is asked for"""
+    with _lock:
+        entry = _models.get(model_path)
+
+        try:
+            mtime = os.path.getmtime(model_path)
+        except OSError:
+            # File may be mid-replacement, keep using the version in memory
+            if entry is None:
+                raise
+            logging.warning(f"Could not stat {model_path}, using loaded model")
+            return entry[1]
+
+        if entry is None:
+            return _load_locked(model_path, backend or _default_backend, warmup=True)
+
+        if backend is not None and entry[2] != backend:
+            logging.info(f"Reloading {model_path} with the {backend} backend")
+            return _load_locked(model_path, backend, warmup=True)
+
+        if entry[0] != mtime:
+            logging.info(f"{model_path} changed on disk, reloading")
+            return _load_locked(model_path, entry[2], warmup=True)
+
+        return entry[1]
+
+
+def unload_model(model_path):
+    """Removes {model_path} from the registry"""
+    with _lock:
+        _models.pop(model_path, None)
@@ -0,0 +1,318 @@
+# Runs the spectral classifier from NN.py with NumPy only, so PiB does not need TensorFlow at runtime.
+# A trained .keras model is exported once to a .npz of Dense weights, with BatchNormalization folded in.
+import os
+import glob
+import logging
+import numpy as np
+
+# Rows pushed through the network at a time. Keeps the widest hidden layer
+# (2048 x 128 float32 = 1 MB) inside the Pi's cache
+DEFAULT_CHUNK_SIZE = 2048
+
+
+def _activation_name(activation):
+    """Returns the name of a keras activation, which may be a string or a function"""
+    if isinstance(activation, str):
+        return activation
+    return getattr(activation, "__name__", "linear")
+
+
+def fold_keras_model(model):
+    """
+    Converts a Sequential Dense/BatchNormalization/Dropout model into a list of
+    (weights, bias, activation) tuples.
+
+    NN.py places BatchNormalization after the Dense activation, so each BatchNormalization
+    is an affine transform on the input of the following Dense layer and is folded into it.
+    Dropout is the identity at inference time and is dropped.
+    """
+    layers = []
+    scale, shift = None, None  # Pending BatchNormalization transform
+
+    for layer in model.layers:
+        kind = layer.__class__.__name__
+        config = layer.get_config()
+
+        if kind in ("InputLayer", "Dropout"):
+            continue
+
+        elif kind == "BatchNormalization":
+            params = layer.get_weights()
+            gamma = params.pop(0) if config.get("scale", True) else None
+            beta = params.pop(0) if config.get("center", True) else None
+            mean, var = params
+
+            s = 1 / np.sqrt(var + layer.epsilon)
+            if gamma is not None:
+                s = s * gamma
+            t = -mean * s
+            if beta is not None:
+                t = t + beta
+
+            # Compose with any BatchNormalization already pending
+            if scale is None:
+                scale, shift = s, t
+            else:
+                scale, shift = scale * s, shift * s + t
+
+        elif kind == "Dense":
+            params = layer.get_weights()
+            w = params[0].astype(np.float64)
+            b = (
+                params[1].astype(np.float64)
+                if config.get("use_bias", True)
+                else np.zeros(w.shape[1])
+            )
+
+            if scale is not None:
+                b = shift @ w + b
+                w = scale[:, None] * w
+                scale, shift = None, None
+
+            layers.append((w, b, _activation_name(config["activation"])))
+
+        else:
+            raise ValueError(f"Layer type {kind} is not supported by the NumPy engine")
+
+    # BatchNormalization at the very end has no Dense to fold into
+    if scale is not None:
+        layers.append((np.diag(scale), shift, "linear"))
+
+    return layers
+
+
+def export_keras_model(model, npz_path):
+    """Folds {model} and writes its layers to {npz_path}"""
+    layers = fold_keras_model(model)
+
+    arrays = {"num_layers": np.array(len(layers))}
+    for i, (w, b, activation) in enumerate(layers):
+        arrays[f"w{i}"] = w.astype(np.float32)
+        arrays[f"b{i}"] = b.astype(np.float32)
+        arrays[f"activation{i}"] = np.array(activation)
+
+    np.savez(npz_path, **arrays)
+    logging.debug(f"Exported {len(layers)} layer NumPy model to {npz_path}")
+
+
+def export_keras_file(keras_path, npz_path=None):
+    """Loads the .keras file at {keras_path} and exports it to {npz_path} (defaults to the same name with .npz)"""
+    import tensorflow as tf
+
+    if npz_path is None:
+        npz_path = os.path.splitext(keras_path)[0] + ".npz"
+
+    model = tf.keras.models.load_model(keras_path)
+    export_keras_model(model, npz_path)
+    return npz_path
+
+
+class NumpyMLP:
+    """Forward pass of an exported classifier. Exposes predict() like a keras model so it can be used as a drop-in.
+    Scratch buffers are shared between calls, so one instance should not be used from two threads at once"""
+
+    def __init__(self, layers, dtype=np.float32, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.weights = [w.astype(self.dtype) for w, _, _ in layers]
+        self.biases = [b.astype(self.dtype) for _, b, _ in layers]
+        self.activations = [a for _, _, a in layers]
+
+        for a in self.activations:
+            if a not in ("relu", "linear", "softmax", "sigmoid", "tanh"):
+                raise ValueError(f"Activation {a} is not supported by the NumPy engine")
+
+        # Per layer scratch buffers, reused for every chunk
+        self._buffers = [
+            np.empty((chunk_size, w.shape[1]), dtype=self.dtype) for w in self.weights
+        ]
+        self._input = np.empty((chunk_size, self.weights[0].shape[0]), dtype=self.dtype)
+
+    @classmethod
+    def from_npz(cls, npz_path, dtype=np.float32, chunk_size=DEFAULT_CHUNK_SIZE):
+        with np.load(npz_path) as data:
+            layers = [
+                (data[f"w{i}"], data[f"b{i}"], str(data[f"activation{i}"]))
+                for i in range(int(data["num_layers"]))
+            ]
+        return cls(layers, dtype, chunk_size)
+
+    @property
+    def input_shape(self):
+        return (None, self.weights[0].shape[0])
+
+    @property
+    def output_shape(self):
+        return (None, self.weights[-1].shape[1])
+
+    def _forward_chunk(self, x, n):
+        """Runs rows x[:n] through the network, returns a view of the final layer's buffer"""
+        h = self._input[:n]
+        np.copyto(h, x, casting="unsafe")
+
+        for w, b, activation, buffer in zip(
+            self.weights, self.biases, self.activations, self._buffers
+        ):
+            out = buffer[:n]
+            np.matmul(h, w, out=out)
+            out += b
+
+            if activation == "relu":
+                np.maximum(out, 0, out=out)
+            elif activation == "sigmoid":
+                np.negative(out, out=out)
+                np.exp(out, out=out)
+                out += 1
+                np.reciprocal(out, out=out)
+            elif activation == "tanh":
+                np.tanh(out, out=out)
+            # Softmax is applied by the caller in float32, linear needs nothing
+
+            h = out
+
+        return h
+
+    def predict(self, x, verbose=0, batch_size=None):
+        """Returns class probabilities for each row of {x}, shape (N, num_classes)"""
+        x = np.asarray(x)
+        n_rows = x.shape[0]
+        out = np.empty((n_rows,) + self.output_shape[1:], dtype=np.float32)
+        softmax = self.activations[-1] == "softmax"
+
+        for start in range(0, n_rows, self.chunk_size):
+            end = min(start + self.chunk_size, n_rows)
+            logits = self._forward_chunk(x[start:end], end - start)
+
+            probs = out[start:end]
+            np.copyto(probs, logits, casting="unsafe")
+            if softmax:
+                probs -= probs.max(axis=1, keepdims=True)
+                np.exp(probs, out=probs)
+                probs /= probs.sum(axis=1, keepdims=True)
+
+        return out
+
+    def predict_labels(self, x):
+        """Returns the most likely class of each row of {x}. Skips the softmax, which does not change the argmax"""
+        x = np.asarray(x)
+        n_rows = x.shape[0]
+        labels = np.empty(n_rows, dtype=np.intp)
+
+        for start in range(0, n_rows, self.chunk_size):
+            end = min(start + self.chunk_size, n_rows)
+            labels[start:end] = np.argmax(
+                self._forward_chunk(x[start:end], end - start), axis=1
+            )
+
+        return labels
+
+
+def check_parity(keras_model, numpy_model, scenes):
+    """
+    Compares the predictions of {keras_model} and {numpy_model} on hyperspectral {scenes}.
+    Returns a list of (label agreement, max probability difference) per scene
+    """
+    from hyperspectral.classification import prepare_pixels
+
+    results = []
+    for scene in scenes:
+        pixels, _ = prepare_pixels(scene)
+
+        expected = keras_model.predict(pixels, verbose=0)
+        actual = numpy_model.predict(pixels)
+
+        agreement = np.mean(np.argmax(expected, axis=1) == np.argmax(actual, axis=1))
+        max_diff = float(np.max(np.abs(expected - actual)))
+        results.append((agreement, max_diff))
+
+    return results
+
+
+def check_folding(seed=0, num_inputs=30, num_classes=5, rows=1000):
+    """
+    Builds a small random Dense/BatchNormalization/Dropout model laid out as NN.py, exports it and checks
+    NumpyMLP matches keras. BatchNormalization statistics are randomised so folding is exercised.
+    Raises AssertionError on a mismatch
+    """
+    import tempfile
+    import tensorflow as tf
+
+    rng = np.random.default_rng(seed)
+    tf.keras.utils.set_random_seed(seed)
+    model = tf.keras.Sequential(
+        [
+            tf.keras.Input(shape=(num_inputs,)),
+            tf.keras.layers.Dense(64, activation="relu"),
+            tf.keras.layers.BatchNormalization(),
+            tf.keras.layers.Dropout(0.3),
+            tf.keras.layers.Dense(32, activation="relu"),
+            tf.keras.layers.BatchNormalization(),
+            tf.keras.layers.Dense(num_classes, activation="softmax"),
+        ]
+    )
+    for layer in model.layers:
+        if layer.__class__.__name__ == "BatchNormalization":
+            n = layer.get_weights()[0].shape[0]
+            layer.set_weights(
+                [
+                    rng.uniform(0.5, 2, n),  # gamma
+                    rng.normal(0, 0.5, n),  # beta
+                    rng.normal(0, 1, n),  # moving mean
+                    rng.uniform(0.1, 3, n),  # moving variance
+                ]
+            )
+
+    x = rng.random((rows, num_inputs), dtype=np.float32)
+    expected = model.predict(x, verbose=0)
+    with tempfile.TemporaryDirectory() as tmp:
+        npz_path = os.path.join(tmp, "model.npz")
+        export_keras_model(model, npz_path)
+        actual = NumpyMLP.from_npz(npz_path, chunk_size=256).predict(x)
+
+    np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-5)
+
+
+def synthetic_scene(seed=0, shape=(64, 64, 512)):
+    """Returns a hyperspectral scene of smooth random spectra, for when no recorded scenes are available"""
+    rng = np.random.default_rng(seed)
+    h, w, bands = shape
+    # A few random spectra mixed in varying proportions over the scene
+    spectra = np.cumsum(rng.normal(0, 1, (4, bands)), axis=1)
+    spectra -= spectra.min(axis=1, keepdims=True)
+    mix = rng.dirichlet(np.ones(4), h * w)
+    return (mix @ spectra * 100).reshape(h, w, bands).astype(np.uint16)
+
+
+if __name__ == "__main__":
+    # Check BatchNormalization folding, then export the classifier and check it against keras on recorded scenes
+    import tensorflow as tf
+
+    MODEL_PATH = "hyperspectral/NN_18_03_2025.keras"
+    SCENES = sorted(glob.glob("debug_PiB/scene_*.npy"))
+
+    check_folding()
+    print("BatchNormalization folding matches keras")
+
+    if SCENES:
+        scenes = {p: lambda p=p: np.load(p) for p in SCENES}
+    else:
+        print("No recorded scenes in debug_PiB, checking on synthetic scenes")
+        scenes = {f"synthetic_{i}": lambda i=i: synthetic_scene(i) for i in range(3)}
+
+    npz_path = export_keras_file(MODEL_PATH)
+    keras_model = tf.keras.models.load_model(MODEL_PATH)
+
+    for dtype, min_agreement in ((np.float32, 0.999), (np.float16, 0.99)):
+        numpy_model = NumpyMLP.from_npz(npz_path, dtype=dtype)
+        results = check_parity(
+            keras_model, numpy_model, (load() for load in scenes.values())
+        )
+
+        checked = 0
+        for name, (agreement, max_diff) in zip(scenes, results):
+            print(
+                f"{np.dtype(dtype).name} {name}: {agreement * 100:.3f}% labels match, max probability difference {max_diff:.2e}"
+            )
+            assert agreement >= min_agreement, f"{name} does not match the keras model"
+            checked += 1
+        assert checked == len(scenes), "Not every scene was checked"
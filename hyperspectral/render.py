@@ -0,0 +1,164 @@
+# Renders index maps and material classifications straight to uint8 BGR arrays,
+# ready to be JPEG encoded and sent to PiA. Replaces the matplotlib figure + savefig path.
+import os
+from functools import lru_cache
+import numpy as np
+import cv2
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+TEXT_COLOUR = (255, 255, 255)
+
+
+@lru_cache(maxsize=None)
+def get_colormap_lut(name, n_colours=256):
+    """Returns the matplotlib colormap {name} sampled at {n_colours} points as a (n_colours, 3) uint8 BGR table"""
+    from matplotlib import colormaps
+
+    rgba = colormaps[name].resampled(n_colours)(np.arange(n_colours))
+    lut = np.round(rgba[:, 2::-1] * 255).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+def _text_scale(height):
+    """Font scale and line thickness for an image {height} pixels high"""
+    scale = max(height / 1000, 0.4)
+    return scale, max(1, round(scale * 1.5))
+
+
+def _add_title(image, title):
+    """Adds a black band above {image} with {title} centred in it"""
+    scale, thickness = _text_scale(image.shape[0])
+    (text_w, text_h), baseline = cv2.getTextSize(title, FONT, scale, thickness)
+    band_h = text_h + baseline + 2 * int(10 * scale)
+
+    out = np.zeros((image.shape[0] + band_h, image.shape[1], 3), dtype=np.uint8)
+    out[band_h:] = image
+    x = max((image.shape[1] - text_w) // 2, 0)
+    cv2.putText(
+        out,
+        title,
+        (x, band_h - baseline - int(10 * scale)),
+        FONT,
+        scale,
+        TEXT_COLOUR,
+        thickness,
+        cv2.LINE_AA,
+    )
+    return out
+
+
+def _append_strip(image, strip):
+    """Joins {strip} to the right of {image}, padding the shorter one with black"""
+    h = max(image.shape[0], strip.shape[0])
+    out = np.zeros((h, image.shape[1] + strip.shape[1], 3), dtype=np.uint8)
+    out[: image.shape[0], : image.shape[1]] = image
+    out[: strip.shape[0], image.shape[1] :] = strip
+    return out
+
+
+def colorbar_strip(height, lut, vmin, vmax, n_ticks=5):
+    """Returns a vertical colorbar, {vmax} at the top, with tick labels to its right"""
+    scale, thickness = _text_scale(height)
+    margin = int(15 * scale)
+    bar_w = int(30 * scale)
+
+    labels = [f"{v:.2f}" for v in np.linspace(vmax, vmin, n_ticks)]
+    (text_w, text_h), _ = cv2.getTextSize(max(labels, key=len), FONT, scale, thickness)
+
+    strip = np.zeros((height, 3 * margin + bar_w + text_w, 3), dtype=np.uint8)
+    levels = np.linspace(len(lut) - 1, 0, height).astype(np.intp)
+    strip[:, margin : margin + bar_w] = lut[levels][:, None, :]
+
+    for label, y in zip(labels, np.linspace(0, height - 1, n_ticks)):
+        y = int(np.clip(y + text_h // 2, text_h, height - 1))
+        cv2.putText(
+            strip,
+            label,
+            (2 * margin + bar_w, y),
+            FONT,
+            scale,
+            TEXT_COLOUR,
+            thickness,
+            cv2.LINE_AA,
+        )
+
+    return strip
+
+
+def legend_strip(height, colours, names):
+    """Returns a legend of coloured swatches, one row per entry of {names}"""
+    scale, thickness = _text_scale(height)
+    margin = int(15 * scale)
+    row_h = max(min(height // max(len(names), 1), int(50 * scale)), 1)
+    swatch = max(row_h - margin // 2, 1)
+
+    text_w = max(
+        [cv2.getTextSize(name, FONT, scale, thickness)[0][0] for name in names] + [0]
+    )
+    strip = np.zeros(
+        (max(height, row_h * len(names)), 3 * margin + swatch + text_w, 3),
+        dtype=np.uint8,
+    )
+
+    for i, (colour, name) in enumerate(zip(colours, names)):
+        y = i * row_h
+        strip[y : y + swatch, margin : margin + swatch] = colour
+        cv2.putText(
+            strip,
+            name,
+            (2 * margin + swatch, y + swatch),
+            FONT,
+            scale,
+            TEXT_COLOUR,
+            thickness,
+            cv2.LINE_AA,
+        )
+
+    return strip
+
+
+def render_index(
+    index_data, cmap="RdYlGn", vmin=-1, vmax=1, title=None, colorbar=False
+):
+    """Maps {index_data} to colours of {cmap} between {vmin} and {vmax}.
+    Optionally adds a {title} and a colorbar. Returns a uint8 BGR image"""
+    lut = get_colormap_lut(cmap)
+
+    # Same binning as matplotlib: floor((x - vmin) / (vmax - vmin) * N), clipped to the table
+    levels = np.subtract(index_data, vmin, dtype=np.float32)
+    levels *= len(lut) / (vmax - vmin)
+    np.clip(levels, 0, len(lut) - 1, out=levels)
+    image = cv2.applyColorMap(levels.astype(np.uint8), lut.reshape(-1, 1, 3))
+
+    if colorbar:
+        image = _append_strip(image, colorbar_strip(image.shape[0], lut, vmin, vmax))
+    if title:
+        image = _add_title(image, title)
+    return image
+
+
+def render_labels(labels, class_names, cmap="gist_rainbow", title=None, legend=False):
+    """
+    Colours a map of class IDs, one colour of {cmap} per class present.
+    {class_names} maps class ID -> name for the legend. Returns a uint8 BGR image
+    """
+    classes = np.unique(labels)
+    colours = get_colormap_lut(cmap, len(classes))
+
+    lut = np.zeros((256, 3), dtype=np.uint8)
+    lut[classes] = colours
+    image = cv2.applyColorMap(labels.astype(np.uint8), lut.reshape(-1, 1, 3))
+
+    if legend:
+        names = [class_names.get(c, str(c)) for c in classes]
+        image = _append_strip(image, legend_strip(image.shape[0], colours, names))
+    if title:
+        image = _add_title(image, title)
+    return image
+
+
+def save_debug_png(image, path):
+    """Writes a rendered image to {path}, for debugging only"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    cv2.imwrite(path, image)
@@ -1,4 +1,5 @@
 import os
+import sys
 import glob
 import csv
 import numpy as np
@@ -6,9 +7,18 @@ import matplotlib.pyplot as plt
 import tkinter as tk
 from tkinter import simpledialog
 
-from hyperspectral_driver import (
-    get_wavelength_index,
-    get_calibration_array,
+# Run as python hyperspectral/spectrum_analyser.py from the repository root, which its paths are relative to
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hyperspectral.hyperspectral_driver import SpectralCalibration
+from hyperspectral.indices import (
+    INDICES,
+    IndexEngine,
+    Band,
+    clip,
+    finite,
+    normalised_difference,
+    where,
 )
 
 # === Functions ===
@@ -35,153 +45,6 @@ def plot_and_save_index(
     print(f"{title} image saved as {output_path}")
 
 
-def calculate_ndvi(full_image, cal_arr):
-    red_idx = get_wavelength_index(cal_arr, 690, 2)
-    nir_idx = get_wavelength_index(cal_arr, 860, 2)
-    red_band = full_image[:, :, red_idx].astype(np.float32)
-    nir_band = full_image[:, :, nir_idx].astype(np.float32)
-    ndvi = (nir_band - red_band) / (nir_band + red_band)
-    return np.nan_to_num(ndvi, nan=0.0, posinf=0.0, neginf=0.0)
-
-def calculate_gndvi(full_image, cal_arr):
-    green_idx = get_wavelength_index(cal_arr, 560, 2)
-    nir_idx = get_wavelength_index(cal_arr, 860, 2)
-    green_band = full_image[:, :, green_idx].astype(np.float32)
-    nir_band = full_image[:, :, nir_idx].astype(np.float32)
-    ndvi = (nir_band - green_band) / (nir_band + green_band)
-    return np.nan_to_num(ndvi, nan=0.0, posinf=0.0, neginf=0.0)
-
-def calculate_ndwi(full_image, cal_arr):
-    green_idx = get_wavelength_index(cal_arr, 560, 2)
-    nir_idx = get_wavelength_index(cal_arr, 860, 2)
-    green_band = full_image[:, :, green_idx].astype(np.float32)
-    nir_band = full_image[:, :, nir_idx].astype(np.float32)
-    ndwi = (green_band-nir_band) / (green_band+nir_band)
-    return np.nan_to_num(ndwi, nan=0.0, posinf=0.0, neginf=0.0)
-
-def calculate_msavi(full_image, cal_arr):
-    red_idx = get_wavelength_index(cal_arr, 690, 2)
-    nir_idx = get_wavelength_index(cal_arr, 860, 2)
-    red_band = full_image[:, :, red_idx].astype(np.float32)
-    nir_band = full_image[:, :, nir_idx].astype(np.float32)
-    msavi = 0.5*(2*(nir_band+1)-np.sqrt((2*nir_band+1)**2-8*(nir_band-red_band)))
-    return np.nan_to_num(msavi, nan=0.0, posinf=0.0, neginf=0.0)
-
-def calculate_pvi(full_image, cal_arr):
-    red_idx = get_wavelength_index(cal_arr, 690, 2)
-    nir_idx = get_wavelength_index(cal_arr, 860, 2)
-    red_band = full_image[:, :, red_idx].astype(np.float32)
-    nir_band = full_image[:, :, nir_idx].astype(np.float32)
-    a=0.6
-    b=0.2
-    pvi = (nir_band-a*red_band-b)/(np.sqrt(1+a**2))
-    return np.nan_to_num(pvi, nan=0.0, posinf=0.0, neginf=0.0)
-
-# Wide Dynamic Range Vegitation Index
-def calculate_wdrvi(full_image, cal_arr):
-    red_idx = get_wavelength_index(cal_arr, 690, 2)
-    nir_idx = get_wavelength_index(cal_arr, 860, 2)
-    red_band = full_image[:, :, red_idx].astype(np.float32)
-    nir_band = full_image[:, :, nir_idx].astype(np.float32)
-    wdrvi = (0.1*nir_band - red_band) / (0.1*nir_band + red_band)
-    return np.nan_to_num(wdrvi, nan=0.0, posinf=0.0, neginf=0.0)
-
-def calculate_npcri(full_image, cal_arr):
-    red_idx = get_wavelength_index(cal_arr, 690, 2)
-    blue_idx = get_wavelength_index(cal_arr, 492, 2)
-    red_band = full_image[:, :, red_idx].astype(np.float32)
-    blue_band = full_image[:, :, blue_idx].astype(np.float32)
-    npcri = (red_band-blue_band) / (red_band+blue_band)
-    return np.nan_to_num(npcri, nan=0.0, posinf=0.0, neginf=0.0)
-
-# Green Chlorophyll Index
-def calculate_clg(full_image, cal_arr):
-    green_idx = get_wavelength_index(cal_arr, 680, 2)
-    nir_idx = get_wavelength_index(cal_arr, 860, 2)
-    green_band = full_image[:, :, green_idx].astype(np.float32)
-    nir_band = full_image[:, :, nir_idx].astype(np.float32)
-    clg = (nir_band/green_band)-1 # should be -1?
-    return np.nan_to_num(clg, nan=0.0, posinf=0.0, neginf=0.0)
-
-def calculate_evi(full_image, cal_arr):
-    red_idx = get_wavelength_index(cal_arr, 690, 2)
-    blue_idx = get_wavelength_index(cal_arr, 470, 2)
-    nir_idx = get_wavelength_index(cal_arr, 860, 2)
-    red_band = full_image[:, :, red_idx].astype(np.float32)
-    blue_band = full_image[:, :, blue_idx].astype(np.float32)
-    nir_band = full_image[:, :, nir_idx].astype(np.float32)
-    evi = 2.5*(nir_band-red_band)/(nir_band+6*red_band-7.5*blue_band+1)
-    return np.nan_to_num(evi, nan=0.0, posinf=0.0, neginf=0.0)
-
-def calculate_ndbi(full_image, cal_arr):
-    swir_idx = get_wavelength_index(cal_arr, 900, 2)
-    nir_idx = get_wavelength_index(cal_arr, 800, 2)
-    swir_band = full_image[:, :, swir_idx].astype(np.float32)
-    nir_band = full_image[:, :, nir_idx].astype(np.float32)
-    ndbi = (swir_band-nir_band)/(swir_band+nir_band)
-    return np.nan_to_num(ndbi, nan=0.0, posinf=0.0, neginf=0.0)
-
-# NIR edge
-def calculate_custom1(full_image, cal_arr):
-    a = get_wavelength_index(cal_arr, 700, 2)
-    b = get_wavelength_index(cal_arr, 770, 2)
-    a = full_image[:, :, a].astype(np.float32)
-    b = full_image[:, :, b].astype(np.float32)
-    custom1 = 5*((b - a) / (b + a))
-    return np.nan_to_num(custom1, nan=0.0, posinf=0.0, neginf=0.0)
-
-def calculate_custom2(full_image, cal_arr):
-    a = get_wavelength_index(cal_arr, 540, 2)
-    b = get_wavelength_index(cal_arr, 580, 2)
-    a = full_image[:, :, a].astype(np.float32)
-    b = full_image[:, :, b].astype(np.float32)
-    result = np.clip((6*(b - a) / (b + a)),-1,1)
-    return np.nan_to_num(result, nan=0.0, posinf=0.0, neginf=0.0)
-
-def calculate_custom3_sky(full_image, cal_arr):
-    a = get_wavelength_index(cal_arr, 470, 2)
-    b = get_wavelength_index(cal_arr, 530, 2)
-    a = full_image[:, :, a].astype(np.float32)
-    b = full_image[:, :, b].astype(np.float32)
-    result = 6*((a - b) / (b + a))
-    return np.nan_to_num(result, nan=0.0, posinf=0.0, neginf=0.0)
-
-
-def calculate_custom1_2_combo(full_image, cal_arr):
-    a = get_wavelength_index(cal_arr, 700, 2)
-    b = get_wavelength_index(cal_arr, 770, 2)
-    c = get_wavelength_index(cal_arr, 520, 2)
-    d = get_wavelength_index(cal_arr, 560, 2)
-
-    a = full_image[:, :, a].astype(np.float32)
-    b = full_image[:, :, b].astype(np.float32)
-    c = full_image[:, :, c].astype(np.float32)
-    d = full_image[:, :, d].astype(np.float32)
-    custom1 = ((b - a) / (b + a))
-    custom2 = ((c - d) / (c + d))
-    result = custom1+custom2
-    return np.nan_to_num(result, nan=0.0, posinf=0.0, neginf=0.0)
-
-def calculate_custom4(full_image, cal_arr):
-    red_idx = get_wavelength_index(cal_arr, 690, 2)
-    nir_idx = get_wavelength_index(cal_arr, 820, 2)
-    red_band = full_image[:, :, red_idx].astype(np.float32)
-    nir_band = full_image[:, :, nir_idx].astype(np.float32)
-    result = 2*(nir_band - red_band) / (nir_band + red_band)
-    ndvi = np.clip(result, -1, 1)
-    return np.nan_to_num(result, nan=0.0, posinf=0.0, neginf=0.0)
-
-def calculate_custom_artifical(full_image, cal_arr):
-    custom1 = calculate_custom1(full_image, cal_arr)
-    custom2 = calculate_custom2(full_image, cal_arr)
-    custom4 = calculate_custom4(full_image, cal_arr)
-    ndvi = calculate_ndvi(full_image, cal_arr)
-    # result = np.where(ndvi < -0.4, ndvi, custom2)# + np.where(ndvi < -0.4, -1, 0) #+ np.where(custom1 < 0.1, -1, 0) + np.where(custom2 < -0.5, -1, 0)
-    result = np.where(custom4 < -0.55, custom4, np.where(custom1 < -0.4, custom1,custom2))
-    # result = np.where(custom1 < -0.4, custom1, custom2)
-    result = np.clip(result, -1, 1)
-    return np.nan_to_num(np.clip(result,-1,1), nan=0.0, posinf=0.0, neginf=0.0)
-
 def save_spectrum(spectrum, label, x, y):
     header = ["file", "x", "y", "label"] + [f"{wl:.2f}" for wl in wavelengths]
     write_header = not os.path.exists(output_csv)
@@ -207,12 +70,36 @@ CALIBRATION_FILE_PATH = "hyperspectral/calibration/BaslerPIA1600_CalibrationA.tx
 folder_path = "./debug_PiB/"
 output_csv = "labeled_spectra.csv"
 
+# Indices saved, with the analyser's own names. Unlike classification, CUSTOM1 and CUSTOM4 are not clipped
+CUSTOM1 = finite(5 * normalised_difference(Band(770), Band(700)))
+CUSTOM4 = finite(2 * normalised_difference(Band(820), Band(690)))
+ANALYSER_INDICES = {
+    name: expr for name, expr in INDICES.items() if name not in ("artificial", "pi")
+}
+ANALYSER_INDICES.update(
+    {
+        "custom1": CUSTOM1,
+        "custom4": CUSTOM4,
+        "custom_artifical": finite(
+            clip(
+                where(
+                    CUSTOM4 < -0.55,
+                    CUSTOM4,
+                    where(CUSTOM1 < -0.4, CUSTOM1, INDICES["custom2"]),
+                ),
+                -1,
+                1,
+            )
+        ),
+    }
+)
+
 root = tk.Tk()
 root.withdraw()
 
 # === Load Calibration and Files ===
 
-cal_arr = get_calibration_array(CALIBRATION_FILE_PATH)
+calibration = SpectralCalibration.from_file(CALIBRATION_FILE_PATH)
 npy_files = sorted(glob.glob(os.path.join(folder_path, "*.npy")))
 
 if not npy_files:
@@ -244,51 +131,23 @@ if image_data.ndim != 3:
 # === Wavelengths ===
 
 num_bands = image_data.shape[2]
-binning_factor = len(cal_arr) // num_bands
-wavelengths = cal_arr[::binning_factor][:num_bands]
+binning_factor = len(calibration) // num_bands
+wavelengths = calibration.centres(binning_factor)[:num_bands]
 
 # === Compute Indexes and Save ===
 
-ndvi = calculate_ndvi(image_data, cal_arr)
-gndvi = calculate_gndvi(image_data, cal_arr)
-ndwi = calculate_ndwi(image_data, cal_arr)
-msavi = calculate_msavi(image_data, cal_arr)
-pvi = calculate_pvi(image_data, cal_arr)
-npcri = calculate_npcri(image_data, cal_arr)
-wdrvi = calculate_wdrvi(image_data, cal_arr) # poor
-clg = calculate_clg(image_data, cal_arr)
-evi = calculate_evi(image_data, cal_arr)
-ndbi = calculate_ndbi(image_data, cal_arr)
-custom1 = calculate_custom1(image_data, cal_arr)
-custom2 = calculate_custom2(image_data, cal_arr)
-custom1_2_combo = calculate_custom1_2_combo(image_data,cal_arr)
-custom_artifical = calculate_custom_artifical(image_data,cal_arr)
-custom3_sky = calculate_custom3_sky(image_data, cal_arr)
-custom4 = calculate_custom4(image_data, cal_arr)
-
-quick_save(folder_path, file_name, ndvi, "ndvi")
-quick_save(folder_path, file_name, gndvi, "gndvi")
-quick_save(folder_path, file_name, ndwi, "ndwi")
-quick_save(folder_path, file_name, msavi, "msavi")
-quick_save(folder_path, file_name, pvi, "pvi")
-quick_save(folder_path, file_name, wdrvi, "wdrvi")
-quick_save(folder_path, file_name, clg, "clg")
-quick_save(folder_path, file_name, evi, "evi")
-quick_save(folder_path, file_name, ndbi, "ndbi")
-quick_save(folder_path, file_name, custom1, "custom1")
-quick_save(folder_path, file_name, custom2, "custom2")
-quick_save(folder_path, file_name, custom1_2_combo, "custom1_2_combo")
-quick_save(folder_path, file_name, custom_artifical, "custom_artifical")
-quick_save(folder_path, file_name, custom3_sky, "custom3_sky")
-quick_save(folder_path, file_name, custom4, "custom4")
+indices = IndexEngine(calibration, binning_factor, ANALYSER_INDICES).evaluate(image_data)
+for name, index_data in indices.items():
+    quick_save(folder_path, file_name, index_data, name)
+
+ndvi = indices["ndvi"]
+custom_artifical = indices["custom_artifical"]
 
 exit()
 
 # === RGB Image Creation ===
 try:
-    r_idx = get_wavelength_index(cal_arr, 650, 2)
-    g_idx = get_wavelength_index(cal_arr, 550, 2)
-    b_idx = get_wavelength_index(cal_arr, 450, 2)
+    r_idx, g_idx, b_idx = calibration.indices((650, 550, 450), 2)
 except Exception as e:
     print("Error finding RGB band indices:", e)
     r_idx, g_idx, b_idx = 50, 30, 10  # Fallback
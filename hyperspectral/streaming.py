@@ -0,0 +1,171 @@
+# Classifies a hyperspectral scan while it is still being grabbed.
+# Blocks of frames are taken from a HyperspectralGrabber as they arrive and run through
+# band selection, normalisation, the classifier and the index engine on a worker thread,
+# so only smoothing and rendering are left once the rotation stage stops.
+import threading
+import logging
+import numpy as np
+from time import perf_counter
+from hyperspectral.classification import select_bands, classify_pixels, RESULT_INDICES
+
+# Frames classified at a time, 64 frames x 800 pixels = 51200 pixels
+DEFAULT_BLOCK_FRAMES = 64
+
+
+class StreamingClassifier:
+    """
+    Classifies the frames of {grabber} in blocks of {block_frames} as they are grabbed.
+
+    The classifier expects pixels normalised by the maximum of the whole scene, which is only
+    known once grabbing has finished. Blocks are normalised by the maximum seen so far, and any
+    block classified with a different maximum to the final one is classified again in finish().
+    A uint8 scene usually saturates early on, so this is rarely more than the first few blocks.
+    """
+
+    def __init__(
+        self,
+        grabber,
+        model,
+        index_engine,
+        index_names=RESULT_INDICES,
+        block_frames=DEFAULT_BLOCK_FRAMES,
+    ):
+        self.grabber = grabber
+        self.model = model
+        self.index_engine = index_engine
+        self.index_names = list(index_names)
+        self.block_frames = block_frames
+        self.band_indices = select_bands()
+
+        width = grabber.buffer.shape[2]
+        nframes = grabber.nframes
+        self.labels = np.zeros((width, nframes), dtype=np.intp)
+        self.indices = {
+            name: np.zeros((width, nframes), dtype=np.float32)
+            for name in self.index_names
+        }
+
+        # (start, end, maximum used to normalise) for every block classified
+        self.blocks = []
+        self.scene_max = 0
+        self.frames_processed = 0
+        self.error = None
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _block(self, start, end):
+        """(width, frames, bands) view of frames {start} to {end} in the grabber's buffer"""
+        return self.grabber.buffer[start:end].transpose(2, 0, 1)
+
+    def _classify_block(self, start, end, scale):
+        selected = self._block(start, end)[:, :, self.band_indices]
+        # An all zero scene so far classifies the same whatever it is divided by
+        pixels = np.divide(selected, max(scale, 1), dtype=np.float32)
+        self.labels[:, start:end] = classify_pixels(
+            self.model, pixels.reshape(-1, pixels.shape[2])
+        ).reshape(pixels.shape[:2])
+
+    def _process_block(self, start, end):
+        block = self._block(start, end)
+        self.scene_max = max(self.scene_max, int(block[:, :, self.band_indices].max()))
+        self._classify_block(start, end, self.scene_max)
+        self.blocks.append((start, end, self.scene_max))
+
+        for name, index_data in self.index_engine.evaluate(
+            block, self.index_names
+        ).items():
+            self.indices[name][:, start:end] = index_data
+
+        self.frames_processed = end
+
+    def _run(self):
+        try:
+            while True:
+                available = self.grabber.wait_for_frames(
+                    self.frames_processed + self.block_frames
+                )
+                if available > self.frames_processed:
+                    self._process_block(self.frames_processed, available)
+                elif self.grabber.is_done():
+                    break
+
+        except Exception as e:
+            logging.error(f"Streaming classification failed: {e}")
+            self.error = e
+
+    def finish(self):
+        """
+        Waits for grabbing and the worker to finish, then classifies again any block
+        normalised with a different maximum to the whole scene's.
+        Returns the classified image (width, nframes) and a dict of index arrays
+        """
+        self.grabber.join()
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+        t0 = perf_counter()
+        rerun = [(s, e) for s, e, scale in self.blocks if scale != self.scene_max]
+        for start, end in rerun:
+            self._classify_block(start, end, self.scene_max)
+        logging.debug(
+            f"Reclassified {len(rerun)} of {len(self.blocks)} blocks in {perf_counter() - t0:.2f}s"
+        )
+
+        n = self.frames_processed
+        return self.labels[:, :n], {
+            name: data[:, :n] for name, data in self.indices.items()
+        }
+
+
+if __name__ == "__main__":
+    # Check streaming gives the same result as classifying the whole scene, using a recorded scene
+    from hyperspectral.hyperspectral_driver import SpectralCalibration
+    from hyperspectral.classification import prepare_pixels
+    from hyperspectral.model_registry import load_model
+    from hyperspectral.indices import IndexEngine
+
+    MODEL_PATH = "hyperspectral/NN_18_03_2025.keras"
+    CALIBRATION_FILE_PATH = "hyperspectral/calibration/BaslerPIA1600_CalibrationA.txt"
+    SCENE_PATH = "debug_PiB/scene_0.npy"
+
+    class RecordedGrabber:
+        """Stands in for HyperspectralGrabber, delivering a recorded scene all at once"""
+
+        def __init__(self, scene):
+            self.buffer = np.ascontiguousarray(scene.transpose(1, 2, 0))
+            self.nframes = self.frames_grabbed = self.buffer.shape[0]
+
+        def wait_for_frames(self, n, timeout=None):
+            return self.frames_grabbed
+
+        def is_done(self):
+            return True
+
+        def join(self, timeout=None):
+            return self.buffer.transpose(2, 0, 1)
+
+    scene = np.load(SCENE_PATH)
+    model = load_model(MODEL_PATH, backend="numpy")
+    engine = IndexEngine(SpectralCalibration.from_file(CALIBRATION_FILE_PATH))
+
+    t0 = perf_counter()
+    pixels, (h, w) = prepare_pixels(scene)
+    expected_labels = classify_pixels(model, pixels).reshape(h, w)
+    expected_indices = engine.evaluate(scene, RESULT_INDICES)
+    print(f"Whole scene: {perf_counter() - t0:.2f}s")
+
+    t0 = perf_counter()
+    streamer = StreamingClassifier(RecordedGrabber(scene), model, engine).start()
+    labels, indices = streamer.finish()
+    print(f"Streaming: {perf_counter() - t0:.2f}s")
+
+    print(f"Labels match: {np.mean(labels == expected_labels) * 100:.3f}%")
+    for name in RESULT_INDICES:
+        print(
+            f"{name} max difference: {np.nanmax(np.abs(indices[name] - expected_indices[name])):.2e}"
+        )
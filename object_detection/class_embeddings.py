@@ -0,0 +1,109 @@
+# Caches the CLIP text embedding of each YOLO-World class on disk, so that setting the classes to detect
+# only runs the text encoder for classes it has never seen, and does nothing if the classes are unchanged.
+import os
+import threading
+import logging
+import numpy as np
+import torch
+
+EMBEDDINGS_PATH = "object_detection/yolo_models/class_embeddings.npz"
+# Text encoder YOLO-World embeds classes with, the cache is discarded if it was made with another
+CLIP_MODEL = "ViT-B/32"
+# Class YOLO-World treats as background, it is embedded but has no name
+BACKGROUND = " "
+
+# class name -> normalised embedding, loaded from EMBEDDINGS_PATH on first use
+_embeddings = None
+_lock = threading.Lock()
+
+
+def _load_embeddings(path):
+    """Reads the embeddings saved at {path}, or none if there is no usable cache"""
+    if not os.path.exists(path):
+        return {}
+    try:
+        data = np.load(path)
+        if str(data["clip_model"]) != CLIP_MODEL:
+            logging.warning(f"Class embeddings at {path} are not from {CLIP_MODEL}")
+            return {}
+        return dict(zip(data["classes"].tolist(), data["embeddings"]))
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f"Could not read class embeddings from {path}: {e}")
+        return {}
+
+
+def _save_embeddings(path, embeddings):
+    """Writes {embeddings} to {path}, through a temporary file so a reader never sees part of it"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp.npz"
+    np.savez(
+        tmp_path,
+        clip_model=CLIP_MODEL,
+        classes=np.array(list(embeddings)),
+        embeddings=np.stack(list(embeddings.values())),
+    )
+    os.replace(tmp_path, path)
+
+
+def _encode(model, classes):
+    """Runs YOLO-World's text encoder on {classes}, returning the normalised embedding of each"""
+    logging.debug(f"Encoding classes {classes}")
+    model.model.set_classes(classes)
+    return model.model.txt_feats[0].cpu().numpy()
+
+
+def get_class_embeddings(model, classes, path=EMBEDDINGS_PATH):
+    """Returns the (classes, dims) text embeddings of {classes}, encoding and caching any not already cached"""
+    global _embeddings
+    with _lock:
+        if _embeddings is None:
+            _embeddings = _load_embeddings(path)
+
+        missing = list(dict.fromkeys(c for c in classes if c not in _embeddings))
+        if missing:
+            _embeddings.update(zip(missing, _encode(model, missing)))
+            try:
+                _save_embeddings(path, _embeddings)
+            except OSError as e:
+                logging.warning(f"Could not save class embeddings to {path}: {e}")
+
+        return np.stack([_embeddings[c] for c in classes])
+
+
+def set_classes(model, classes, path=EMBEDDINGS_PATH):
+    """
+    Sets the classes YOLO-World {model} detects, as model.set_classes, from cached embeddings.
+    Does nothing if {classes} are the classes already set
+    """
+    classes = list(classes)
+    names = [c for c in classes if c != BACKGROUND]
+    if getattr(model.model, "names", None) == names:
+        logging.debug(f"Classes unchanged {names}")
+        return
+
+    embeddings = get_class_embeddings(model, classes, path)
+    # Moved to the device and precision of the input when predicting
+    head = model.model
+    head.txt_feats = torch.from_numpy(embeddings)[None]
+    head.model[-1].nc = len(classes)
+
+    head.names = names
+    if model.predictor:
+        model.predictor.model.names = names
+
+
+if __name__ == "__main__":
+    from time import perf_counter
+    from ultralytics import YOLOWorld
+
+    logging.basicConfig(level=logging.DEBUG)
+    model = YOLOWorld("object_detection/yolo_models/yolov8s-worldv2.pt")
+    for classes in (
+        ["person", "dog"],
+        ["person", "dog"],
+        ["dog", "bicycle"],
+        ["person", "bicycle"],
+    ):
+        t0 = perf_counter()
+        set_classes(model, classes)
+        print(f"{classes}: {(perf_counter() - t0) * 1000:.1f}ms")
@@ -0,0 +1,241 @@
+# Headless benchmark of object detection on CPU.
+# Runs each set of frames a Pi detects objects in through object_detection one frame at a time and through
+# object_detection_batch on each detector backend, records the latency and throughput of each,
+# and checks batched and per-frame detection find the same objects.
+#   python -m object_detection.detection_benchmark --debug-dir ./debug_PiA
+#   python -m object_detection.detection_benchmark --synthetic 3 --classes person dog bicycle
+#   python -m object_detection.detection_benchmark --backends ultralytics onnx openvino
+#   python -m object_detection.detection_benchmark --tiled --tile-size 1280 --max-tiles 16
+import os
+import json
+import argparse
+from datetime import datetime
+from time import perf_counter
+import numpy as np
+import cv2
+import torch
+from ultralytics import YOLOWorld
+from object_detection.object_detection import (
+    object_detection,
+    object_detection_batch,
+    object_detection_tiled,
+    tile_shape,
+)
+from object_detection.detector_backends import DETECTOR_BACKENDS, get_detector
+from stitching.stitching_benchmark import findFrameSets, syntheticFrames, _gitVersion
+
+MODEL_PATH = "object_detection/yolo_models/yolov8s-worldv2.pt"
+CLASSES = ["person"]
+# Frames detected on each Pi
+FRAMES_PER_PI = 2
+CONF = 0.1
+RESULTS_DIR = "object_detection/benchmarks"
+
+
+def describe(objects):
+    """Returns the label, box and confidence of each of {objects} in each frame, to compare runs"""
+    return [[(o.label, o.coords, o.conf, o.camera) for o in frame] for frame in objects]
+
+
+def timeDetection(detect, repeats):
+    """Returns the time of each of {repeats} calls of {detect}, and its last result"""
+    times = []
+    for _ in range(repeats):
+        t0 = perf_counter()
+        result = detect()
+        times.append(perf_counter() - t0)
+    return times, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark object detection")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--debug-dir", help="detect in the frames PiA saved here")
+    source.add_argument(
+        "--synthetic", type=int, default=3, help="number of synthetic frame sets"
+    )
+    parser.add_argument("--model", default=MODEL_PATH, help="YOLO-World weights")
+    parser.add_argument("--classes", nargs="+", default=CLASSES)
+    parser.add_argument(
+        "--frames", type=int, default=FRAMES_PER_PI, help="frames per batch"
+    )
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        choices=DETECTOR_BACKENDS,
+        default=["ultralytics"],
+        help="detector backends to run",
+    )
+    parser.add_argument("--int8", action="store_true", help="int8 quantise exports")
+    parser.add_argument(
+        "--tiled", action="store_true", help="also time tiled detection"
+    )
+    parser.add_argument("--tile-size", type=int, default=1280)
+    parser.add_argument("--tile-overlap", type=float, default=0.2)
+    parser.add_argument("--max-tiles", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=3, help="runs of each set")
+    parser.add_argument("--threads", type=int, help="torch CPU threads")
+    parser.add_argument("--output", help="results file, in RESULTS_DIR by default")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    if args.debug_dir:
+        frame_sets = [
+            lambda paths=paths: [cv2.imread(p) for p in paths[: args.frames]]
+            for paths in findFrameSets(args.debug_dir)
+        ]
+    else:
+        frame_sets = [
+            lambda seed=seed: syntheticFrames(seed)[: args.frames]
+            for seed in range(args.synthetic)
+        ]
+    if not frame_sets:
+        raise SystemExit("No frame sets to benchmark")
+
+    model = YOLOWorld(args.model)
+    frame_shape = frame_sets[0]()[0].shape[:2]
+    tiles_shape = tile_shape(
+        frame_shape, args.tile_size, args.tile_overlap, args.max_tiles
+    )
+    backends = {}
+    for backend in args.backends:
+        t0 = perf_counter()
+        detector = get_detector(model, args.classes, backend, args.int8, frame_shape)
+        setup_time = perf_counter() - t0
+        if backend != "ultralytics" and detector is model:
+            print(f"{backend}: could not load, skipped")
+            continue
+        # Exports are made for the shape detected in, so tiles have their own
+        tile_detector = (
+            get_detector(model, args.classes, backend, args.int8, tiles_shape)
+            if args.tiled
+            else None
+        )
+
+        # First predictions set up the predictor and allocate the letterbox buffers
+        warmup = frame_sets[0]()
+        object_detection(detector, warmup[0], 0, CONF)
+        object_detection_batch(detector, warmup, range(len(warmup)), CONF)
+
+        per_frame = []
+        batched = []
+        tiled = []
+        objects = 0
+        tiled_objects = 0
+        mismatches = 0
+        for i, load in enumerate(frame_sets):
+            frames = load()
+            times, single = timeDetection(
+                lambda: [
+                    object_detection(detector, f, c, CONF) for c, f in enumerate(frames)
+                ],
+                args.repeats,
+            )
+            per_frame += times
+            times, batch = timeDetection(
+                lambda: object_detection_batch(
+                    detector, frames, range(len(frames)), CONF
+                ),
+                args.repeats,
+            )
+            batched += times
+
+            same = describe(single) == describe(batch)
+            mismatches += not same
+            objects += sum(map(len, batch))
+
+            if args.tiled:
+                times, tiles = timeDetection(
+                    lambda: [
+                        object_detection_tiled(
+                            tile_detector,
+                            f,
+                            c,
+                            CONF,
+                            args.tile_size,
+                            args.tile_overlap,
+                            args.max_tiles,
+                        )
+                        for c, f in enumerate(frames)
+                    ],
+                    args.repeats,
+                )
+                tiled += times
+                tiled_objects += sum(map(len, tiles))
+                print(
+                    f"{backend} set {i}: tiled {np.mean(times) * 1000:.0f}ms, "
+                    f"{sum(map(len, tiles))} objects"
+                )
+
+            print(
+                f"{backend} set {i}: per frame {np.mean(per_frame[-args.repeats:]) * 1000:.0f}ms, "
+                f"batched {np.mean(batched[-args.repeats:]) * 1000:.0f}ms, "
+                f"{sum(map(len, batch))} objects, {'same' if same else 'DIFFERENT'}"
+            )
+
+        backends[backend] = {
+            "setup_time": setup_time,
+            "frame_latency": {
+                "mean": float(np.mean(per_frame)) / args.frames,
+                "min": float(np.min(per_frame)) / args.frames,
+            },
+            "per_frame": {
+                "mean": float(np.mean(per_frame)),
+                "min": float(np.min(per_frame)),
+            },
+            "batched": {"mean": float(np.mean(batched)), "min": float(np.min(batched))},
+            "objects": objects,
+            "mismatched_sets": mismatches,
+        }
+        if args.tiled:
+            backends[backend]["tiled"] = {
+                "mean": float(np.mean(tiled)),
+                "min": float(np.min(tiled)),
+                "objects": tiled_objects,
+            }
+
+    results = {
+        "version": _gitVersion(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "model": args.model,
+            "classes": args.classes,
+            "frames": args.frames,
+            "int8": args.int8,
+            "tiles": (
+                [args.tile_size, args.tile_overlap, args.max_tiles]
+                if args.tiled
+                else None
+            ),
+            "torch_threads": torch.get_num_threads(),
+            "cpus": os.cpu_count(),
+        },
+        "backends": backends,
+    }
+    for backend, result in backends.items():
+        latency = result["frame_latency"]["mean"]
+        batched = result["batched"]["mean"]
+        print(
+            f"{backend}: {latency * 1000:.0f}ms per frame, "
+            f"batched {args.frames / batched:.2f} frames/s, {result['objects']} objects"
+        )
+        if args.tiled:
+            tiled = result["tiled"]
+            print(
+                f"{backend} tiled: {tiled['mean'] / args.frames * 1000:.0f}ms per frame, "
+                f"{tiled['objects']} objects"
+            )
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"detection_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=4)
+    print(f"Saved results to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# Runs object detection on a CPU-optimised runtime instead of PyTorch.
+# YOLO-World is exported with the classes to detect baked in, to ONNX for ONNX Runtime or to OpenVINO, and the export
+# is cached on disk by a hash of the class list, so it is only exported again when the vocabulary changes.
+# The exported model is run through ultralytics like the PyTorch model, so object_detection works with either.
+# If exporting or loading fails, detection falls back to the PyTorch model.
+# Exports have a fixed input shape, so are made for the shape of the images detected in, whole frames or tiles.
+# The runtimes are optional dependencies, in requirements-detector-backends.txt: onnx and onnxruntime, or openvino.
+import os
+import json
+import shutil
+import hashlib
+import logging
+import importlib.util
+from time import perf_counter
+from ultralytics import YOLO
+from object_detection.class_embeddings import set_classes
+from object_detection.object_detection import letterbox_shape
+
+DETECTOR_BACKENDS = ("ultralytics", "onnx", "openvino")
+EXPORT_DIR = "object_detection/yolo_models/exports"
+# Packages each backend needs to export and run, checked before exporting as ultralytics would otherwise
+# try to pip install them on the Pi
+BACKEND_PACKAGES = {"onnx": ("onnx", "onnxruntime"), "openvino": ("openvino",)}
+# OpenVINO int8 quantisation is calibrated on this dataset, downloaded by ultralytics on first export
+INT8_CALIBRATION_DATA = "coco8.yaml"
+
+# Exported models loaded, export key -> model. Frames and tiles each need their own export
+MAX_LOADED_EXPORTS = 2
+_exports = {}
+
+
+def export_imgsz(model, image_shape):
+    """Returns the (height, width) input shape to export {model} with for images of {image_shape},
+    the shape they are letterboxed to for the model's input size"""
+    imgsz = model.overrides.get("imgsz", 640)
+    stride = max(int(model.model.stride.max()), 32)
+    return letterbox_shape(image_shape, imgsz, stride)[0]
+
+
+def check_backend(backend):
+    """Raises ImportError if a package {backend} needs is not installed"""
+    for package in BACKEND_PACKAGES.get(backend, ()):
+        if importlib.util.find_spec(package) is None:
+            raise ImportError(
+                f"{package} is needed for the {backend} detector backend, see requirements-detector-backends.txt"
+            )
+
+
+def export_key(weights, classes, backend, imgsz, int8=False):
+    """Returns a short hash identifying the export of {weights} for {classes} on {backend} with input shape {imgsz}"""
+    description = [
+        os.path.basename(weights),
+        list(classes),
+        backend,
+        int8,
+        list(imgsz),
+    ]
+    return hashlib.sha1(json.dumps(description).encode()).hexdigest()[:12]
+
+
+def export_path(weights, key, backend):
+    """Returns where the export of {weights} with {key} is cached"""
+    stem = os.path.splitext(os.path.basename(weights))[0]
+    if backend == "onnx":
+        return os.path.join(EXPORT_DIR, f"{stem}_{key}.onnx")
+    return os.path.join(EXPORT_DIR, f"{stem}_{key}_openvino_model")
+
+
+def export_detector(model, classes, path, backend, imgsz, int8=False):
+    """Exports YOLO-World {model} for {classes} on {backend} with input shape {imgsz} to {path}.
+    With {int8}, ONNX exports are quantised by ONNX Runtime, OpenVINO by ultralytics"""
+    set_classes(model, classes)
+    exported = model.export(
+        format=backend,
+        imgsz=list(imgsz),
+        int8=int8 and backend == "openvino",
+        data=INT8_CALIBRATION_DATA if int8 and backend == "openvino" else None,
+    )
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    if backend == "onnx" and int8:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        quantize_dynamic(exported, path, weight_type=QuantType.QUInt8)
+        os.remove(exported)
+    else:
+        os.replace(exported, path)
+
+
+def load_export(model, classes, backend, image_shape, int8=False):
+    """Returns the export of YOLO-World {model} for {classes} on {backend} for images of {image_shape},
+    exporting it if it is not cached"""
+    imgsz = export_imgsz(model, image_shape)
+    key = export_key(model.ckpt_path, classes, backend, imgsz, int8)
+    if key in _exports:
+        return _exports[key]
+
+    # Loading needs the runtime as well as exporting
+    check_backend(backend)
+    path = export_path(model.ckpt_path, key, backend)
+    if not os.path.exists(path):
+        logging.info(f"Exporting detector for {classes} at {imgsz} to {path}")
+        t0 = perf_counter()
+        export_detector(model, classes, path, backend, imgsz, int8)
+        logging.info(f"Exported detector in {perf_counter() - t0:.1f}s")
+
+    detector = YOLO(path, task="detect")
+    # Exports only take their exported shape
+    detector.overrides["imgsz"] = list(imgsz)
+
+    # Keep the most recently loaded exports
+    while len(_exports) >= MAX_LOADED_EXPORTS:
+        _exports.pop(next(iter(_exports)))
+    _exports[key] = detector
+    return detector
+
+
+def get_detector(model, classes, backend="ultralytics", int8=False, image_shape=None):
+    """
+    Returns the model to detect {classes} with on {backend}, "ultralytics", "onnx" or "openvino".
+    "ultralytics" runs YOLO-World {model} itself, other backends run its export for {classes},
+    exported for images of {image_shape}: the frames, or the tiles when detecting in tiles.
+    With {int8}, exports are int8 quantised
+    """
+    classes = list(classes)
+    if backend not in DETECTOR_BACKENDS:
+        raise ValueError(f"Unknown detector backend {backend}")
+
+    if backend != "ultralytics":
+        try:
+            if image_shape is None:
+                raise ValueError(f"The {backend} backend needs the image shape")
+            return load_export(model, classes, backend, image_shape, int8)
+        except Exception:
+            logging.exception(f"Could not detect on {backend}, using ultralytics")
+
+    set_classes(model, classes)
+    return model
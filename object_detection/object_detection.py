@@ -1,4 +1,6 @@
 from ultralytics import YOLOWorld
+from ultralytics.utils import ops
+import torch
 import math
 import cv2
 import numpy as np
@@ -138,14 +140,57 @@ def object_detection(model, frame, camera, conf=0.25):
     """
     logging.debug(f"Detecting objects in frame {camera}")
     detections = model.predict(frame, conf=conf)
+    boxes = detections[0].boxes
+    return detections_to_objects(model, boxes.xyxy, boxes.cls, boxes.conf, camera)
+
+
+def object_detection_batch(model, frames, cameras, conf=0.25):
+    """
+    Detects objects in all frames using YOLO model, in one batch.
+    Frames are letterboxed as ultralytics does into buffers kept between calls, so the objects are the same as
+    from object_detection on each frame.
+    Inputs:
+    -model : YOLO model
+    -frames : image frames to detect objects in
+    -cameras : camera of each frame
+    -conf : confidence threshold for detecting objects (default=0.25)
+    Outputs:
+    -Array of the objects in each frame
+    """
+    cameras = list(cameras)
+
+    # Frames can only be batched if they are letterboxed to the same shape,
+    # and exported models (see detector_backends) are exported for a batch of one
+    exported = not isinstance(model.model, torch.nn.Module)
+    if len({f.shape for f in frames}) != 1 or exported:
+        return [object_detection(model, f, c, conf) for f, c in zip(frames, cameras)]
+
+    logging.debug(f"Detecting objects in frames {cameras}")
+    imgsz = model.overrides.get("imgsz", 640)
+    stride = max(int(model.model.stride.max()), 32)
+    batch = letterbox_batch(frames, imgsz, stride)
+    detections = model.predict(batch, conf=conf)
+
     results = []
-    for box in detections[0].boxes:
-        label = model.names[int(box.cls[0])]
-        coords = box.xyxy.tolist()[0]
-        coords = [round(i) for i in coords]
-        conf = math.ceil((box.conf[0] * 100)) / 100
+    for frame, camera, detection in zip(frames, cameras, detections):
+        # Boxes are in the letterboxed frame
+        boxes = detection.boxes
+        xyxy = ops.scale_boxes(batch.shape[2:], boxes.xyxy.clone(), frame.shape)
+        results.append(
+            detections_to_objects(model, xyxy, boxes.cls, boxes.conf, camera)
+        )
+    return results
+
+
+def detections_to_objects(model, xyxy, cls, conf, camera):
+    """Returns an Object for each detected box, from the box corners {xyxy}, classes {cls} and confidences {conf}"""
+    results = []
+    for coords, c, p in zip(xyxy, cls, conf):
+        label = model.names[int(c)]
+        coords = [round(i) for i in coords.tolist()]
+        p = math.ceil((p * 100)) / 100
         # results.append([label,coords,conf])
-        obj = Object(label=label, coords=coords, conf=conf, camera=camera)
+        obj = Object(label=label, coords=coords, conf=p, camera=camera)
         results.append(obj)
         logging.debug(
             f"Object detected:\n{obj.label}, {obj.coords}, {obj.conf}, {obj.camera}"
@@ -153,6 +198,156 @@ def object_detection(model, frame, camera, conf=0.25):
     return results
 
 
+def letterbox_shape(image_shape, imgsz=640, stride=32):
+    """
+    Finds how an image is letterboxed for the model, as ultralytics' LetterBox with minimal padding.
+    Inputs:
+    -image_shape : shape of the image
+    -imgsz : model input size
+    -stride : model stride, which the letterboxed size is a multiple of
+    Outputs:
+    -(height, width) of the letterboxed image, (width, height) the image is resized to and (left, top) padding
+    """
+    h, w = image_shape[:2]
+    r = min(imgsz / h, imgsz / w)
+    new_w, new_h = int(round(w * r)), int(round(h * r))
+    dw = (imgsz - new_w) % stride / 2
+    dh = (imgsz - new_h) % stride / 2
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    return (top + new_h + bottom, left + new_w + right), (new_w, new_h), (left, top)
+
+
+# Letterboxed frames and the batch tensor made from them, by batch size and letterboxed shape
+_letterbox_buffers = {}
+
+
+def letterbox_batch(frames, imgsz=640, stride=32):
+    """
+    Letterboxes frames of the same shape into a batch tensor, preprocessed as ultralytics does (RGB, 0-1).
+    The padded frames and the tensor are reused by the next batch of the same size, so are overwritten by it.
+    Inputs:
+    -frames : BGR image frames of the same shape
+    -imgsz : model input size
+    -stride : model stride
+    Outputs:
+    -Batch tensor (frames, 3, height, width)
+    """
+    shape, (new_w, new_h), (left, top) = letterbox_shape(frames[0].shape, imgsz, stride)
+    key = (len(frames), shape)
+    if key not in _letterbox_buffers:
+        # Padding is only written once, as each frame is resized into the same region
+        padded = np.full((len(frames), *shape, 3), 114, dtype=np.uint8)
+        batch = torch.empty((len(frames), 3, *shape), dtype=torch.float32)
+        _letterbox_buffers[key] = (padded, batch)
+    padded, batch = _letterbox_buffers[key]
+
+    for i, frame in enumerate(frames):
+        region = padded[i, top : top + new_h, left : left + new_w]
+        cv2.resize(frame, (new_w, new_h), dst=region, interpolation=cv2.INTER_LINEAR)
+        cv2.cvtColor(region, cv2.COLOR_BGR2RGB, dst=region)
+
+    batch.copy_(torch.from_numpy(padded).permute(0, 3, 1, 2))
+    batch /= 255
+    return batch
+
+
+def tile_windows(image_shape, tile_size=1280, overlap=0.2, max_tiles=16):
+    """
+    Splits an image into overlapping tiles, evenly spaced to cover it.
+    Inputs:
+    -image_shape : shape of the image
+    -tile_size : side of each tile in pixels, grown until at most max_tiles tiles cover the image
+    -overlap : fraction of each tile shared with its neighbours
+    -max_tiles : maximum number of tiles
+    Outputs:
+    -Array of tiles [x1, y1, x2, y2]
+    """
+    if max_tiles < 1:
+        raise ValueError(f"max_tiles must be at least 1, not {max_tiles}")
+    if tile_size < 1:
+        raise ValueError(f"tile_size must be at least 1, not {tile_size}")
+    if not 0 <= overlap < 1:
+        raise ValueError(f"overlap must be from 0 up to 1, not {overlap}")
+
+    h, w = image_shape[:2]
+    # Ends once one tile covers the image, if not before
+    while True:
+        tile_w, tile_h = min(tile_size, w), min(tile_size, h)
+        nx = _tile_count(w, tile_w, overlap)
+        ny = _tile_count(h, tile_h, overlap)
+        if nx * ny <= max_tiles:
+            break
+        tile_size = max(int(tile_size * 1.25), tile_size + 1)
+
+    xs = np.linspace(0, w - tile_w, nx).round().astype(int).tolist()
+    ys = np.linspace(0, h - tile_h, ny).round().astype(int).tolist()
+    return [[x, y, x + tile_w, y + tile_h] for y in ys for x in xs]
+
+
+def tile_shape(image_shape, tile_size=1280, overlap=0.2, max_tiles=16):
+    """Returns the (height, width) of the tiles tile_windows splits an image of {image_shape} into"""
+    x1, y1, x2, y2 = tile_windows(image_shape, tile_size, overlap, max_tiles)[0]
+    return y2 - y1, x2 - x1
+
+
+def _tile_count(length, tile_length, overlap):
+    """Number of tiles of {tile_length} overlapping by {overlap} needed to cover {length}"""
+    if tile_length >= length:
+        return 1
+    step = tile_length * (1 - overlap)
+    return math.ceil((length - tile_length) / step) + 1
+
+
+def object_detection_tiled(
+    model,
+    frame,
+    camera,
+    conf=0.25,
+    tile_size=1280,
+    overlap=0.2,
+    max_tiles=16,
+    full_frame=True,
+    iou_threshold=0.5,
+):
+    """
+    Detects objects in overlapping tiles of frame, so small objects are not lost when the frame is downsampled
+    to the model's input size (as SAHI). The tiles are detected in one batch, and detections of the same object
+    in several tiles are merged with non-maximum suppression, matching boxes by intersection over the smaller box
+    so the part of an object cut off by a tile's edge is merged into the whole.
+    Inputs:
+    -model : YOLO model
+    -frame : image frame to detect objects in
+    -camera : camera of the frame
+    -conf : confidence threshold for detecting objects (default=0.25)
+    -tile_size, overlap, max_tiles : tiling, see tile_windows
+    -full_frame : also detect in the whole frame, for objects larger than a tile
+    -iou_threshold : overlap of boxes of the same class to consider as duplicate
+    Outputs:
+    -Array of objects
+    """
+    windows = tile_windows(frame.shape, tile_size, overlap, max_tiles)
+    logging.debug(f"Detecting objects in {len(windows)} tiles of frame {camera}")
+    tiles = [frame[y1:y2, x1:x2] for x1, y1, x2, y2 in windows]
+    detections = object_detection_batch(model, tiles, [camera] * len(tiles), conf)
+
+    objects = []
+    for (x1, y1, _, _), tile_objects in zip(windows, detections):
+        for obj in tile_objects:
+            # Move from the tile into the frame
+            obj.adjust_xyxy(x1, y1, x1, y1)
+            obj.coords_original = obj.coords
+            objects.append(obj)
+    if full_frame and len(windows) > 1:
+        objects += object_detection(model, frame, camera, conf)
+
+    if not objects:
+        return objects
+    boxes, scores, classes = _object_arrays(objects)
+    keep = nms(boxes, scores, classes, iou_threshold, metric="ios")
+    return [objects[i] for i in keep]
+
+
 def assign_id(objects):
     id = 0
     for i in range(len(objects)):
@@ -258,44 +453,170 @@ def calculate_iou(bbA, bbB):
     return iou
 
 
-def non_maximum_suppression(objects, iou_threshold=0.5):
+def box_iou(boxes1, boxes2, metric="iou"):
     """
-    Perform Non-Maximum Suppression to remove duplicate boxes.
+    Overlap of every box in boxes1 with every box in boxes2.
     Inputs:
-        -objects: [[class_name, (x1, y1, x2, y2), confidence], ...]
-        -iou_threshold (float): IoU threshold to consider as duplicate
+    -boxes1 : (N, 4) array of boxes [x1, y1, x2, y2]
+    -boxes2 : (M, 4) array of boxes [x1, y1, x2, y2]
+    -metric : "iou" intersection over union, or "ios" intersection over the smaller box
+    Outputs:
+    -(N, M) array of overlaps
+    """
+    boxes1 = np.asarray(boxes1, dtype=np.float32)
+    boxes2 = np.asarray(boxes2, dtype=np.float32)
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+
+    top_left = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    bottom_right = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+
+    if metric == "ios":
+        denominator = np.minimum(area1[:, None], area2[None, :])
+    elif metric == "iou":
+        denominator = area1[:, None] + area2[None, :] - intersection
+    else:
+        raise ValueError(f"Unknown overlap metric {metric}")
+    return intersection / np.maximum(denominator, np.finfo(np.float32).eps)
+
+
+def nms(boxes, scores, classes=None, iou_threshold=0.5, metric="iou", method="numpy"):
+    """
+    Non-maximum suppression over arrays of boxes.
+    Boxes of each class are suppressed with one overlap matrix per class.
+    Inputs:
+    -boxes : (N, 4) array of boxes [x1, y1, x2, y2]
+    -scores : (N,) confidence of each box
+    -classes : (N,) class of each box, only boxes of the same class suppress each other (default=all the same)
+    -iou_threshold (float): overlap to consider as duplicate, not used by "soft"
+    -metric : overlap metric, see box_iou
+    -method : "numpy", "cv2" for OpenCV's NMSBoxesBatched (IoU only) or "soft", see soft_nms.
+        "soft" removes boxes whose decayed score falls below the score_threshold of soft_nms, not by iou_threshold
     Returns:
-        -list: Filtered list of objects with unique detections
+    -Indices of the boxes kept, highest score first
     """
-    # Sort objects by confidence score in descending order
-    logging.debug("Performing non maximum suppression")
-    objects = sorted(objects, key=lambda x: x.conf, reverse=True)
-
-    selected_objects = []
-    # Loop while unfiltered objects remaining
-    while len(objects) > 0:
-        # Select the object with the highest score
-        current_object = objects[0]
-        selected_objects.append(current_object)
-        objects = objects[1:]
-
-        filtered_objects = []
-        for obj in objects:
-            # Check if the current and candidate objects are of the same class
-            if current_object.label == obj.label:
-                # Calculate IoU between the selected and remaining boxes
-                iou = calculate_iou(current_object.get_xyxy(), obj.get_xyxy())
-                # Keep the object if IoU is below the threshold
-                if iou < iou_threshold:
-                    filtered_objects.append(obj)
-            else:
-                # Keep objects of different classes
-                filtered_objects.append(obj)
+    boxes = np.asarray(boxes, dtype=np.float32)
+    scores = np.asarray(scores, dtype=np.float32)
+    classes = np.zeros(len(boxes), dtype=int) if classes is None else np.asarray(classes)
+    if len(boxes) == 0:
+        return []
+    if method == "soft":
+        return soft_nms(boxes, scores, classes, metric=metric)[0]
+    if method == "cv2":
+        return _nms_cv2(boxes, scores, classes, iou_threshold, metric)
+    if method != "numpy":
+        raise ValueError(f"Unknown non-maximum suppression method {method}")
+
+    order = np.argsort(-scores, kind="stable")
+    keep = []
+    for c in np.unique(classes):
+        group = order[classes[order] == c]
+        overlaps = box_iou(boxes[group], boxes[group], metric) >= iou_threshold
+        suppressed = np.zeros(len(group), dtype=bool)
+        for i in range(len(group)):
+            if not suppressed[i]:
+                keep.append(group[i])
+                suppressed |= overlaps[i]
+
+    # Back into order of score across classes
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(len(order))
+    return [int(i) for i in sorted(keep, key=lambda i: rank[i])]
+
+
+def _nms_cv2(boxes, scores, classes, iou_threshold, metric="iou"):
+    """nms with OpenCV, which only compares boxes by IoU"""
+    if metric != "iou":
+        raise ValueError("OpenCV non-maximum suppression only supports IoU")
+    xywh = boxes.copy()
+    xywh[:, 2:] -= xywh[:, :2]
+    keep = cv2.dnn.NMSBoxesBatched(
+        xywh.tolist(), scores.tolist(), classes.tolist(), 0.0, iou_threshold
+    )
+    return np.asarray(keep, dtype=int).ravel().tolist()
 
-        objects = filtered_objects
 
+def soft_nms(
+    boxes, scores, classes=None, sigma=0.5, score_threshold=0.1, metric="iou"
+):
+    """
+    Soft non-maximum suppression (Bodla et al. 2017). Rather than removing boxes overlapping a kept box,
+    their scores are decayed by exp(-overlap^2 / sigma), so overlapping objects with high scores survive.
+    Inputs:
+    -boxes : (N, 4) array of boxes [x1, y1, x2, y2]
+    -scores : (N,) confidence of each box
+    -classes : (N,) class of each box, only boxes of the same class decay each other (default=all the same)
+    -sigma : width of the Gaussian decay
+    -score_threshold : boxes whose decayed score falls below this are removed
+    -metric : overlap metric, see box_iou
+    Returns:
+    -Indices of the boxes kept, highest decayed score first, and their decayed scores
+    """
+    boxes = np.asarray(boxes, dtype=np.float32)
+    scores = np.array(scores, dtype=np.float64)
+    overlaps = box_iou(boxes, boxes, metric)
+    if classes is not None:
+        classes = np.asarray(classes)
+        overlaps[classes[:, None] != classes[None, :]] = 0
+
+    remaining = np.ones(len(scores), dtype=bool)
+    keep = []
+    while remaining.any():
+        i = int(np.argmax(np.where(remaining, scores, -np.inf)))
+        if scores[i] < score_threshold:
+            break
+        keep.append(i)
+        remaining[i] = False
+        scores[remaining] *= np.exp(-(overlaps[i, remaining] ** 2) / sigma)
+    return keep, scores[keep]
+
+
+def _object_arrays(objects):
+    """Returns the boxes, confidences and class indices of {objects} as arrays"""
+    boxes = np.array([obj.get_xyxy() for obj in objects], dtype=np.float32)
+    scores = np.array([obj.conf for obj in objects], dtype=np.float32)
+    classes = np.unique([obj.label for obj in objects], return_inverse=True)[1]
+    return boxes, scores, classes
+
+
+def non_maximum_suppression_indices(objects, iou_threshold=0.5, method="numpy"):
+    """
+    Perform Non-Maximum Suppression to find duplicate objects, over arrays of their boxes.
+    Inputs:
+        -objects: list of Object
+        -iou_threshold (float): IoU threshold to consider as duplicate, not used by "soft"
+        -method : "numpy", "cv2" or "soft", see nms
+    Returns:
+        -list: Indices into objects of the unique detections, highest confidence first
+    """
+    if not objects:
+        return []
+    boxes, scores, classes = _object_arrays(objects)
+    return nms(boxes, scores, classes, iou_threshold, method=method)
+
+
+def non_maximum_suppression(objects, iou_threshold=0.5, method="numpy"):
+    """
+    Perform Non-Maximum Suppression to remove duplicate boxes.
+    Inputs:
+        -objects: list of Object
+        -iou_threshold (float): IoU threshold to consider as duplicate, not used by "soft"
+        -method : "numpy", "cv2" or "soft", see nms.
+            With "soft", objects are removed by the score_threshold of soft_nms
+            and the confidence of each object kept is set to its decayed score
+    Returns:
+        -list: Filtered list of objects with unique detections, highest confidence first
+    """
+    logging.debug("Performing non maximum suppression")
+    if method == "soft" and objects:
+        keep, scores = soft_nms(*_object_arrays(objects))
+        for i, score in zip(keep, scores):
+            objects[i].conf = float(score)
+    else:
+        keep = non_maximum_suppression_indices(objects, iou_threshold, method)
     logging.debug("Non-maximum suppression complete")
-    return selected_objects
+    return [objects[i] for i in keep]
 
 
 def split_panorama(image):
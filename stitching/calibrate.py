@@ -0,0 +1,177 @@
+# Headless calibration of the transforms placing each camera in the panorama.
+# Features are only found in the strips where neighbouring cameras overlap, with every strip processed in parallel,
+# and matched with FLANN. The transforms are written to a versioned calibration file,
+# which stitching_main loads at startup in place of its hard-coded transforms.
+import os
+import json
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from stitching.stitching_functions import (
+    PROJECTION_COEFFICIENTS,
+    getProjectionMaps,
+    getProjectionCrop,
+    detectStripFeatures,
+    matchFeatures,
+)
+
+TRANSFORMS_VERSION = 1
+# Width of the strip searched for features either side of each overlap
+OVERLAP_WIDTH = 500
+RANSAC_THRESHOLD = 3
+MIN_INLIERS = 10
+
+
+def projectImages(images, coefficients=PROJECTION_COEFFICIENTS):
+    """Applies the cropped cylindrical projection to each of {images}, as stitchImages"""
+    h, w = images[0].shape[:2]
+    map_x, map_y = getProjectionMaps(w, h, coefficients)
+    x, y, crop_w, crop_h = getProjectionCrop(map_x, map_y)
+    map_x = map_x[y : y + crop_h, x : x + crop_w]
+    map_y = map_y[y : y + crop_h, x : x + crop_w]
+    return [cv2.remap(image, map_x, map_y, cv2.INTER_LINEAR) for image in images]
+
+
+def estimatePairTransform(points1, points2, translation_only=True):
+    """
+    Estimates the transform taking {points2} in one image to the matching {points1} in its neighbour, with RANSAC.
+    With {translation_only}, the median shift of the RANSAC inliers is used, as the stitcher's transforms are translations.
+    Returns the 2x3 matrix and the number of inliers
+    """
+    if len(points1) < 3:
+        return None, 0
+
+    matrix, inliers = cv2.estimateAffine2D(
+        points2,
+        points1,
+        method=cv2.RANSAC,
+        ransacReprojThreshold=RANSAC_THRESHOLD,
+        confidence=0.999,
+    )
+    if matrix is None:
+        return None, 0
+
+    inliers = inliers.ravel().astype(bool)
+    if translation_only:
+        tx, ty = np.median(points1[inliers] - points2[inliers], axis=0)
+        matrix = np.array([[1, 0, tx], [0, 1, ty]], dtype=np.float64)
+    return matrix, int(inliers.sum())
+
+
+def calibrateTransforms(
+    images,
+    overlap=OVERLAP_WIDTH,
+    translation_only=True,
+    threads=None,
+    coefficients=PROJECTION_COEFFICIENTS,
+):
+    """
+    Finds the transform placing each of {images} after the first in the panorama, as used by stitchImages.
+    Returns the transforms and a report of the matches between each pair of neighbouring images.
+    Raises ValueError if a pair does not have enough matches to calibrate
+    """
+    projected = projectImages(images, coefficients)
+
+    # Right strip of every image but the last, left strip of every image but the first
+    strips = [(i, "right") for i in range(len(images) - 1)]
+    strips += [(i, "left") for i in range(1, len(images))]
+
+    def detect(strip):
+        i, side = strip
+        return detectStripFeatures(projected[i], side, overlap)
+
+    with ThreadPoolExecutor(threads or len(strips)) as executor:
+        features = dict(zip(strips, executor.map(detect, strips)))
+
+    transforms = []
+    report = []
+    placement = np.eye(3)
+    for i in range(len(images) - 1):
+        points1, des1 = features[(i, "right")]
+        points2, des2 = features[(i + 1, "left")]
+        idx1, idx2 = matchFeatures(des1, des2)
+        matrix, inliers = estimatePairTransform(
+            points1[idx1], points2[idx2], translation_only
+        )
+        logging.debug(
+            f"Cameras {i} and {i + 1}: {len(idx1)} matches, {inliers} inliers"
+        )
+        report.append({"cameras": [i, i + 1], "matches": len(idx1), "inliers": inliers})
+
+        if matrix is None or inliers < MIN_INLIERS:
+            raise ValueError(
+                f"Only {inliers} inliers between cameras {i} and {i + 1}, need {MIN_INLIERS}"
+            )
+
+        # Chain onto the placement of the previous image
+        placement = placement @ np.vstack([matrix, [0, 0, 1]])
+        transforms.append(placement[:2].copy())
+
+    return transforms, report
+
+
+def saveTransforms(
+    path, transforms, image_shape, report=None, coefficients=PROJECTION_COEFFICIENTS
+):
+    """Writes {transforms} to the calibration file at {path}. An existing file is kept, renamed by its calibration time"""
+    if os.path.exists(path):
+        try:
+            with open(path, "r") as file:
+                calibrated = json.load(file)["calibrated"]
+        except (OSError, ValueError, KeyError):
+            calibrated = datetime.fromtimestamp(os.path.getmtime(path)).isoformat()
+        root, ext = os.path.splitext(path)
+        os.replace(path, f"{root}_{calibrated.replace(':', '')}{ext}")
+
+    data = {
+        "version": TRANSFORMS_VERSION,
+        "calibrated": datetime.now().isoformat(timespec="seconds"),
+        "image_shape": list(image_shape[:2]),
+        "projection_coefficients": list(coefficients),
+        "transforms": [np.asarray(m).tolist() for m in transforms],
+        "pairs": report or [],
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as file:
+        json.dump(data, file, indent=4)
+    logging.info(f"Saved stitching transforms to {path}")
+
+
+def loadTransforms(path, image_shape=None, coefficients=PROJECTION_COEFFICIENTS):
+    """Returns the transforms in the calibration file at {path}, or None if there is no usable file.
+    A file calibrated from images of another shape than {image_shape}, if given,
+    or with other projection {coefficients} is not usable"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as file:
+            data = json.load(file)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read stitching transforms from {path}: {e}")
+        return None
+
+    if data.get("version") != TRANSFORMS_VERSION:
+        logging.warning(
+            f"Stitching transforms at {path} are version {data.get('version')}, expected {TRANSFORMS_VERSION}"
+        )
+        return None
+
+    if image_shape is not None and data.get("image_shape") != list(image_shape[:2]):
+        logging.warning(
+            f"Stitching transforms at {path} are for images of {data.get('image_shape')}, expected {list(image_shape[:2])}"
+        )
+        return None
+
+    calibrated_coefficients = data.get("projection_coefficients")
+    if calibrated_coefficients is None or not np.allclose(
+        calibrated_coefficients, coefficients
+    ):
+        logging.warning(
+            f"Stitching transforms at {path} are for projection coefficients {calibrated_coefficients}, expected {list(coefficients)}"
+        )
+        return None
+
+    logging.debug(f"Loaded stitching transforms calibrated {data['calibrated']}")
+    return [np.array(m, dtype=np.float64) for m in data["transforms"]]
@@ -0,0 +1,130 @@
+# Exposure matching between cameras.
+# Per-camera, per-channel gains are estimated from where neighbouring cameras overlap, sampled on a coarse grid
+# so no full frame is copied or converted to float, smoothed over recent scans, and applied with a uint8 LUT.
+import logging
+import numpy as np
+import cv2
+from stitching.stitching_functions import PROJECTION_COEFFICIENTS
+from stitching.panorama_maps import (
+    getPanoramaGeometry,
+    getPanoramaOverlaps,
+    buildCameraMaps,
+)
+
+# Sample every SAMPLE_STEP pixels of each overlap
+SAMPLE_STEP = 8
+
+# Noise in the overlap means, as in OpenCV's GainCompensator, and how far gains may stray from 1.
+# OpenCV's 0.1 holds gains too close to 1 to correct the exposure differences between these cameras
+SIGMA_N = 10.0
+SIGMA_G = 0.3
+
+# Samples this bright are likely clipped, so say nothing about exposure
+SATURATED = 250
+
+
+def buildOverlapSampleMaps(
+    image_shape,
+    transforms,
+    crop,
+    step=SAMPLE_STEP,
+    coefficients=PROJECTION_COEFFICIENTS,
+):
+    """
+    Builds maps sampling every {step} pixels of each overlap between neighbouring cameras, from both cameras.
+    Returns a list of (camera i, camera i + 1, maps into i, maps into i + 1)
+    """
+    projection, (_, pano_h), _ = getPanoramaGeometry(
+        image_shape, transforms, crop, coefficients
+    )
+    placements = [np.array([[1, 0, 0], [0, 1, 0]], dtype=np.float64)] + [
+        np.asarray(m, dtype=np.float64) for m in transforms
+    ]
+
+    sample_maps = []
+    for i, columns in enumerate(
+        getPanoramaOverlaps(image_shape, transforms, crop, coefficients)
+    ):
+        maps = [
+            buildCameraMaps(
+                columns,
+                placements[j],
+                image_shape,
+                projection,
+                crop,
+                pano_h,
+                False,
+                coefficients,
+                step,
+            )
+            for j in (i, i + 1)
+        ]
+        sample_maps.append((i, i + 1, maps[0], maps[1]))
+    return sample_maps
+
+
+def estimateGains(images, sample_maps, sigma_n=SIGMA_N, sigma_g=SIGMA_G):
+    """
+    Estimates the gain of each channel of each of {images} that best matches their overlaps, sampled with {sample_maps}.
+    Minimises, per channel, the sum over overlaps of
+        N_ij * ((g_i I_ij - g_j I_ji)^2 / sigma_n^2 + (1 - g_i)^2 / sigma_g^2)
+    where I_ij is the mean of image i over its overlap with image j. Returns (cameras, 3) gains
+    """
+    n = len(images)
+    A = np.zeros((3, n, n))
+    b = np.zeros((3, n))
+
+    for i, j, maps_i, maps_j in sample_maps:
+        samples_i = cv2.remap(images[i], *maps_i, cv2.INTER_NEAREST)
+        samples_j = cv2.remap(images[j], *maps_j, cv2.INTER_NEAREST)
+
+        # Only pixels seen by both, and not clipped in either
+        valid = (
+            (samples_i.max(axis=2) > 0)
+            & (samples_j.max(axis=2) > 0)
+            & (samples_i.max(axis=2) < SATURATED)
+            & (samples_j.max(axis=2) < SATURATED)
+        )
+        count = int(valid.sum())
+        if count == 0:
+            logging.debug(f"No usable overlap between cameras {i} and {j}")
+            continue
+
+        mean_i = samples_i[valid].mean(axis=0)
+        mean_j = samples_j[valid].mean(axis=0)
+        for c in range(3):
+            A[c, i, i] += count * (mean_i[c] ** 2 / sigma_n**2 + 1 / sigma_g**2)
+            A[c, j, j] += count * (mean_j[c] ** 2 / sigma_n**2 + 1 / sigma_g**2)
+            A[c, i, j] -= count * mean_i[c] * mean_j[c] / sigma_n**2
+            A[c, j, i] -= count * mean_i[c] * mean_j[c] / sigma_n**2
+            b[c, i] += count / sigma_g**2
+            b[c, j] += count / sigma_g**2
+
+    gains = np.ones((n, 3))
+    for c in range(3):
+        # Cameras with no usable overlap keep a gain of 1
+        seen = np.diag(A[c]) > 0
+        if seen.any():
+            gains[seen, c] = np.linalg.solve(A[c][np.ix_(seen, seen)], b[c, seen])
+    return gains
+
+
+def smoothGains(previous, gains, weight):
+    """Blends new {gains} into the {previous} gains, {weight} being the share of the new gains"""
+    if previous is None:
+        return gains
+    return (1 - weight) * previous + weight * gains
+
+
+def gainLUTs(gains):
+    """Returns a cv2.LUT table (256, 1, 3) applying each camera's channel gains, for each of {gains}"""
+    levels = np.arange(256, dtype=np.float64)[:, None, None]
+    return [
+        np.clip(np.round(levels * g[None, None, :]), 0, 255).astype(np.uint8)
+        for g in np.asarray(gains)
+    ]
+
+
+def applyGains(image, lut, out=None):
+    """Applies the gains in {lut} to {image}, in place if {out} is {image}"""
+    return cv2.LUT(image, lut, dst=out)
@@ -0,0 +1,380 @@
+# Precomputed remap maps taking each camera image straight to its part of the panorama.
+# The cylindrical projection, the translation of each camera and the final crop are all fixed,
+# so they are composed once into one map per camera and cached on disk.
+# Stitching is then one remap per camera into a preallocated panorama, plus a feathered blend across each seam.
+import os
+import logging
+from time import perf_counter
+import numpy as np
+import cv2
+from stitching.stitching_functions import (
+    PROJECTION_COEFFICIENTS,
+    cylindricalSourceCoords,
+    getProjectionMaps,
+    getProjectionCrop,
+    featherWeights,
+    featherBlend,
+)
+
+MAPS_VERSION = 2
+
+
+def getPanoramaGeometry(
+    image_shape, transforms, crop, coefficients=PROJECTION_COEFFICIENTS
+):
+    """
+    Works out where each camera lands in the panorama, matching the legacy
+    remap + applyTransform + crop pipeline.
+    Returns the projected crop (x, y, w, h), the panorama size (width, height),
+    and the panorama column range drawn from each camera
+    """
+    h, w = image_shape[:2]
+    map_x, map_y = getProjectionMaps(w, h, coefficients)
+    x0, y0, proj_w, proj_h = getProjectionCrop(map_x, map_y)
+
+    canvas_w, canvas_h, lefts, rights = _placementExtents(proj_w, proj_h, transforms)
+
+    top, bottom, left, right = crop
+    pano_w = canvas_w - left - right
+    pano_h = canvas_h - top - bottom
+
+    # Each camera is drawn up to the middle of its overlap with the next
+    seams = [0]
+    for i in range(len(transforms)):
+        seams.append(int(round((lefts[i + 1] + rights[i]) / 2)) - left)
+    seams.append(pano_w)
+    seams = np.clip(seams, 0, pano_w)
+    regions = [(int(seams[i]), int(seams[i + 1])) for i in range(len(seams) - 1)]
+
+    return (x0, y0, proj_w, proj_h), (pano_w, pano_h), regions
+
+
+def _placementExtents(proj_w, proj_h, transforms):
+    """Canvas size and the left and right edge of each placed image, as applyTransform"""
+    # Canvas grows as each image is placed
+    corners = np.array(
+        [[[0, 0], [proj_w, 0], [0, proj_h], [proj_w, proj_h]]], dtype=np.float32
+    )
+    canvas_w, canvas_h = proj_w, proj_h
+    lefts, rights = [0.0], [float(proj_w)]
+    for matrix in transforms:
+        new_corners = cv2.transform(corners, matrix)[0]
+        canvas_w = int(np.max(new_corners[:, 0]))
+        canvas_h = max(canvas_h, int(np.max(new_corners[:, 1])))
+        lefts.append(float(np.min(new_corners[:, 0])))
+        rights.append(float(np.max(new_corners[:, 0])))
+    return canvas_w, canvas_h, lefts, rights
+
+
+def getPanoramaOverlaps(
+    image_shape, transforms, crop, coefficients=PROJECTION_COEFFICIENTS
+):
+    """Returns the panorama columns (start, end) where each pair of neighbouring cameras overlap"""
+    (_, _, proj_w, proj_h), (pano_w, _), _ = getPanoramaGeometry(
+        image_shape, transforms, crop, coefficients
+    )
+    _, _, lefts, rights = _placementExtents(proj_w, proj_h, transforms)
+    left = crop[2]
+    return [
+        (
+            int(np.clip(np.ceil(lefts[i + 1]) - left, 0, pano_w)),
+            int(np.clip(np.floor(rights[i]) - left, 0, pano_w)),
+        )
+        for i in range(len(transforms))
+    ]
+
+
+def buildCameraMaps(
+    columns,
+    matrix,
+    image_shape,
+    projection,
+    crop,
+    pano_h,
+    fixed_point,
+    coefficients=PROJECTION_COEFFICIENTS,
+    step=1,
+):
+    """Remap maps drawing panorama {columns} (start, end) from the camera placed with {matrix}.
+    With {step}, only every step-th row and column of the panorama is drawn"""
+    h, w = image_shape[:2]
+    x0, y0, proj_w, proj_h = projection
+    top, _, left, _ = crop
+    start, end = columns
+
+    # Canvas co-ordinates of these panorama columns
+    X, Y = np.meshgrid(
+        np.arange(start, end, step, dtype=np.float64) + left,
+        np.arange(0, pano_h, step, dtype=np.float64) + top,
+    )
+
+    # Back through the camera's placement to the cropped cylindrical projection
+    inverse = cv2.invertAffineTransform(matrix)
+    xp = inverse[0, 0] * X + inverse[0, 1] * Y + inverse[0, 2]
+    yp = inverse[1, 0] * X + inverse[1, 1] * Y + inverse[1, 2]
+    inside = (xp >= 0) & (xp < proj_w) & (yp >= 0) & (yp < proj_h)
+
+    # Then through the cylindrical projection to the camera image
+    map_x, map_y = cylindricalSourceCoords(xp + x0, yp + y0, w, h, coefficients)
+    map_x = map_x.astype(np.float32)
+    map_y = map_y.astype(np.float32)
+    map_x[~inside] = -1
+    map_y[~inside] = -1
+
+    if fixed_point:
+        map_x, map_y = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+    return map_x, map_y
+
+
+def buildPanoramaMaps(
+    image_shape,
+    transforms,
+    crop,
+    fixed_point=True,
+    coefficients=PROJECTION_COEFFICIENTS,
+    feather_width=0,
+):
+    """
+    Composes the cylindrical projection, camera placement and crop into one pair of remap maps per camera.
+    Panorama pixels with no source pixel map to -1 so remap leaves them black.
+    With {fixed_point}, maps are converted to the faster CV_16SC2 format with cv2.convertMaps.
+    With {feather_width}, also builds maps of both neighbouring cameras for a band of that width around each seam
+    """
+    projection, (pano_w, pano_h), regions = getPanoramaGeometry(
+        image_shape, transforms, crop, coefficients
+    )
+    placements = [np.array([[1, 0, 0], [0, 1, 0]], dtype=np.float64)] + [
+        np.asarray(m, dtype=np.float64) for m in transforms
+    ]
+
+    def cameraMaps(columns, matrix):
+        return buildCameraMaps(
+            columns,
+            matrix,
+            image_shape,
+            projection,
+            crop,
+            pano_h,
+            fixed_point,
+            coefficients,
+        )
+
+    maps = [cameraMaps(region, matrix) for region, matrix in zip(regions, placements)]
+
+    # Band either side of the seam between each pair of cameras, kept within both cameras' regions
+    seams = []
+    seam_maps = []
+    if feather_width > 0:
+        for i in range(len(regions) - 1):
+            seam = regions[i][1]
+            start = max(seam - feather_width // 2, regions[i][0])
+            end = min(start + feather_width, regions[i + 1][1])
+            seams.append((start, end))
+            seam_maps.append(
+                (
+                    cameraMaps((start, end), placements[i]),
+                    cameraMaps((start, end), placements[i + 1]),
+                )
+            )
+
+    return {
+        "shape": (pano_h, pano_w),
+        "regions": regions,
+        "maps": maps,
+        "seams": seams,
+        "seam_maps": seam_maps,
+    }
+
+
+def _cacheKey(image_shape, transforms, crop, fixed_point, coefficients, feather_width):
+    return np.concatenate(
+        [
+            [MAPS_VERSION, image_shape[0], image_shape[1], fixed_point, feather_width],
+            np.ravel(transforms),
+            np.ravel(crop),
+            np.ravel(coefficients),
+        ]
+    ).astype(np.float64)
+
+
+def savePanoramaMaps(path, panorama_maps, key):
+    arrays = {
+        "key": key,
+        "shape": np.array(panorama_maps["shape"]),
+        "regions": np.array(panorama_maps["regions"]),
+        "seams": np.array(panorama_maps["seams"]).reshape(-1, 2),
+    }
+    for i, (map1, map2) in enumerate(panorama_maps["maps"]):
+        arrays[f"map1_{i}"] = map1
+        arrays[f"map2_{i}"] = map2
+    for i, ((left1, left2), (right1, right2)) in enumerate(panorama_maps["seam_maps"]):
+        arrays[f"seam_left1_{i}"] = left1
+        arrays[f"seam_left2_{i}"] = left2
+        arrays[f"seam_right1_{i}"] = right1
+        arrays[f"seam_right2_{i}"] = right2
+    np.savez(path, **arrays)
+
+
+def loadPanoramaMaps(
+    path,
+    image_shape,
+    transforms,
+    crop,
+    fixed_point=True,
+    coefficients=PROJECTION_COEFFICIENTS,
+    feather_width=0,
+):
+    """
+    Loads the panorama maps cached at {path}, rebuilding and saving them if the
+    cache is missing or was built for a different geometry
+    """
+    key = _cacheKey(
+        image_shape, transforms, crop, fixed_point, coefficients, feather_width
+    )
+
+    if os.path.exists(path):
+        with np.load(path) as data:
+            if np.array_equal(data["key"], key):
+                regions = [tuple(r) for r in data["regions"].tolist()]
+                seams = [tuple(s) for s in data["seams"].tolist()]
+                logging.debug(f"Loaded panorama maps from {path}")
+                return {
+                    "shape": tuple(data["shape"].tolist()),
+                    "regions": regions,
+                    "maps": [
+                        (data[f"map1_{i}"], data[f"map2_{i}"])
+                        for i in range(len(regions))
+                    ],
+                    "seams": seams,
+                    "seam_maps": [
+                        (
+                            (data[f"seam_left1_{i}"], data[f"seam_left2_{i}"]),
+                            (data[f"seam_right1_{i}"], data[f"seam_right2_{i}"]),
+                        )
+                        for i in range(len(seams))
+                    ],
+                }
+        logging.info(f"Panorama maps at {path} are out of date, rebuilding")
+
+    logging.debug("Building panorama maps")
+    panorama_maps = buildPanoramaMaps(
+        image_shape, transforms, crop, fixed_point, coefficients, feather_width
+    )
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    savePanoramaMaps(path, panorama_maps, key)
+    logging.debug(f"Saved panorama maps to {path}")
+    return panorama_maps
+
+
+def remapPanorama(
+    images, panorama_maps, out=None, executor=None, timings=None, luts=None
+):
+    """
+    Draws each of {images} straight into its part of the panorama, then feathers the seams
+    between them if the maps have seam bands. {out} is reused if given.
+    With {luts}, each camera's pixels are passed through its cv2.LUT table, such as from gainLUTs, as they are drawn.
+    Cameras, then seams, are drawn concurrently on {executor} if given, as cv2.remap releases the GIL.
+    If {timings} is a dict, the seconds taken for each camera and each seam are added to it
+    """
+    pano_h, pano_w = panorama_maps["shape"]
+    if out is None:
+        out = np.empty((pano_h, pano_w, 3), dtype=np.uint8)
+
+    def drawCamera(i):
+        t0 = perf_counter()
+        start, end = panorama_maps["regions"][i]
+        map1, map2 = panorama_maps["maps"][i]
+        cv2.remap(
+            images[i],
+            map1,
+            map2,
+            cv2.INTER_LINEAR,
+            dst=out[:, start:end],
+            borderMode=cv2.BORDER_CONSTANT,
+        )
+        if luts is not None:
+            cv2.LUT(out[:, start:end], luts[i], dst=out[:, start:end])
+        return perf_counter() - t0
+
+    def drawSeam(i):
+        # Redraw the seam band from both cameras, blended across the band
+        t0 = perf_counter()
+        start, end = panorama_maps["seams"][i]
+        left_maps, right_maps = panorama_maps["seam_maps"][i]
+        left = cv2.remap(images[i], *left_maps, cv2.INTER_LINEAR)
+        right = cv2.remap(images[i + 1], *right_maps, cv2.INTER_LINEAR)
+        if luts is not None:
+            cv2.LUT(left, luts[i], dst=left)
+            cv2.LUT(right, luts[i + 1], dst=right)
+        featherBlend(left, right, featherWeights(end - start), out[:, start:end])
+        return perf_counter() - t0
+
+    # Seam bands overlap the cameras' regions, so are only drawn once every camera is
+    run = map if executor is None else executor.map
+    camera_times = list(run(drawCamera, range(len(panorama_maps["regions"]))))
+    seam_times = list(run(drawSeam, range(len(panorama_maps["seams"]))))
+
+    if timings is not None:
+        timings["cameras"] = camera_times
+        timings["seams"] = seam_times
+    return out
+
+
+if __name__ == "__main__":
+    # Build and cache the maps for the cameras' full resolution, and time stitching with them
+    from concurrent.futures import ThreadPoolExecutor
+    from stitching.stitching_main import (
+        TRANSFORMS,
+        PANORAMA_CROP,
+        PANORAMA_MAPS_PATH,
+        PANORAMA_MAPS_FIXED_POINT,
+        SEAM_FEATHER_WIDTH,
+    )
+
+    RESOLUTION = (4608, 2592)
+    image_shape = (RESOLUTION[1], RESOLUTION[0], 3)
+
+    t0 = perf_counter()
+    panorama_maps = buildPanoramaMaps(
+        image_shape,
+        TRANSFORMS,
+        PANORAMA_CROP,
+        PANORAMA_MAPS_FIXED_POINT,
+        feather_width=SEAM_FEATHER_WIDTH,
+    )
+    savePanoramaMaps(
+        PANORAMA_MAPS_PATH,
+        panorama_maps,
+        _cacheKey(
+            image_shape,
+            TRANSFORMS,
+            PANORAMA_CROP,
+            PANORAMA_MAPS_FIXED_POINT,
+            PROJECTION_COEFFICIENTS,
+            SEAM_FEATHER_WIDTH,
+        ),
+    )
+    print(
+        f"Built panorama maps in {perf_counter() - t0:.2f}s, saved to {PANORAMA_MAPS_PATH}"
+    )
+    print(
+        f"Panorama {panorama_maps['shape'][1]}x{panorama_maps['shape'][0]}, camera columns {panorama_maps['regions']}, seams {panorama_maps['seams']}"
+    )
+
+    images = [np.full(image_shape, 128, dtype=np.uint8)] * 4
+    out = remapPanorama(images, panorama_maps)
+    t0 = perf_counter()
+    remapPanorama(images, panorama_maps, out)
+    print(f"Stitched in {perf_counter() - t0:.3f}s")
+
+    with ThreadPoolExecutor(len(images)) as executor:
+        timings = {}
+        t0 = perf_counter()
+        remapPanorama(images, panorama_maps, out, executor, timings)
+        print(f"Stitched on {len(images)} threads in {perf_counter() - t0:.3f}s")
+        print(
+            "Cameras: "
+            + ", ".join(f"{t * 1000:.0f}ms" for t in timings["cameras"])
+            + ", seams: "
+            + ", ".join(f"{t * 1000:.0f}ms" for t in timings["seams"])
+        )
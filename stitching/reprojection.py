@@ -0,0 +1,123 @@
+# Moves object boxes from camera images to panorama co-ordinates.
+# Inverts the cylindrical projection of getCylindricalProjection analytically, for all boxes at once,
+# rather than searching the projection maps for the nearest pixel to each corner.
+from functools import lru_cache
+import numpy as np
+from stitching.stitching_functions import (
+    PROJECTION_COEFFICIENTS,
+    getProjectionMaps,
+    getProjectionCrop,
+)
+
+
+def inverseCylindricalProjection(x, y, w, h, coefficients=PROJECTION_COEFFICIENTS):
+    """
+    Returns the co-ordinates in the cylindrical projection of points {x}, {y} of a {w} x {h} image.
+
+    getCylindricalProjection samples the image at
+        map_x = (w/2) * (tan(theta) + 1)
+        map_y = (h/2) * (tan(phi) / cos(theta) + 1)
+    with theta = c_x (x' - w/2) / (w/2) and phi = c_y (y' - h/2) / (h/2), which inverts to
+        theta = atan(2x/w - 1)
+        phi = atan((2y/h - 1) * cos(theta))
+    """
+    theta = np.arctan(2 * np.asarray(x, dtype=np.float64) / w - 1)
+    phi = np.arctan((2 * np.asarray(y, dtype=np.float64) / h - 1) * np.cos(theta))
+    return (
+        (w / 2) * (theta / coefficients[0] + 1),
+        (h / 2) * (phi / coefficients[1] + 1),
+    )
+
+
+def getCropOffset(image_shape, coefficients=PROJECTION_COEFFICIENTS):
+    """Returns the (x, y) offset of the crop applied after cylindrical projection"""
+    h, w = image_shape[:2]
+    return _cropOffset(w, h, tuple(coefficients))
+
+
+@lru_cache(maxsize=None)
+def _cropOffset(w, h, coefficients):
+    map_x, map_y = getProjectionMaps(w, h, coefficients)
+    x, y, _, _ = getProjectionCrop(map_x, map_y)
+    return x, y
+
+
+def reprojectBoxes(
+    boxes, cameras, image_shape, transforms, coefficients=PROJECTION_COEFFICIENTS
+):
+    """
+    Moves {boxes} (N, 4) of x1, y1, x2, y2 in camera images to the stitching canvas, before the panorama crop.
+    {cameras} (N,) is the image each box is from. Image 0 is the reference, image i is placed with transforms[i - 1].
+    Returns an (N, 4) int array
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    cameras = np.asarray(cameras, dtype=np.intp).reshape(-1)
+    h, w = image_shape[:2]
+    x_offset, y_offset = getCropOffset(image_shape, coefficients)
+
+    # Corners into the cropped cylindrical projection, to the nearest pixel as findNewObjectLocation
+    x, y = inverseCylindricalProjection(
+        boxes[:, [0, 2]], boxes[:, [1, 3]], w, h, coefficients
+    )
+    x = np.clip(np.round(x), 0, w - 1) - x_offset
+    y = np.clip(np.round(y), 0, h - 1) - y_offset
+
+    # Then placed in the panorama, as applyTransform
+    placements = np.concatenate(
+        [
+            [[[1, 0, 0], [0, 1, 0]]],
+            np.asarray(transforms, dtype=np.float64).reshape(-1, 2, 3),
+        ]
+    )[cameras]
+    new_x = (
+        placements[:, 0, 0, None] * x
+        + placements[:, 0, 1, None] * y
+        + placements[:, 0, 2, None]
+    )
+    new_y = (
+        placements[:, 1, 0, None] * x
+        + placements[:, 1, 1, None] * y
+        + placements[:, 1, 2, None]
+    )
+
+    # Only images after the first are rounded by applyTransform
+    placed = cameras > 0
+    new_x[placed] = np.round(new_x[placed].astype(np.float32))
+    new_y[placed] = np.round(new_y[placed].astype(np.float32))
+
+    return np.stack(
+        [new_x[:, 0], new_y[:, 0], new_x[:, 1], new_y[:, 1]], axis=1
+    ).astype(int)
+
+
+if __name__ == "__main__":
+    # Compare with the nearest pixel search of findNewObjectLocation, and time both
+    from time import perf_counter
+    from stitching.stitching_functions import findNewObjectLocation
+
+    RESOLUTION = (4608, 2592)
+    NUM_BOXES = 20
+
+    w, h = RESOLUTION
+    rng = np.random.default_rng(0)
+    corners = rng.uniform(0, 1, (NUM_BOXES, 2, 2)) * [w, h]
+    boxes = np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1).round()
+
+    t0 = perf_counter()
+    map_x, map_y = getProjectionMaps(w, h)
+    x_offset, y_offset = getCropOffset((h, w))
+    expected = []
+    for x1, y1, x2, y2 in boxes:
+        x1, x2, y1, y2 = findNewObjectLocation(
+            x1, y1, x2, y2, map_x, map_y, x_offset, y_offset
+        )
+        expected.append([x1, y1, x2, y2])
+    t_search = perf_counter() - t0
+
+    t0 = perf_counter()
+    actual = reprojectBoxes(boxes, np.zeros(NUM_BOXES), (h, w), [])
+    t_analytic = perf_counter() - t0
+
+    error = np.abs(actual - np.array(expected))
+    print(f"Search: {t_search:.2f}s, analytic: {t_analytic * 1000:.2f}ms")
+    print(f"Max difference {error.max()}px, mean {error.mean():.3f}px")
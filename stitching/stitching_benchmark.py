@@ -0,0 +1,266 @@
+# Headless benchmark of panoramic stitching.
+# Replays sets of four frames recorded by PiA in debug mode (frame_{n}_{camera}.jpg), or synthetic frames,
+# through performPanoramicStitching and records the time of each phase, peak memory and output checksums as JSON,
+# so results from different versions can be compared.
+#   python -m stitching.stitching_benchmark --debug-dir ./debug_PiA
+#   python -m stitching.stitching_benchmark --synthetic 5 --compare stitching/benchmarks/previous.json
+import os
+import re
+import sys
+import json
+import hashlib
+import argparse
+import resource
+import subprocess
+import tracemalloc
+from datetime import datetime
+from time import perf_counter
+import numpy as np
+import cv2
+import stitching.stitching_main as stitching_main
+from object_detection.object_detection import Object
+
+NUM_CAMERAS = 4
+RESOLUTION = (4608, 2592)
+OBJECTS_PER_FRAME = 5
+RESULTS_DIR = "stitching/benchmarks"
+
+
+def findFrameSets(debug_dir, num_cameras=NUM_CAMERAS):
+    """Returns the paths of each complete set of frames in {debug_dir}, oldest first"""
+    frames = {}
+    for f in os.listdir(debug_dir):
+        match = re.fullmatch(r"frame_(\d+)_(\d+)\.jpg", f)
+        if match:
+            frames[int(match.group(1))] = (int(match.group(2)), f)
+
+    sets = []
+    for start in sorted(frames):
+        group = [frames.get(start + i) for i in range(num_cameras)]
+        if all(g is not None and g[0] == i for i, g in enumerate(group)):
+            sets.append([os.path.join(debug_dir, g[1]) for g in group])
+    return sets
+
+
+def syntheticFrames(seed, resolution=RESOLUTION, num_cameras=NUM_CAMERAS):
+    """Returns {num_cameras} smooth random frames, the same for the same {seed}"""
+    rng = np.random.default_rng(seed)
+    w, h = resolution
+    return [
+        cv2.resize(
+            rng.integers(0, 256, (h // 16, w // 16, 3), dtype=np.uint8),
+            (w, h),
+            interpolation=cv2.INTER_LINEAR,
+        )
+        for _ in range(num_cameras)
+    ]
+
+
+def syntheticObjects(seed, image_shape, num_cameras=NUM_CAMERAS):
+    """Returns {OBJECTS_PER_FRAME} random boxes in each camera's frame"""
+    rng = np.random.default_rng(seed)
+    h, w = image_shape[:2]
+    objects = []
+    for camera in range(num_cameras):
+        frame = []
+        for i in range(OBJECTS_PER_FRAME):
+            x1, x2 = sorted(rng.integers(0, w, 2).tolist())
+            y1, y2 = sorted(rng.integers(0, h, 2).tolist())
+            frame.append(
+                Object(
+                    id=camera * OBJECTS_PER_FRAME + i,
+                    label="person",
+                    coords=[x1, y1, x2, y2],
+                    conf=0.5,
+                    camera=camera,
+                )
+            )
+        objects.append(frame)
+    return objects
+
+
+def _gitVersion():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _peakRSS():
+    """Peak resident set size of the process so far, in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+
+def benchmarkSet(name, images, objects, trace_memory=True, preview=False):
+    """Stitches one set of {images} and {objects}, returning the timings, memory and checksums of the run"""
+    timings = {}
+    if trace_memory:
+        tracemalloc.reset_peak()
+
+    t0 = perf_counter()
+    panorama, objects = stitching_main.performPanoramicStitching(
+        images, objects, timings, preview
+    )
+    total = perf_counter() - t0
+
+    boxes = [obj.get_xyxy() for frame in objects for obj in frame]
+    return {
+        "name": name,
+        "total": total,
+        "phases": timings,
+        "peak_rss_mb": _peakRSS(),
+        "peak_traced_mb": (
+            tracemalloc.get_traced_memory()[1] / 1e6 if trace_memory else None
+        ),
+        "panorama_shape": list(panorama.shape),
+        "panorama_sha256": hashlib.sha256(
+            np.ascontiguousarray(panorama).tobytes()
+        ).hexdigest(),
+        "objects_sha256": hashlib.sha256(
+            json.dumps(boxes, default=int).encode()
+        ).hexdigest(),
+    }
+
+
+def summarise(runs):
+    """Mean and min of each phase over {runs}. Phases timed per camera or per image are kept apart,
+    as cameras may be processed concurrently"""
+    phases = {}
+    for run in runs:
+        for phase, t in list(run["phases"].items()) + [("total", run["total"])]:
+            if isinstance(t, list):
+                for i, ti in enumerate(t):
+                    phases.setdefault(f"{phase}[{i}]", []).append(ti)
+            else:
+                phases.setdefault(phase, []).append(t)
+    return {
+        phase: {"mean": float(np.mean(t)), "min": float(np.min(t))}
+        for phase, t in phases.items()
+    }
+
+
+def compare(results, previous):
+    """Prints the change in each phase from {previous}, and whether the outputs match"""
+    print(f"Compared with {previous.get('version')} ({previous.get('timestamp')}):")
+    for phase, now in results["summary"].items():
+        before = previous["summary"].get(phase)
+        if before:
+            change = (now["mean"] - before["mean"]) / before["mean"] * 100
+            print(
+                f"  {phase}: {before['mean'] * 1000:.1f}ms -> {now['mean'] * 1000:.1f}ms ({change:+.0f}%)"
+            )
+
+    checksums = {r["name"]: r["panorama_sha256"] for r in previous["runs"]}
+    for run in results["runs"]:
+        if run["name"] in checksums:
+            same = checksums[run["name"]] == run["panorama_sha256"]
+            print(f"  {run['name']}: panorama {'unchanged' if same else 'CHANGED'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark panoramic stitching")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--debug-dir", help="replay the frames PiA saved here")
+    source.add_argument(
+        "--synthetic", type=int, default=3, help="number of synthetic frame sets"
+    )
+    parser.add_argument("--repeats", type=int, default=1, help="runs of each set")
+    parser.add_argument(
+        "--legacy", action="store_true", help="stitch without the panorama maps"
+    )
+    parser.add_argument(
+        "--sequential", action="store_true", help="project cameras one at a time"
+    )
+    parser.add_argument(
+        "--preview", action="store_true", help="stitch the low resolution preview"
+    )
+    parser.add_argument(
+        "--no-trace", action="store_true", help="skip tracemalloc peak memory"
+    )
+    parser.add_argument("--output", help="results file, in RESULTS_DIR by default")
+    parser.add_argument("--compare", help="earlier results file to compare with")
+    args = parser.parse_args()
+
+    stitching_main.USE_PANORAMA_MAPS = not args.legacy
+    stitching_main.PARALLEL_STITCHING = not args.sequential
+
+    if args.debug_dir:
+        frame_sets = [
+            (
+                os.path.basename(paths[0]),
+                lambda paths=paths: [cv2.imread(p) for p in paths],
+            )
+            for paths in findFrameSets(args.debug_dir)
+        ]
+    else:
+        frame_sets = [
+            (f"synthetic_{seed}", lambda seed=seed: syntheticFrames(seed))
+            for seed in range(args.synthetic)
+        ]
+    if not frame_sets:
+        raise SystemExit("No frame sets to benchmark")
+
+    # Maps are loaded at startup on the platform, so are not part of the benchmark
+    first = frame_sets[0][1]()
+    t0 = perf_counter()
+    stitching_main.loadStitchingMaps(first[0].shape)
+    load_time = perf_counter() - t0
+
+    if not args.no_trace:
+        tracemalloc.start()
+
+    runs = []
+    for seed, (name, load) in enumerate(frame_sets):
+        images = load()
+        for repeat in range(args.repeats):
+            objects = syntheticObjects(seed, images[0].shape)
+            run = benchmarkSet(name, images, objects, not args.no_trace, args.preview)
+            run["repeat"] = repeat
+            runs.append(run)
+            print(
+                f"{name} #{repeat}: {run['total'] * 1000:.0f}ms, peak RSS {run['peak_rss_mb']:.0f}MB, "
+                f"panorama {run['panorama_sha256'][:12]}"
+            )
+
+    results = {
+        "version": _gitVersion(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "use_panorama_maps": stitching_main.USE_PANORAMA_MAPS,
+            "parallel_stitching": stitching_main.PARALLEL_STITCHING,
+            "stitching_threads": stitching_main.STITCHING_THREADS,
+            "seam_feather_width": stitching_main.SEAM_FEATHER_WIDTH,
+            "preview_scale": stitching_main.PREVIEW_SCALE if args.preview else None,
+            "opencv": cv2.__version__,
+            "cpus": os.cpu_count(),
+        },
+        "map_load_time": load_time,
+        "summary": summarise(runs),
+        "runs": runs,
+    }
+
+    for phase, t in results["summary"].items():
+        print(f"{phase}: mean {t['mean'] * 1000:.1f}ms, min {t['min'] * 1000:.1f}ms")
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"stitching_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=4)
+    print(f"Saved results to {output}")
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
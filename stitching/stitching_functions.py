@@ -1,4 +1,6 @@
 # This file specifies the functions for image stitching
+import os
+from functools import lru_cache
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
@@ -11,34 +13,86 @@ def showImage(image, title="Snapshot"):
     cv2.destroyAllWindows()
 
 ### Determine cylindrical projection parameters ####
-def getCylindricalProjection(img):
+# Note: change coefficients to change warping effect. Scale of the horizontal and vertical angles
+PROJECTION_COEFFICIENTS = (1.0, 1.0)
+
+# Projection maps already computed, keyed by (width, height, coefficients, fixed point)
+_projection_maps = {}
 
-    h, w = img.shape[:2]  # Retrieve image dimensions
-    map_x, map_y = np.meshgrid(
-        np.arange(w), np.arange(h)
-    )  # Create a coordinate array for mapping
 
-    theta = (map_x - w / 2) / (w / 2)  # Define approx. parameters
-    phi = (map_y - h / 2) / (h / 2)
+def cylindricalSourceCoords(x, y, w, h, coefficients=PROJECTION_COEFFICIENTS):
+    """Returns where pixels {x}, {y} of the cylindrical projection of a {w} x {h} image sample the image"""
+    theta = coefficients[0] * (x - w / 2) / (w / 2)  # Define approx. parameters
+    phi = coefficients[1] * (y - h / 2) / (h / 2)
 
     x = np.sin(theta) * np.cos(phi)
     y = np.sin(phi)
     z = np.cos(theta) * np.cos(phi)
 
-    # Note: change coefficients to change warping effect
     map_x = (w / 2) * (x / z + 1)
     map_y = (h / 2) * (y / z + 1)
 
     return map_x, map_y
 
 
+def getCylindricalProjection(img, coefficients=PROJECTION_COEFFICIENTS):
+
+    h, w = img.shape[:2]  # Retrieve image dimensions
+    map_x, map_y = np.meshgrid(
+        np.arange(w), np.arange(h)
+    )  # Create a coordinate array for mapping
+
+    return cylindricalSourceCoords(map_x, map_y, w, h, coefficients)
+
+
+def getProjectionMaps(
+    w, h, coefficients=PROJECTION_COEFFICIENTS, fixed_point=False, cache_dir=None
+):
+    """
+    Returns the cylindrical projection maps for a {w} x {h} image, ready for cv2.remap.
+    Maps are computed once per process. With {cache_dir} they are also kept on disk as .npy, so are only computed once.
+    With {fixed_point}, returns the CV_16SC2 and CV_16UC1 maps from cv2.convertMaps, which remap faster
+    """
+    coefficients = tuple(float(c) for c in coefficients)
+    key = (w, h, coefficients, fixed_point)
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(
+            cache_dir,
+            f"cylindrical_{w}x{h}_{coefficients[0]:g}_{coefficients[1]:g}.npy",
+        )
+
+    maps = _projection_maps.get(key)
+    if maps is None:
+        if fixed_point:
+            map_x, map_y = getProjectionMaps(w, h, coefficients, False, cache_dir)
+            maps = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+        elif path is not None and os.path.exists(path):
+            maps = tuple(np.load(path))
+        else:
+            map_x, map_y = getCylindricalProjection(
+                np.empty((h, w), dtype=np.uint8), coefficients
+            )
+            maps = (map_x.astype(np.float32), map_y.astype(np.float32))
+
+        for m in maps:
+            m.flags.writeable = False
+        _projection_maps[key] = maps
+
+    if not fixed_point and path is not None and not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(path, np.stack(maps))
+
+    return maps
+
+
 ### Apply cylindrical projection ####
 def applyCylindricalProjection(img, map_x, map_y):
 
-    # Apply cylindrical projection
-    cylindricalProjection = cv2.remap(
-        img, map_x.astype(np.float32), map_y.astype(np.float32), cv2.INTER_LINEAR
-    )
+    # Apply cylindrical projection, maps from getProjectionMaps are used as they are
+    if map_x.dtype == np.float64:
+        map_x, map_y = map_x.astype(np.float32), map_y.astype(np.float32)
+    cylindricalProjection = cv2.remap(img, map_x, map_y, cv2.INTER_LINEAR)
 
     # Crop
     cylindricalProjection, x_offset, y_offset = cropToObject(cylindricalProjection)
@@ -46,6 +100,17 @@ def applyCylindricalProjection(img, map_x, map_y):
     return cylindricalProjection, x_offset, y_offset 
 
 
+### Determine the crop of a cylindrical projection from its maps ####
+def getProjectionCrop(map_x, map_y):
+    h, w = map_x.shape
+
+    # Pixels that sample at least partly from inside the source image, the rest are left black by remap
+    valid = (map_x > -1) & (map_x < w) & (map_y > -1) & (map_y < h)
+    x, y, crop_w, crop_h = cv2.boundingRect(valid.astype(np.uint8))
+
+    return x, y, crop_w, crop_h
+
+
 ### Determine the coordinates of an object, after cylindrical projection ####
 def findNewObjectLocation(x1, y1, x2, y2, map_x, map_y, x_offset, y_offset):
     distances = np.sqrt(
@@ -94,59 +159,64 @@ def cropToObject(image):
 
 
 ### Find Matching Co-ordinates through SIFT ####
-def findKeyPoints(img1, img2, horizontal_overlap=500):
-    height, width, _ = img1.shape
-
-    # Convert to grayscale
-    img1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
-    img2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
-
-    # Perform SIFT
-    sift = cv2.SIFT_create()
-
-    # Create mask and apply SIFT to reference image
-    mask = np.zeros((height, width), dtype=np.uint8)
-    mask[:, width - horizontal_overlap :] = 255
-    kp1, des1 = sift.detectAndCompute(img1, mask)
-
-    # Create mask and apply SIFT to warp image
-    mask = np.zeros((height, width), dtype=np.uint8)
-    mask[:, :horizontal_overlap] = 255  # White region in the rightmost quarter
-    kp2, des2 = sift.detectAndCompute(img2, mask)
-
-    # Brute Force Match
-    bf = cv2.BFMatcher()
-    matches = bf.knnMatch(des1, des2, k=2)
-    img_matches = cv2.drawMatchesKnn(img1, kp1, img2, kp2, matches, None, flags=cv2.DrawMatchesFlags_NOT_DRAW_SINGLE_POINTS)
-    showImage(img_matches)
+def detectStripFeatures(image, side, overlap=500, sift=None):
+    """
+    Finds SIFT features in the {overlap} wide strip on the {side} ("left" or "right") of {image}.
+    Only the strip is processed. Returns the feature points (N, 2) in {image} co-ordinates and their descriptors
+    """
+    width = image.shape[1]
+    x0 = width - overlap if side == "right" else 0
+    strip = image[:, x0 : x0 + overlap]
+    if strip.ndim == 3:
+        strip = cv2.cvtColor(strip, cv2.COLOR_BGR2GRAY)
+
+    sift = cv2.SIFT_create() if sift is None else sift
+    kp, des = sift.detectAndCompute(strip, None)
+    points = np.float32([k.pt for k in kp]).reshape(-1, 2)
+    points[:, 0] += x0
+    return points, des
+
+
+def matchFeatures(des1, des2, ratio=0.75):
+    """Matches descriptors {des1} to {des2} with FLANN and Lowe's ratio test.
+    Returns the indices into each of the good matches, best first"""
+    if des1 is None or des2 is None or len(des1) < 2 or len(des2) < 2:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+    flann = cv2.FlannBasedMatcher(dict(algorithm=1, trees=5), dict(checks=50))  # KD-tree
+    matches = flann.knnMatch(des1, des2, k=2)
 
     # Perform Lowe's Ratio Test
-    goodMatches = []
-    for m, n in matches:
-        if m.distance < 0.75 * n.distance:
-            goodMatches.append(m)
-
-    img_matches = cv2.drawMatches(
-        img1,
-        kp1,
-        img2,
-        kp2,
-        goodMatches,
-        None,
-        flags=cv2.DrawMatchesFlags_NOT_DRAW_SINGLE_POINTS,
-    )
-    # showImage(img_matches)
+    good = []
+    for pair in matches:
+        if len(pair) == 2 and pair[0].distance < ratio * pair[1].distance:
+            good.append(pair[0])
 
     # Sort matches, best to worst
-    goodMatches = sorted(goodMatches, key=lambda x: x.distance)
+    good = sorted(good, key=lambda m: m.distance)
+    return (
+        np.array([m.queryIdx for m in good], dtype=int),
+        np.array([m.trainIdx for m in good], dtype=int),
+    )
+
 
-    # # Draw matches
-    img_matches = cv2.drawMatches(img1, kp1, img2, kp2, goodMatches, None, flags=cv2.DrawMatchesFlags_NOT_DRAW_SINGLE_POINTS)
-    # showImage(img_matches)
+def findKeyPoints(img1, img2, horizontal_overlap=500, verbose=False):
+    """Matches features in the right strip of {img1} to the left strip of {img2}.
+    With {verbose}, the matches are shown"""
+    points1, des1 = detectStripFeatures(img1, "right", horizontal_overlap)
+    points2, des2 = detectStripFeatures(img2, "left", horizontal_overlap)
+    idx1, idx2 = matchFeatures(des1, des2)
 
-    # Convert to numpy array
-    src_pts = np.float32([kp1[m.queryIdx].pt for m in goodMatches]).reshape(-1, 1, 2)
-    dst_pts = np.float32([kp2[m.trainIdx].pt for m in goodMatches]).reshape(-1, 1, 2)
+    src_pts = points1[idx1].reshape(-1, 1, 2)
+    dst_pts = points2[idx2].reshape(-1, 1, 2)
+
+    if verbose:
+        # Draw matches
+        kp1 = [cv2.KeyPoint(float(x), float(y), 1) for x, y in src_pts[:, 0]]
+        kp2 = [cv2.KeyPoint(float(x), float(y), 1) for x, y in dst_pts[:, 0]]
+        matches = [cv2.DMatch(i, i, 0) for i in range(len(kp1))]
+        img_matches = cv2.drawMatches(img1, kp1, img2, kp2, matches, None)
+        showImage(img_matches)
 
     return src_pts, dst_pts
 
@@ -183,61 +253,96 @@ def applyTransform(img1, img2, matrix, objects):
     canvas = cv2.warpAffine(img2, matrix, (maxX, max(height1, maxY)))
     # showImage(canvas, 'canvas')
 
-    # Apply Blending
-    blended = applyBlend(img1, canvas)
+    # Apply Blending, only across the overlap with the warped image
+    blended = applyBlend(img1, canvas, int(np.floor(np.min(newCorners[:, 0]))))
 
     # Find the new coordintes of an objects after warping
-    if objects != []:
-        for obj in objects:
+    objects = transformObjects(objects, matrix)
 
-            x1, y1, x2, y2 = obj.get_xyxy()
+    return blended, objects
 
-            original_coords = np.array([[x1, y1], [x2, y2]], dtype=np.float32)
-            new_coords = cv2.transform(np.array([original_coords]), matrix)[0]
 
-            x1 = round(new_coords[0][0])
-            y1 = round(new_coords[0][1])
-            x2 = round(new_coords[1][0])
-            y2 = round(new_coords[1][1])
+### Apply affine transform to object co-ordinates ####
+def transformObjects(objects, matrix):
+    for obj in objects:
 
-            obj.set_xyxy([x1, y1, x2, y2])
+        x1, y1, x2, y2 = obj.get_xyxy()
 
-    return blended, objects
+        original_coords = np.array([[x1, y1], [x2, y2]], dtype=np.float32)
+        new_coords = cv2.transform(np.array([original_coords]), matrix)[0]
 
+        x1 = round(new_coords[0][0])
+        y1 = round(new_coords[0][1])
+        x2 = round(new_coords[1][0])
+        y2 = round(new_coords[1][1])
 
-def applyBlend(image1, canvas):
+        obj.set_xyxy([x1, y1, x2, y2])
 
-    # Extend image 1 to be the same size as the new canvas
-    height1, width1, _ = image1.shape  # First image / panorama
-    img1 = np.zeros_like(canvas)
-    img1[:height1, :width1, :] = image1
+    return objects
 
-    # Highlight the area to blend
-    identifyBlendedArea = np.where((canvas > 0) & (img1 > 0), 255, 0).astype(np.uint8)
 
-    # Crop to the smallest bounding box
-    blendedObject, x, y = cropToObject(identifyBlendedArea)
+# Feather weights are fixed point, out of FEATHER_SCALE
+FEATHER_SCALE = 256
+FEATHER_SHIFT = 8
 
 
-    # Get the blending area width
-    height, width, _ = blendedObject.shape
+@lru_cache(maxsize=None)
+def featherWeights(width):
+    """Returns the weight of the right image across a {width} column overlap, rising linearly from 0 to FEATHER_SCALE"""
+    weights = np.round(np.linspace(0, 1, width) * FEATHER_SCALE).astype(np.uint16)
+    weights.flags.writeable = False
+    return weights
 
-    # Create a 3D gradient
-    gradient = np.linspace(0, 1, width)
-    gradient = np.stack([gradient] * 3, axis=1)  # Shape: (width, 3)
-    gradient = np.tile(gradient, (height, 1, 1))  # Repeat for height
 
-    # Project the new gradient to the blending shape
-    gradient = np.where(blendedObject != 0, gradient, blendedObject)
-    
-    # Place the new gradient back in its original position
-    newGradient = np.zeros_like(canvas).astype(np.float32)
-    newGradient[y : y + height, x : x + width, :] = gradient
+def featherBlend(left, right, weights, out):
+    """
+    Blends {left} and {right} (h, w, 3) uint8 into {out} with the fixed point {weights} (w,) of {right}.
+    Only pixels with content in both are blended, elsewhere whichever has content is used.
+    {out} may be either input
+    """
+    w = weights[None, :, None]
+    blended = left.astype(np.uint16)
+    blended *= FEATHER_SCALE - w
+    blended += right.astype(np.uint16) * w
+    blended >>= FEATHER_SHIFT
+    both = (left > 0) & (right > 0)
+
+    np.copyto(out, np.where(left > 0, left, right))
+    np.copyto(out, blended, casting="unsafe", where=both)
+    return out
 
-    blended = ((1 - newGradient) * img1 + newGradient * canvas).astype(np.uint8)
-    blended = np.where(blended == 0, canvas, blended).astype(np.uint8)
 
-    return blended
+def applyBlend(image1, canvas, band_start=None):
+    """
+    Blends the panorama {image1} onto {canvas}, the next image already warped into place, in place.
+    Only the overlap band, from {band_start} (the left edge of the warped image) to the right edge of {image1},
+    is blended. Left of it, {image1} is copied straight through and right of it {canvas} is left as is
+    """
+    height1, width1, _ = image1.shape  # First image / panorama
+    if band_start is None:
+        # Left edge of the warped image
+        columns = np.flatnonzero(canvas[:height1, :width1].any(axis=(0, 2)))
+        band_start = columns[0] if len(columns) else width1
+    band_start = int(np.clip(band_start, 0, width1))
+
+    # No overlap left of the band
+    canvas[:height1, :band_start] = image1[:, :band_start]
+
+    left = image1[:, band_start:]
+    right = canvas[:height1, band_start:width1]
+    if left.size == 0:
+        return canvas
+
+    # Feather across the columns where both images have content
+    columns = np.flatnonzero(((left > 0) & (right > 0)).any(axis=(0, 2)))
+    weights = np.zeros(left.shape[1], dtype=np.uint16)
+    if len(columns):
+        weights[columns[0] : columns[-1] + 1] = featherWeights(
+            int(columns[-1] - columns[0] + 1)
+        )
+
+    featherBlend(left, right, weights, right)
+    return canvas
 
 def normalise_brightness(img, verbose=False):
     result = img.copy().astype(np.float32)
@@ -245,9 +350,8 @@ def normalise_brightness(img, verbose=False):
     b, g, r = cv2.split(img)
 
     # Plot histograms
-    plt.figure(figsize=(10, 4))
-
     if verbose:
+        plt.figure(figsize=(10, 4))
         plt.subplot(1, 3, 1)
         plt.hist(b.ravel(), bins=256, range=[0, 256], color='blue')
         plt.title('Blue Channel')
@@ -1,81 +1,330 @@
 # This file takes four images and creates one continous panorama, by applying pre-computed homographies.
 # It also translates the position of objects into the new panoramic location.
-# Can also be used to calibrate pre-computed homographies.
+# The homographies are calibrated by calibrate_stitching.py.
 
 # Imports
 from stitching.stitching_functions import *
+from stitching.panorama_maps import (
+    getPanoramaGeometry,
+    buildPanoramaMaps,
+    loadPanoramaMaps,
+    remapPanorama,
+)
+from stitching.reprojection import reprojectBoxes
+from stitching.calibrate import loadTransforms
+from stitching.gain_compensation import (
+    buildOverlapSampleMaps,
+    estimateGains,
+    smoothGains,
+    gainLUTs,
+)
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 import cv2
 import numpy as np
 import logging
 
 
-def performPanoramicStitching(images, objects):
-    # Retrieve the mapping of co-ordinates, to find the new location of objects after cylindrical projection
-    logging.debug("Stitching images")
-    map_x, map_y = getCylindricalProjection(images[0])
+### Pre-computed transforms between neighbouring images ###
+# Defaults, used when there is no calibration file. To recalibrate, run calibrate_stitching.py
+
+# Recieved matrix: [[8.40855598e-01  6.12737961e-02  3.25624999e+03][ 8.77841949e-02  9.89504187e-01 -5.27089969e+01]]
+H1 = np.array([[1,  0,  3.25624999e+03],[ 0,  1, -4.27089969e+01]])
+
+# [[8.70816812e-01  2.95356821e-02  6.50228434e+03][-6.58791426e-02  1.00045882e+00 -1.04482638e+02]]
+H2 = np.array([[1,  0,  6.50228434e+03],[0,  1, -1.04482638e+02]])
+
+# [[ 9.09794130e-01  1.11946952e-01  9.64858946e+03][-3.19979319e-02  9.96809381e-01 -2.34668237e+01]]
+H3 = np.array(
+    [
+         [1,  0, 9.74858946e+03],[0,  1, -2.34668237e+01]
+    ]
+)
+
+# Calibration file written by calibrate_stitching.py, loaded in place of the defaults if present
+# and calibrated from frames of IMAGE_SHAPE with PROJECTION_COEFFICIENTS
+CALIBRATION_DIR = "stitching/calibration"
+TRANSFORMS_PATH = CALIBRATION_DIR + "/transforms.json"
+IMAGE_SHAPE = (2592, 4608)  # Camera frames, height x width
+TRANSFORMS = loadTransforms(
+    TRANSFORMS_PATH, IMAGE_SHAPE, PROJECTION_COEFFICIENTS
+) or [H1, H2, H3]
+
+# Crop of the stitched panorama: top, bottom, left, right
+PANORAMA_CROP = (150, 300, 300, 300)
+
+# Cylindrical projection maps are kept in CALIBRATION_DIR too, so are only computed once
+PROJECTION_FIXED_POINT = True  # cv2.convertMaps CV_16SC2 maps, faster to remap than float32
+
+# Remap each image straight into the panorama with precomputed maps, instead of projecting and warping each in turn
+USE_PANORAMA_MAPS = True
+PANORAMA_MAPS_PATH = CALIBRATION_DIR + "/panorama_maps.npz"
+PANORAMA_MAPS_FIXED_POINT = True  # cv2.convertMaps CV_16SC2 maps, faster to remap than float32
+# The panorama maps blend cameras over SEAM_FEATHER_WIDTH pixels centred on the middle of each overlap, narrower than
+# the legacy stitcher's gradient across the whole overlap (about 370 pixels), so seams look sharper than they did.
+# Inside the overlaps pixels differ from the legacy panorama by up to 225 grey levels, outside by up to 9
+SEAM_FEATHER_WIDTH = 128  # Width of the blend across each seam, in pixels. 0 for hard seams
+
+# Project the cameras concurrently, cv2.remap releases the GIL. False to run them one after another for debugging
+PARALLEL_STITCHING = True
+STITCHING_THREADS = 4
+
+# Preview panoramas are stitched from frames downsampled by PREVIEW_SCALE, with the geometry scaled to match
+PREVIEW_SCALE = 4
+
+# Match the exposure of the cameras with gains estimated from their overlaps
+GAIN_COMPENSATION = True
+GAIN_SMOOTHING = 0.5  # Share of the latest scan in the gains, the rest is from earlier scans
+
+_panorama_maps = None
+_preview_maps = None
+_stitching_pool = None
+_gain_sample_maps = None
+_camera_gains = None
+
+
+def transformObjectsToPanorama(images, objects):
+    """Moves the objects of each image to their location in the panorama of {images}.
+    Only needs the image size, so can be done before the images are stitched"""
+    logging.debug("Transforming objects to panorama co-ordinates")
+    boxes = [obj.get_xyxy() for frame in objects for obj in frame]
+    cameras = [i for i, frame in enumerate(objects) for _ in frame]
+
+    if boxes:
+        # All objects of all images in one go
+        new_boxes = reprojectBoxes(boxes, cameras, images[0].shape, TRANSFORMS)
+        flattened = [obj for frame in objects for obj in frame]
+        for obj, box in zip(flattened, new_boxes.tolist()):
+            obj.set_xyxy(box)
+
+    # Account for the crop
+    top, _, left, _ = PANORAMA_CROP
+    for frame in objects:
+        for obj in frame:
+            obj.adjust_xyxy(-left, -top, -left, -top)
+
+    return objects
+
 
-    for i in range(len(images)):
-        # Apply a cylindrical projection to each image
-        logging.debug(f"Applying cylindrical projection to image {i}")
-        images[i], x_offset, y_offset = applyCylindricalProjection(
-            images[i], map_x, map_y
+def getPanoramaMaps(image_shape):
+    """Returns the panorama maps for images of {image_shape}, loaded from disk once per process"""
+    global _panorama_maps
+    image_shape = tuple(image_shape[:2])
+    if _panorama_maps is None or _panorama_maps[0] != image_shape:
+        maps = loadPanoramaMaps(
+            PANORAMA_MAPS_PATH,
+            image_shape,
+            TRANSFORMS,
+            PANORAMA_CROP,
+            PANORAMA_MAPS_FIXED_POINT,
+            feather_width=SEAM_FEATHER_WIDTH,
         )
+        _panorama_maps = (image_shape, maps)
+    return _panorama_maps[1]
 
-        logging.debug(f"Translating objects to new co-ordinates in image {i}")
-        # Translate each object to new co-ordinates
-        for obj in objects[i]:
-            x1, y1, x2, y2 = obj.get_xyxy()
-
-            (x1, x2, y1, y2) = findNewObjectLocation(
-                x1, y1, x2, y2, map_x, map_y, x_offset, y_offset
-            )
-
-            obj.set_xyxy([x1, y1, x2, y2])
-
-    ### First stitch ###
-    # Uncomment for calibration:
-    # src_pts, dst_pts = findKeyPoints(images[0], images[1])
-    # H1 = calculateTransform(dst_pts, src_pts)
-    # print(H1)
-
-    # Recieved matrix: [[8.40855598e-01  6.12737961e-02  3.25624999e+03][ 8.77841949e-02  9.89504187e-01 -5.27089969e+01]]
-    logging.debug(f"Stitching images 0 and 1")
-    H1 = np.array([[1,  0,  3.25624999e+03],[ 0,  1, -4.27089969e+01]])
-    panorama, objects[1] = applyTransform(images[0], images[1], H1, objects[1])
-
-    ### Second Stitch ###
-    # src_pts, dst_pts = findKeyPoints(panorama, images[2])
-    # H2 = calculateTransform(dst_pts, src_pts)
-    # print(H2)
-    # [[8.70816812e-01  2.95356821e-02  6.50228434e+03][-6.58791426e-02  1.00045882e+00 -1.04482638e+02]]
-    logging.debug(f"Stitching images 1 and 2")
-    H2 = np.array([[1,  0,  6.50228434e+03],[0,  1, -1.04482638e+02]])
-    panorama, objects[2] = applyTransform(panorama, images[2], H2, objects[2])
-
-    ### Third Stitch ###
-    # src_pts, dst_pts = findKeyPoints(panorama, images[3])
-    # H3 = calculateTransform(dst_pts, src_pts)
-    # print(H3)
-    # [[ 9.09794130e-01  1.11946952e-01  9.64858946e+03][-3.19979319e-02  9.96809381e-01 -2.34668237e+01]]
-    logging.debug(f"Stitching images 2 and 3")
-    H3 = np.array(
-        [
-             [1,  0, 9.74858946e+03],[0,  1, -2.34668237e+01]
-        ]
-    )
-    panorama, objects[3] = applyTransform(panorama, images[3], H3, objects[3])
 
+def getPanoramaShape(image_shape):
+    """Returns the (height, width) of the panorama stitched from images of {image_shape}"""
+    _, (pano_w, pano_h), _ = getPanoramaGeometry(image_shape, TRANSFORMS, PANORAMA_CROP)
+    return pano_h, pano_w
+
+
+def getPreviewMaps(image_shape):
+    """Returns the panorama maps for images of {image_shape} downsampled by PREVIEW_SCALE.
+    They are small, so are built in memory once per process rather than cached on disk"""
+    global _preview_maps
+    image_shape = tuple(image_shape[:2])
+    if _preview_maps is None or _preview_maps[0] != image_shape:
+        h, w = image_shape
+        transforms = [np.array(m, dtype=np.float64) for m in TRANSFORMS]
+        for m in transforms:
+            m[:, 2] /= PREVIEW_SCALE
+        maps = buildPanoramaMaps(
+            (h // PREVIEW_SCALE, w // PREVIEW_SCALE),
+            transforms,
+            [c // PREVIEW_SCALE for c in PANORAMA_CROP],
+            PANORAMA_MAPS_FIXED_POINT,
+            feather_width=SEAM_FEATHER_WIDTH // PREVIEW_SCALE,
+        )
+        _preview_maps = (image_shape, maps)
+    return _preview_maps[1]
+
+
+def getGainSampleMaps(image_shape):
+    """Returns the maps sampling the camera overlaps of images of {image_shape}, built once per process"""
+    global _gain_sample_maps
+    image_shape = tuple(image_shape[:2])
+    if _gain_sample_maps is None or _gain_sample_maps[0] != image_shape:
+        _gain_sample_maps = (
+            image_shape,
+            buildOverlapSampleMaps(image_shape, TRANSFORMS, PANORAMA_CROP),
+        )
+    return _gain_sample_maps[1]
+
+
+def updateCameraGains(images):
+    """Estimates the gains matching the exposure of {images}, smoothed with earlier scans.
+    Returns the LUT of each camera"""
+    global _camera_gains
+    gains = estimateGains(images, getGainSampleMaps(images[0].shape))
+    _camera_gains = smoothGains(_camera_gains, gains, GAIN_SMOOTHING)
+    logging.debug(f"Camera gains {np.round(_camera_gains, 3).tolist()}")
+    return gainLUTs(_camera_gains)
+
+
+def getStitchingPool():
+    """Returns the thread pool cameras are projected on, or None with PARALLEL_STITCHING off"""
+    global _stitching_pool
+    if not PARALLEL_STITCHING:
+        return None
+    if _stitching_pool is None:
+        _stitching_pool = ThreadPoolExecutor(
+            STITCHING_THREADS, thread_name_prefix="stitching"
+        )
+    return _stitching_pool
+
+
+def _logTimings(timings):
+    for i, t in enumerate(timings.get("cameras", [])):
+        logging.debug(f"Camera {i} projected in {t * 1000:.0f}ms")
+    for i, t in enumerate(timings.get("seams", [])):
+        logging.debug(f"Seam {i} blended in {t * 1000:.0f}ms")
+    for i, t in enumerate(timings.get("transforms", [])):
+        logging.debug(f"Image {i + 1} placed in {t * 1000:.0f}ms")
+
+
+def loadStitchingMaps(image_shape):
+    """Loads, or computes and caches, every map stitching needs for images of {image_shape}.
+    Call at startup so the first scan does not compute them"""
+    h, w = image_shape[:2]
+    getProjectionMaps(w, h, cache_dir=CALIBRATION_DIR)
+    if USE_PANORAMA_MAPS:
+        getPanoramaMaps(image_shape)
+    else:
+        getProjectionMaps(w, h, fixed_point=PROJECTION_FIXED_POINT, cache_dir=CALIBRATION_DIR)
+    if GAIN_COMPENSATION:
+        getGainSampleMaps(image_shape)
+    getPreviewMaps(image_shape)
+
+
+def stitchImages(images, out=None, timings=None):
+    """Stitches four images into a panorama.
+    With USE_PANORAMA_MAPS, seams are feathered across the middle of each overlap and the panorama is written to {out} if given.
+    If {timings} is a dict, the seconds taken by each phase are added to it"""
+    timings = {} if timings is None else timings
+
+    luts = None
+    if GAIN_COMPENSATION:
+        t0 = perf_counter()
+        luts = updateCameraGains(images)
+        timings["gains"] = perf_counter() - t0
+
+    if USE_PANORAMA_MAPS:
+        logging.debug("Stitching images with panorama maps")
+        panorama = remapPanorama(
+            images,
+            getPanoramaMaps(images[0].shape),
+            out,
+            getStitchingPool(),
+            timings,
+            luts,
+        )
+        _logTimings(timings)
+        logging.debug(f"Stitching complete")
+        return panorama
+
+    logging.debug("Stitching images")
+    image_h, image_w = images[0].shape[:2]
+    map_x, map_y = getProjectionMaps(image_w, image_h, cache_dir=CALIBRATION_DIR)
+    x, y, w, h = getProjectionCrop(map_x, map_y)
+    if PROJECTION_FIXED_POINT:
+        map_x, map_y = getProjectionMaps(
+            image_w, image_h, fixed_point=True, cache_dir=CALIBRATION_DIR
+        )
+
+    # Only the cropped part of the projection is needed
+    map_x = map_x[y : y + h, x : x + w]
+    map_y = map_y[y : y + h, x : x + w]
+
+    # Apply a cylindrical projection to each image, into one buffer
+    projected = np.empty((len(images), h, w, 3), dtype=np.uint8)
+
+    def project(i):
+        t0 = perf_counter()
+        cv2.remap(images[i], map_x, map_y, cv2.INTER_LINEAR, dst=projected[i])
+        if luts is not None:
+            cv2.LUT(projected[i], luts[i], dst=projected[i])
+        return perf_counter() - t0
+
+    pool = getStitchingPool()
+    run = map if pool is None else pool.map
+    timings["cameras"] = list(run(project, range(len(images))))
+
+    panorama = projected[0]
+    timings["transforms"] = []
+    for i in range(1, len(projected)):
+        logging.debug(f"Stitching images {i - 1} and {i}")
+        t0 = perf_counter()
+        panorama, _ = applyTransform(panorama, projected[i], TRANSFORMS[i - 1], [])
+        timings["transforms"].append(perf_counter() - t0)
 
     # Crop Image
     logging.debug(f"Cropping stitched image")
+    t0 = perf_counter()
     height, width, _ = panorama.shape
+    top, bottom, left, right = PANORAMA_CROP
+    panorama = panorama[top : height - bottom, left : width - right, :]
+    timings["crop"] = perf_counter() - t0
 
-    panorama = panorama[150 : height - 300, 300 : width - 300, :]
-    for frame in objects:
-        for obj in frame:
-            obj.adjust_xyxy(-150, -150, -150, -150)
-
+    _logTimings(timings)
     logging.debug(f"Stitching complete")
+    return panorama
+
+
+def stitchPreview(images, timings=None):
+    """Stitches a panorama PREVIEW_SCALE times smaller than stitchImages, from downsampled {images}.
+    Uses the camera gains of the latest full stitch, if any"""
+    timings = {} if timings is None else timings
+    logging.debug("Stitching preview")
+    h, w = images[0].shape[:2]
+    size = (w // PREVIEW_SCALE, h // PREVIEW_SCALE)
+
+    def downsample(image):
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    t0 = perf_counter()
+    pool = getStitchingPool()
+    small = list(map(downsample, images) if pool is None else pool.map(downsample, images))
+    timings["downsampling"] = perf_counter() - t0
+
+    luts = None
+    if GAIN_COMPENSATION and _camera_gains is not None:
+        luts = gainLUTs(_camera_gains)
+
+    panorama = remapPanorama(
+        small, getPreviewMaps(images[0].shape), None, pool, timings, luts
+    )
+    logging.debug("Preview complete")
+    return panorama
+
+
+def performPanoramicStitching(images, objects, timings=None, preview=False):
+    """Stitches {images} and moves their {objects} into the panorama.
+    With {preview}, the panorama is PREVIEW_SCALE times smaller and much faster to stitch,
+    the objects are still in full resolution panorama co-ordinates.
+    If {timings} is a dict, the seconds taken by each phase are added to it"""
+    timings = {} if timings is None else timings
+
+    t0 = perf_counter()
+    objects = transformObjectsToPanorama(images, objects)
+    timings["reprojection"] = perf_counter() - t0
+
+    t0 = perf_counter()
+    if preview:
+        panorama = stitchPreview(images, timings)
+    else:
+        panorama = stitchImages(images, timings=timings)
+    timings["stitching"] = perf_counter() - t0
     return panorama, objects
 
 
@@ -0,0 +1,162 @@
+# Multi-resolution tile pyramid of a panorama for the web UI.
+# The panorama is reprojected onto the six faces of a cube, and each face is cut into
+# JPEG tiles at several levels, in the layout pannellum's multires viewer loads:
+#   {out_dir}/{level}/{face}{row}_{column}.jpg
+# so the browser only downloads the tiles in view, at the zoom level in view.
+# A small thumbnail is also written, for the viewer to show while tiles load.
+import os
+import logging
+import numpy as np
+import cv2
+
+# Field of view the panorama is shown with in the UI (Panorama.js), in degrees
+PANORAMA_HAOV = 358
+PANORAMA_VAOV = 60
+
+TILE_SIZE = 512
+THUMBNAIL_WIDTH = 1024
+JPEG_QUALITY = 85
+
+CUBE_FACES = "frbldu"
+
+
+def getCubeResolution(panorama_width, haov=PANORAMA_HAOV):
+    """Returns the cube face size keeping the resolution of a {panorama_width} wide panorama covering {haov} degrees"""
+    full_width = panorama_width * 360 / haov
+    return 8 * int(full_width / np.pi / 8)
+
+
+def getPyramidLevels(cube_resolution, tile_size=TILE_SIZE):
+    """Returns the number of levels, halving the face size each level until it fits in one tile"""
+    levels = 1
+    while cube_resolution / 2 ** (levels - 1) > tile_size:
+        levels += 1
+    return levels
+
+
+def _faceDirections(face, rows, size):
+    """Returns the view directions (x right, y up, z forward) of {rows} of a cube {face} of {size} pixels"""
+    u, v = np.meshgrid(
+        2 * (np.arange(size, dtype=np.float32) + 0.5) / size - 1,
+        2 * (rows.astype(np.float32) + 0.5) / size - 1,
+    )
+    one = np.ones_like(u)
+    return {
+        "f": (u, -v, one),
+        "r": (one, -v, -u),
+        "b": (-u, -v, -one),
+        "l": (-one, -v, u),
+        "u": (u, one, v),
+        "d": (u, -one, -v),
+    }[face]
+
+
+def renderCubeFace(
+    panorama, face, size, haov=PANORAMA_HAOV, vaov=PANORAMA_VAOV, strip_rows=TILE_SIZE
+):
+    """
+    Reprojects {panorama}, centred on yaw 0 and pitch 0 and covering {haov} x {vaov} degrees,
+    onto a {size} x {size} cube {face}. Directions outside the panorama are black.
+    Maps are built {strip_rows} rows at a time, so full-face maps are never held in memory
+    """
+    height, width = panorama.shape[:2]
+    out = np.empty((size, size, 3), dtype=np.uint8)
+
+    for start in range(0, size, strip_rows):
+        rows = np.arange(start, min(start + strip_rows, size))
+        x, y, z = _faceDirections(face, rows, size)
+        yaw = np.degrees(np.arctan2(x, z))
+        pitch = np.degrees(np.arctan2(y, np.hypot(x, z)))
+
+        map_x = ((yaw / haov + 0.5) * width - 0.5).astype(np.float32)
+        map_y = ((0.5 - pitch / vaov) * height - 0.5).astype(np.float32)
+        cv2.remap(
+            panorama,
+            map_x,
+            map_y,
+            cv2.INTER_LINEAR,
+            dst=out[rows[0] : rows[-1] + 1],
+            borderMode=cv2.BORDER_CONSTANT,
+        )
+
+    return out
+
+
+def saveThumbnail(panorama, path, width=THUMBNAIL_WIDTH):
+    """Writes {panorama} scaled down to {width} pixels wide to {path}"""
+    height = max(1, round(panorama.shape[0] * width / panorama.shape[1]))
+    thumbnail = cv2.resize(panorama, (width, height), interpolation=cv2.INTER_AREA)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    cv2.imwrite(path, thumbnail, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    return thumbnail
+
+
+def buildTilePyramid(
+    panorama, out_dir, tile_size=TILE_SIZE, haov=PANORAMA_HAOV, vaov=PANORAMA_VAOV
+):
+    """
+    Writes the tile pyramid of {panorama} to {out_dir}.
+    Returns the multiRes settings pannellum needs to load it, relative to {out_dir}
+    """
+    cube_resolution = getCubeResolution(panorama.shape[1], haov)
+    levels = getPyramidLevels(cube_resolution, tile_size)
+    for level in range(1, levels + 1):
+        os.makedirs(os.path.join(out_dir, str(level)), exist_ok=True)
+
+    for face in CUBE_FACES:
+        logging.debug(f"Building tiles of cube face {face}")
+        image = renderCubeFace(panorama, face, cube_resolution, haov, vaov)
+
+        # Halve the face for each level down, from the full resolution at the top level
+        for level in range(levels, 0, -1):
+            size = int(np.ceil(cube_resolution / 2 ** (levels - level)))
+            if image.shape[0] != size:
+                image = cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
+
+            for row, y in enumerate(range(0, size, tile_size)):
+                for column, x in enumerate(range(0, size, tile_size)):
+                    cv2.imwrite(
+                        os.path.join(out_dir, str(level), f"{face}{row}_{column}.jpg"),
+                        image[y : y + tile_size, x : x + tile_size],
+                        [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY],
+                    )
+
+    return {
+        "path": "/%l/%s%y_%x",
+        "extension": "jpg",
+        "tileResolution": tile_size,
+        "maxLevel": levels,
+        "cubeResolution": cube_resolution,
+    }
+
+
+if __name__ == "__main__":
+    # Build the pyramid of a panorama, and compare its size with the full JPEG
+    import sys
+    from time import perf_counter
+
+    PANORAMA_PATH = sys.argv[1] if len(sys.argv) > 1 else "./images/panorama.jpg"
+    OUT_DIR = "./tiles"
+
+    panorama = cv2.imread(PANORAMA_PATH)
+    if panorama is None:
+        panorama = np.random.default_rng(0).integers(
+            0, 256, (1586, 12768, 3), dtype=np.uint8
+        )
+        panorama = cv2.GaussianBlur(panorama, (31, 31), 0)
+
+    t0 = perf_counter()
+    saveThumbnail(panorama, os.path.join(OUT_DIR, "thumbnail.jpg"))
+    multires = buildTilePyramid(panorama, OUT_DIR)
+    print(f"Built {multires['maxLevel']} levels in {perf_counter() - t0:.2f}s: {multires}")
+
+    level_sizes = {}
+    for root, _, files in os.walk(OUT_DIR):
+        for f in files:
+            level_sizes[root] = level_sizes.get(root, 0) + os.path.getsize(
+                os.path.join(root, f)
+            )
+    full = len(cv2.imencode(".jpg", panorama)[1])
+    print(f"Full JPEG {full / 1e6:.1f}MB")
+    for root, size in sorted(level_sizes.items()):
+        print(f"{root}: {size / 1e6:.2f}MB")
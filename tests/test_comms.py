@@ -0,0 +1,72 @@
+import socket
+import threading
+import pytest
+
+pytest.importorskip("ultralytics")
+pytest.importorskip("torch")
+
+from comms.comms import (
+    send_object_detection_results,
+    receive_object_detection_results,
+)
+from object_detection.object_detection import Object
+
+
+def round_trip(values):
+    """Sends {values} with send_object_detection_results and returns what is received"""
+    a, b = socket.socketpair()
+    try:
+        sender = threading.Thread(
+            target=send_object_detection_results, args=(a, values)
+        )
+        sender.start()
+        received = receive_object_detection_results(b)
+        sender.join()
+        return received
+    finally:
+        a.close()
+        b.close()
+
+
+def make_object(i, camera):
+    obj = Object(
+        id=i,
+        label="person",
+        coords=[i, i, i + 100, i + 200],
+        conf=0.5,
+        camera=camera,
+    )
+    obj.set_hs_materials({"plant": 40.0})
+    return obj
+
+
+def describe(obj):
+    return (obj.id, obj.label, obj.coords, obj.conf, obj.camera, obj.hs_materials)
+
+
+def test_objects_per_camera_round_trip():
+    objects = [[make_object(0, 2), make_object(1, 2)], [], [make_object(2, 3)]]
+    received = round_trip(objects)
+    assert [[describe(o) for o in frame] for frame in received] == [
+        [describe(o) for o in frame] for frame in objects
+    ]
+
+
+def test_objects_round_trip():
+    objects = [make_object(i, i % 4) for i in range(3)]
+    assert [describe(o) for o in round_trip(objects)] == [describe(o) for o in objects]
+    assert round_trip([]) == []
+    assert round_trip([[], []]) == [[], []]
+
+
+def test_values_round_trip():
+    assert round_trip([{"person": True, "dog": False}]) == [
+        {"person": True, "dog": False}
+    ]
+    assert round_trip([False]) == [False]
+
+
+def test_unserialisable_values_raise():
+    a, b = socket.socketpair()
+    with a, b, pytest.raises(TypeError):
+        send_object_detection_results(a, [object()])
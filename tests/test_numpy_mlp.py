@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+
+from hyperspectral.numpy_mlp import (
+    NumpyMLP,
+    check_folding,
+    export_keras_model,
+    fold_keras_model,
+)
+
+
+# Stand-ins for keras layers, with the attributes fold_keras_model reads.
+# Each also runs its own forward pass, so the folded model is checked against the unfolded one
+class Dense:
+    def __init__(self, w, b=None, activation="linear"):
+        self.w, self.b, self.activation = w, b, activation
+
+    def get_config(self):
+        return {"activation": self.activation, "use_bias": self.b is not None}
+
+    def get_weights(self):
+        return [self.w] if self.b is None else [self.w, self.b]
+
+    def __call__(self, x):
+        x = x @ self.w + (0 if self.b is None else self.b)
+        if self.activation == "relu":
+            return np.maximum(x, 0)
+        if self.activation == "softmax":
+            e = np.exp(x - x.max(axis=1, keepdims=True))
+            return e / e.sum(axis=1, keepdims=True)
+        return x
+
+
+class BatchNormalization:
+    epsilon = 1e-3
+
+    def __init__(self, rng, n, scale=True, center=True):
+        self.gamma = rng.uniform(0.5, 2, n) if scale else None
+        self.beta = rng.normal(0, 0.5, n) if center else None
+        self.mean = rng.normal(0, 1, n)
+        self.var = rng.uniform(0.1, 3, n)
+
+    def get_config(self):
+        return {"scale": self.gamma is not None, "center": self.beta is not None}
+
+    def get_weights(self):
+        return [
+            p for p in (self.gamma, self.beta, self.mean, self.var) if p is not None
+        ]
+
+    def __call__(self, x):
+        x = (x - self.mean) / np.sqrt(self.var + self.epsilon)
+        if self.gamma is not None:
+            x = x * self.gamma
+        if self.beta is not None:
+            x = x + self.beta
+        return x
+
+
+class Dropout:
+    def get_config(self):
+        return {}
+
+    def __call__(self, x):
+        return x
+
+
+class Sequential:
+    def __init__(self, layers):
+        self.layers = layers
+
+    def __call__(self, x):
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+
+def dense(rng, n_in, n_out, activation="relu", bias=True):
+    return Dense(
+        rng.normal(0, 1 / np.sqrt(n_in), (n_in, n_out)),
+        rng.normal(0, 0.1, n_out) if bias else None,
+        activation,
+    )
+
+
+def models(rng, num_inputs=30, num_classes=5):
+    yield "NN.py layout", Sequential(
+        [
+            dense(rng, num_inputs, 64),
+            BatchNormalization(rng, 64),
+            Dropout(),
+            dense(rng, 64, 32),
+            BatchNormalization(rng, 32),
+            dense(rng, 32, num_classes, "softmax"),
+        ]
+    )
+    yield "consecutive and partial BatchNormalization", Sequential(
+        [
+            BatchNormalization(rng, num_inputs, scale=False),
+            BatchNormalization(rng, num_inputs, center=False),
+            dense(rng, num_inputs, 16, bias=False),
+            BatchNormalization(rng, 16),
+            dense(rng, 16, num_classes, "softmax"),
+        ]
+    )
+    yield "trailing BatchNormalization", Sequential(
+        [dense(rng, num_inputs, 16), BatchNormalization(rng, 16)]
+    )
+
+
+@pytest.mark.parametrize("index", range(3))
+def test_folding_matches_unfolded_forward_pass(index, tmp_path):
+    rng = np.random.default_rng(index)
+    name, model = list(models(rng))[index]
+    x = rng.random((1000, 30))
+    expected = model(x)
+
+    folded = NumpyMLP(fold_keras_model(model), chunk_size=256)
+    np.testing.assert_allclose(
+        folded.predict(x), expected, rtol=1e-4, atol=1e-5, err_msg=name
+    )
+
+    export_keras_model(model, tmp_path / "model.npz")
+    exported = NumpyMLP.from_npz(tmp_path / "model.npz", chunk_size=256)
+    np.testing.assert_allclose(exported.predict(x), expected, rtol=1e-4, atol=1e-5)
+    np.testing.assert_array_equal(
+        exported.predict_labels(x), np.argmax(exported.predict(x), axis=1)
+    )
+
+
+def test_folding_matches_keras():
+    pytest.importorskip("tensorflow")
+    check_folding()
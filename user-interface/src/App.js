@@ -58,6 +58,15 @@ function App() {
           // Save data
           setPins(data.pins)
           setLocationName(data.location)
+
+          // Swap a preview panorama for the full resolution panorama once it replaces the preview pin
+          if (selectedPin?.preview) {
+            const updated = data.pins.find((pin) => pin.uid === selectedPin.uid)
+            if (updated && !updated.preview) {
+              setSelectedPin(updated)
+              setObjects(updated.objects)
+            }
+          }
         });
       } catch (error) {
         console.log(error)
@@ -2,6 +2,7 @@
 import React, {useState, useEffect} from 'react';
 import '../styles/Panorama.css';
 import { Pannellum } from "pannellum-react";
+import { TiledPanorama } from "./TiledPanorama";
 
 export function Panorama({setShowLegend, panorama, setPanorama, selectedEnviroment, hsiManualScan, setHSIManualScan,   objects, locationName, setShowHSI, setSearchObjects, searchObjects, selectedPin, setTargetObject}) {
 
@@ -124,6 +125,11 @@ export function Panorama({setShowLegend, panorama, setPanorama, selectedEnvirome
         
     }, [showRGB, showObjects, showHSIClassification, showNDMI, showNVDI, showMSAVI, showCustom, showArtificial, showHSIRGB])
         
+    // RGB panoramas with a tile pyramid only load the tiles in view
+    const imagesPath = selectedEnviroment ? './images/' + selectedEnviroment.slice(0, -5) : null
+    const showTiles = (showRGB || showObjects) && selectedPin?.tiles_ref && selectedPin?.tiles_multires
+    const preview = (showRGB || showObjects) && selectedPin?.thumbnail_ref ? imagesPath + selectedPin.thumbnail_ref : undefined
+
     return (
         <div className='panorama-container'>
             <h1 style={{fontWeight: 'lighter', position: 'absolute', left: '5px', top: '30px', color: 'white', zIndex: 100, fontSize: '16px'}}>Lon/Lat: {selectedPin?.geo_coords} </h1>
@@ -140,13 +146,25 @@ export function Panorama({setShowLegend, panorama, setPanorama, selectedEnvirome
 
             </div>
 
-            {panorama ? (
+            {panorama && showTiles ? (
+                <div style={{backgroundColor: 'black', width: '100%', height: '100%'}}>
+                    <TiledPanorama
+                        basePath={imagesPath + selectedPin.tiles_ref}
+                        multiRes={selectedPin.tiles_multires}
+                        preview={preview}
+                        objects={objects}
+                        showObjects={showObjects}
+                        handleHotspot={handleHotspot}
+                    />
+                </div>
+            ) : panorama ? (
                 // <img src={panorama} alt='Dynamic' className='panorama'/>
                 <div style={{backgroundColor: 'black', width: '100%', height: '100%'}}>
                     <Pannellum
                         width={"100%"}
                         height={"100vh"}
                         image={panorama}
+                        preview={preview}
                         haov={showRGB|| showObjects ? 358 : 220}
                         vaov={showRGB|| showObjects ? 60 : 27}
                         yaw={showRGB|| showObjects ? 225 : 0}
@@ -0,0 +1,44 @@
+// This file creates a TiledPanorama component, which shows a panorama from its tile pyramid.
+// Only the tiles in view are downloaded, at the resolution in view
+import React, {useEffect, useRef} from 'react';
+import 'pannellum/build/pannellum.css';
+import 'pannellum/build/pannellum.js';
+
+export function TiledPanorama({basePath, multiRes, preview, objects, showObjects, handleHotspot}) {
+
+    const container = useRef(null)
+
+    // Rebuild the viewer whenever the panorama or its hotspots change
+    useEffect(() => {
+        const hotSpots = showObjects ? (objects ?? []).map((obj) => ({
+            type: 'info',
+            pitch: (obj.y/815)*-1*30,
+            yaw: (obj.x/6399)*179,
+            createTooltipFunc: (hotSpotDiv) => {
+                obj?.HS_classification_ref ? hotSpotDiv.classList.add("custom-hotspot-blue") : hotSpotDiv.classList.add("custom-hotspot");
+                obj?.HS_classification_ref ? hotSpotDiv.innerHTML = `<div class="custom-hotspot-inner-blue"/><h1 class="hotspot-text">${obj.RGB_classification}<h1/>`
+                : hotSpotDiv.innerHTML =  `<div class="custom-hotspot-inner"/><h1 class="hotspot-text">${obj.RGB_classification}<h1/>`;
+            },
+            clickHandlerFunc: () => handleHotspot(obj)
+        })) : []
+
+        const viewer = window.pannellum.viewer(container.current, {
+            type: 'multires',
+            multiRes: {...multiRes, basePath: basePath},
+            preview: preview,
+            yaw: 225,
+            autoLoad: true,
+            showControls: true,
+            showFullscreenCtrl: true,
+            showZoomCtrl: true,
+            orientationOnByDefault: true,
+            hotSpots: hotSpots
+        })
+
+        return () => viewer.destroy()
+    }, [basePath, multiRes, preview, objects, showObjects])
+
+    return (
+        <div ref={container} style={{width: '100%', height: '100vh'}}/>
+    );
+}